@@ -0,0 +1,544 @@
+import array
+import bisect
+import mmap
+import os
+import struct
+import sys
+
+# Node status codes.
+STATUSES = ("unchanged", "added", "removed", "modified")
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
+# isDirectory is True, False, or (for processes) None.
+DIR_FALSE = 0
+DIR_TRUE = 1
+DIR_NONE = 2
+_DIR_VALUES = (False, True, None)
+
+NO_PARENT = -1
+
+# Orders children can be listed in. Children are stored by name; the others are sorted on request.
+SORTS = ("name", "status", "lines", "descendants")
+# Changed nodes first.
+_STATUS_RANKS = array.array("B", [3, 1, 2, 0])
+PAGE_SIZE = 1000
+# Defaults for prefetching several levels of the tree at once.
+SUBTREE_DEPTH = 3
+SUBTREE_BUDGET = 2000
+
+_MAGIC = b"VMDTREE\0"
+_VERSION = 1
+# magic, version, byte order (1 = little endian), number of nodes, number of sections
+_HEADER = struct.Struct("<8sIIII")
+# name, offset, length
+_SECTION = struct.Struct("<32sQQ")
+_ALIGNMENT = 8
+
+# Per-node arrays, with their array typecodes.
+_NODE_ARRAYS = (
+    ("parent", "i"),
+    # Children are laid out contiguously (breadth first), so a node's next sibling is the next index.
+    ("first_child", "I"),
+    ("child_count", "I"),
+    ("status", "B"),
+    ("is_dir", "B"),
+    ("key_id", "I"),
+    ("title_id", "I"),
+    ("lines_added", "I"),
+    ("lines_removed", "I"),
+    ("diff_bytes", "Q"),
+    # File descendants, as shown by the frontend.
+    ("num_children", "I"),
+    ("num_direct_children", "I"),
+    # Aggregates over the subtree rooted at each node (including the node itself).
+    ("subtree_lines_added", "Q"),
+    ("subtree_lines_removed", "Q"),
+    ("subtree_diff_bytes", "Q"),
+    ("subtree_added", "I"),
+    ("subtree_removed", "I"),
+    ("subtree_modified", "I"),
+)
+
+
+class StringTable(object):
+    """A list of strings stored as one UTF-8 blob and an array of offsets, decoded on access."""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_strings(cls, strings):
+        offsets = array.array("Q", [0])
+        parts = []
+        position = 0
+        for string in strings:
+            data = string.encode("utf8")
+            parts.append(data)
+            position += len(data)
+            offsets.append(position)
+        return cls(offsets, b"".join(parts))
+
+    def __getitem__(self, index):
+        return str(self.blob[self.offsets[index]:self.offsets[index + 1]], "utf8")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def get_page_key(key, sort="name", cursor=None):
+    """Key of one page of children in the static export. The first page by name has the node's own key."""
+    if sort == "name" and not cursor:
+        return key
+    return f"{key}\0{sort}\0{cursor or ''}"
+
+
+class CompactTree(object):
+    """The diff tree as parallel arrays, with its strings in tables.
+
+    Nodes are numbered breadth first, so the children of a node are the contiguous
+    range first_child .. first_child + child_count, sorted by key. Node JSON for the
+    frontend is produced on demand. Saved as a single binary file that's loaded
+    (or memory mapped) without parsing.
+    """
+
+    # Number of directories whose sorted children are kept.
+    _SORTED_CHILDREN_SIZE = 256
+
+    def __init__(self, arrays, keys, titles, roots, sorted_keys):
+        """
+        Args:
+            arrays (dict): name -> array (or memoryview) for each of _NODE_ARRAYS.
+            keys (StringTable): node keys.
+            titles (StringTable): distinct node titles.
+            roots (sequence[int]): root node indices.
+            sorted_keys (sequence[int]): node indices sorted by key, to look keys up.
+        """
+        self.arrays = arrays
+        for name, value in arrays.items():
+            setattr(self, name, value)
+        self.keys = keys
+        self.titles = titles
+        self.roots = roots
+        self.sorted_keys = sorted_keys
+        # (node, sort) -> children in that order, for the directories that have been listed.
+        self._sorted_children = {}
+
+    @classmethod
+    def build(cls, roots, children, keys, titles, statuses, is_dirs, lines_added, lines_removed, diff_bytes):
+        """Lay out a tree breadth first, and compute the file counts and subtree aggregates in one bottom-up pass.
+
+        Args:
+            roots (list[int]): root nodes.
+            children (list[list[int]]): children of each node.
+            keys (list[str]): key of each node.
+            titles (list[str]): title of each node.
+            statuses (list[str]): status of each node.
+            is_dirs (list[bool | None]): isDirectory of each node.
+            lines_added, lines_removed, diff_bytes (list[int]): diff stats of each node.
+
+        Nodes that can't be reached from the roots are left out.
+        """
+        order = list(roots)
+        first_child = array.array("I")
+        child_count = array.array("I")
+        parent = array.array("i", [NO_PARENT] * len(roots))
+
+        for position, node in enumerate(order):
+            node_children = sorted(children[node], key=keys.__getitem__)
+            first_child.append(len(order))
+            child_count.append(len(node_children))
+            parent.extend([position] * len(node_children))
+            order.extend(node_children)
+
+        num_nodes = len(order)
+        title_ids = {}
+        arrays = {
+            "parent": parent,
+            "first_child": first_child,
+            "child_count": child_count,
+            "status": array.array("B", (STATUS_CODES[statuses[node]] for node in order)),
+            "is_dir": array.array("B", (_DIR_VALUES.index(is_dirs[node]) for node in order)),
+            "key_id": array.array("I", range(num_nodes)),
+            "title_id": array.array("I", (title_ids.setdefault(titles[node], len(title_ids)) for node in order)),
+            "lines_added": array.array("I", (lines_added[node] for node in order)),
+            "lines_removed": array.array("I", (lines_removed[node] for node in order)),
+            "diff_bytes": array.array("Q", (diff_bytes[node] for node in order)),
+        }
+        for name, typecode in _NODE_ARRAYS:
+            if name not in arrays:
+                arrays[name] = array.array(typecode, bytes(
+                    array.array(typecode).itemsize * num_nodes))
+
+        num_children = arrays["num_children"]
+        num_direct_children = arrays["num_direct_children"]
+        subtree_lines_added = arrays["subtree_lines_added"]
+        subtree_lines_removed = arrays["subtree_lines_removed"]
+        subtree_diff_bytes = arrays["subtree_diff_bytes"]
+        subtree_counts = {
+            STATUS_CODES["added"]: arrays["subtree_added"],
+            STATUS_CODES["removed"]: arrays["subtree_removed"],
+            STATUS_CODES["modified"]: arrays["subtree_modified"],
+        }
+        status = arrays["status"]
+        is_dir = arrays["is_dir"]
+
+        for node in reversed(range(num_nodes)):
+            subtree_lines_added[node] += arrays["lines_added"][node]
+            subtree_lines_removed[node] += arrays["lines_removed"][node]
+            subtree_diff_bytes[node] += arrays["diff_bytes"][node]
+            if status[node] in subtree_counts:
+                subtree_counts[status[node]][node] += 1
+
+            node_parent = parent[node]
+            if node_parent == NO_PARENT:
+                continue
+
+            # Count the number of file descendants of each node. (Don't count directories as children.)
+            if is_dir[node] != DIR_TRUE:
+                num_children[node_parent] += 1
+                num_direct_children[node_parent] += 1
+            num_children[node_parent] += num_children[node]
+
+            subtree_lines_added[node_parent] += subtree_lines_added[node]
+            subtree_lines_removed[node_parent] += subtree_lines_removed[node]
+            subtree_diff_bytes[node_parent] += subtree_diff_bytes[node]
+            for counts in subtree_counts.values():
+                counts[node_parent] += counts[node]
+
+        sorted_keys = array.array("I", sorted(
+            range(num_nodes), key=lambda node: keys[order[node]]))
+
+        return cls(
+            arrays,
+            StringTable.from_strings(keys[node] for node in order),
+            StringTable.from_strings(title_ids),
+            array.array("I", range(len(roots))),
+            sorted_keys,
+        )
+
+    def __len__(self):
+        return len(self.parent)
+
+    def get_key(self, node):
+        return self.keys[self.key_id[node]]
+
+    def get_title(self, node):
+        return self.titles[self.title_id[node]]
+
+    def find(self, key):
+        """
+        Returns:
+            int: the node with the key, or None.
+        """
+        position = bisect.bisect_left(_KeyView(self), key)
+        if position < len(self.sorted_keys):
+            node = self.sorted_keys[position]
+            if self.get_key(node) == key:
+                return node
+        return None
+
+    def get_children(self, node):
+        first_child = self.first_child[node]
+        return range(first_child, first_child + self.child_count[node])
+
+    def node_json(self, node):
+        """The node as the frontend expects it."""
+        return {
+            "title": self.get_title(node),
+            "key": self.get_key(node),
+            "isLeaf": self.child_count[node] == 0,
+            "isDirectory": _DIR_VALUES[self.is_dir[node]],
+            "children": [],
+            "status": STATUSES[self.status[node]],
+            "linesAdded": self.lines_added[node],
+            "linesRemoved": self.lines_removed[node],
+            "numChildren": self.num_children[node],
+            "numDirectChildren": self.num_direct_children[node],
+        }
+
+    def children_json(self, node):
+        return [self.node_json(child) for child in self.get_children(node)]
+
+    def get_sorted_children(self, node, sort="name"):
+        """
+        Args:
+            sort (str): one of SORTS. Ties are in name order.
+
+        Returns:
+            sequence[int]: the children of node in that order.
+        """
+        children = self.get_children(node)
+        if sort == "name" or len(children) < 2:
+            return children
+
+        sorted_children = self._sorted_children.get((node, sort))
+        if sorted_children is not None:
+            return sorted_children
+
+        if sort == "status":
+            sort_keys = [_STATUS_RANKS[self.status[child]] for child in children]
+        elif sort == "lines":
+            sort_keys = [-(self.subtree_lines_added[child] + self.subtree_lines_removed[child])
+                         for child in children]
+        elif sort == "descendants":
+            sort_keys = [-self.num_children[child] for child in children]
+        else:
+            raise ValueError(f"Unknown sort {sort}, expected one of {SORTS}")
+
+        # Stable, so ties stay in name order.
+        positions = sorted(range(len(children)), key=sort_keys.__getitem__)
+        sorted_children = array.array("I", (children[position] for position in positions))
+        if len(self._sorted_children) >= self._SORTED_CHILDREN_SIZE:
+            self._sorted_children.clear()
+        self._sorted_children[(node, sort)] = sorted_children
+        return sorted_children
+
+    def children_page(self, node, sort="name", cursor=None, limit=PAGE_SIZE):
+        """One page of the children of node.
+
+        Args:
+            cursor (str): nextCursor of the previous page, None for the first page.
+
+        Returns:
+            dict: children (node JSON), total (number of children) and nextCursor (None on the last page).
+        """
+        start = int(cursor) if cursor else 0
+        if start < 0 or limit < 1:
+            raise ValueError(f"Invalid cursor {cursor} or limit {limit}")
+
+        children = self.get_sorted_children(node, sort)
+        end = min(start + limit, len(children))
+        return {
+            "children": [self.node_json(child) for child in children[start:end]],
+            "total": len(children),
+            "nextCursor": str(end) if end < len(children) else None,
+        }
+
+    def iter_pages(self, node, sort="name", limit=PAGE_SIZE):
+        """Yield (cursor, page) for every page of the children of node."""
+        cursor = None
+        while True:
+            page = self.children_page(node, sort, cursor, limit)
+            yield cursor, page
+            cursor = page["nextCursor"]
+            if cursor is None:
+                return
+
+    def has_changes(self, node):
+        """Whether anything in the subtree of node changed."""
+        return bool(self.subtree_added[node] or self.subtree_removed[node] or self.subtree_modified[node])
+
+    def subtree_json(self, node, depth=SUBTREE_DEPTH, changed_only=False, budget=SUBTREE_BUDGET):
+        """Several levels of the tree below node, in one response.
+
+        Levels are filled in breadth first, with the "children" of each node either all there or
+        left empty (for the client to load later), until depth levels or the node budget is reached.
+
+        Args:
+            depth (int): number of levels below node.
+            changed_only (bool): only descend into children with changes under them.
+            budget (int): maximum number of nodes.
+
+        Returns:
+            dict: children (nested node JSON, or None if node alone has more children than
+                the budget), numNodes and truncated (whether the budget cut it short).
+        """
+        if self.child_count[node] > budget:
+            return {"children": None, "numNodes": 0, "truncated": True}
+
+        children = self.children_json(node)
+        num_nodes = len(children)
+        truncated = False
+        # (node index, node JSON) of the nodes whose children are next to be filled in.
+        level = list(zip(self.get_children(node), children))
+        for _ in range(depth - 1):
+            next_level = []
+            for child, child_json in level:
+                if not self.child_count[child] or (changed_only and not self.has_changes(child)):
+                    continue
+                if num_nodes + self.child_count[child] > budget:
+                    truncated = True
+                    continue
+                child_json["children"] = self.children_json(child)
+                num_nodes += len(child_json["children"])
+                next_level.extend(
+                    zip(self.get_children(child), child_json["children"]))
+            level = next_level
+
+        return {"children": children, "numNodes": num_nodes, "truncated": truncated}
+
+    def tree_json(self):
+        return [self.node_json(root) for root in self.roots]
+
+    def iter_children_json(self):
+        """Yield (key, children JSON) for every node."""
+        for node in range(len(self)):
+            yield self.get_key(node), self.children_json(node)
+
+    def get_children_map(self):
+        return dict(self.iter_children_json())
+
+    def get_aggregates(self, node):
+        """Totals over the subtree rooted at a node."""
+        return {
+            "linesAdded": self.subtree_lines_added[node],
+            "linesRemoved": self.subtree_lines_removed[node],
+            "diffBytes": self.subtree_diff_bytes[node],
+            "added": self.subtree_added[node],
+            "removed": self.subtree_removed[node],
+            "modified": self.subtree_modified[node],
+        }
+
+    def merge(self, other):
+        """Combine two trees into one with the roots of both."""
+        num_nodes = len(self)
+        num_titles = len(self.titles)
+        arrays = {}
+        for name, typecode in _NODE_ARRAYS:
+            merged = array.array(typecode, self.arrays[name])
+            offset = {"parent": num_nodes, "first_child": num_nodes,
+                      "key_id": num_nodes, "title_id": num_titles}.get(name, 0)
+            if name == "parent":
+                merged.extend(parent + offset if parent != NO_PARENT else NO_PARENT
+                              for parent in other.arrays[name])
+            else:
+                merged.extend(value + offset for value in other.arrays[name])
+            arrays[name] = merged
+
+        keys = StringTable.from_strings(list(self.keys) + list(other.keys))
+        titles = StringTable.from_strings(
+            list(self.titles) + list(other.titles))
+        roots = array.array(
+            "I", list(self.roots) + [root + num_nodes for root in other.roots])
+        sorted_keys = array.array("I", sorted(
+            range(len(keys)), key=keys.__getitem__))
+        return CompactTree(arrays, keys, titles, roots, sorted_keys)
+
+    def save(self, path):
+        """Write the tree, replacing any previous file atomically, since readers may have it mapped."""
+        sections = [(name, self.arrays[name]) for name, _ in _NODE_ARRAYS]
+        sections.extend([
+            ("roots", self.roots),
+            ("sorted_keys", self.sorted_keys),
+            ("key_offsets", self.keys.offsets),
+            ("key_blob", self.keys.blob),
+            ("title_offsets", self.titles.offsets),
+            ("title_blob", self.titles.blob),
+        ])
+
+        write_sections(path, _MAGIC, len(self), sections)
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Use a saved tree in place, e.g. from bytes or an mmap, without copying or parsing it."""
+        typecodes = dict(_NODE_ARRAYS)
+        typecodes.update({"roots": "I", "sorted_keys": "I",
+                         "key_offsets": "Q", "title_offsets": "Q"})
+        _, sections = read_sections(buffer, _MAGIC, typecodes)
+
+        arrays = {name: sections[name] for name, _ in _NODE_ARRAYS}
+        return cls(
+            arrays,
+            StringTable(sections["key_offsets"], sections["key_blob"]),
+            StringTable(sections["title_offsets"], sections["title_blob"]),
+            sections["roots"],
+            sections["sorted_keys"],
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Read a saved tree into memory."""
+        with open(path, "rb") as f:
+            return cls.from_buffer(f.read())
+
+    @classmethod
+    def open(cls, path):
+        """Memory map a saved tree. Opening takes constant time, pages are only read when
+        nodes are accessed, and processes serving the same tree share them in the page cache.
+        """
+        return cls.from_buffer(map_file(path))
+
+
+class _KeyView(object):
+    """Keys in sorted order, as a sequence for bisect."""
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __getitem__(self, position):
+        return self.tree.get_key(self.tree.sorted_keys[position])
+
+    def __len__(self):
+        return len(self.tree.sorted_keys)
+
+
+def _align(position):
+    return -(-position // _ALIGNMENT) * _ALIGNMENT
+
+
+def write_sections(path, magic, num_items, sections):
+    """Write named arrays and blobs to a file that can be used in place, replacing any previous
+    file atomically, since readers may have it mapped.
+
+    Args:
+        magic (bytes): 8 bytes identifying the kind of file.
+        num_items (int): number of items (e.g. nodes), recorded in the header.
+        sections (list[tuple[str, buffer]]): (name, array or bytes).
+    """
+    table_size = _HEADER.size + _SECTION.size * len(sections)
+    position = _align(table_size)
+    table = []
+    for name, data in sections:
+        length = memoryview(data).nbytes
+        table.append((name, position, length))
+        position = _align(position + length)
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(_HEADER.pack(magic, _VERSION, sys.byteorder == "little",
+                             num_items, len(sections)))
+        for name, offset, length in table:
+            f.write(_SECTION.pack(name.encode(), offset, length))
+        for (name, offset, length), (_, data) in zip(table, sections):
+            f.write(bytes(offset - f.tell()))
+            f.write(memoryview(data).cast("B"))
+    os.replace(temp_path, path)
+
+
+def read_sections(buffer, magic, typecodes):
+    """The sections of a file written by write_sections, as views into buffer (no copies).
+
+    Args:
+        typecodes (dict): section name -> array typecode; other sections are left as bytes.
+
+    Returns:
+        tuple: (num_items: int, sections: dict of name -> memoryview)
+    """
+    view = memoryview(buffer)
+    file_magic, version, little_endian, num_items, num_sections = _HEADER.unpack_from(
+        view)
+    if file_magic != magic or version != _VERSION:
+        raise ValueError(f"Expected a {magic!r} file of version {_VERSION}")
+    if bool(little_endian) != (sys.byteorder == "little"):
+        raise ValueError("File was written on a machine with another byte order")
+
+    sections = {}
+    for index in range(num_sections):
+        name, offset, length = _SECTION.unpack_from(
+            view, _HEADER.size + index * _SECTION.size)
+        name = name.rstrip(b"\0").decode()
+        section = view[offset:offset + length]
+        sections[name] = section.cast(
+            typecodes[name]) if name in typecodes else section
+    return num_items, sections
+
+
+def map_file(path):
+    """Memory map a file read-only."""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,59 @@
+import json
+
+import packstore
+
+
+class ComponentCache(object):
+    """Per-file diff components of one pair of images, independent of the run options.
+
+    Each component (file facts, stat/times/attributes hunks, contents diff) is stored
+    under its own key, so a run with other options or filters only computes the
+    components it hasn't seen before, and assembles the rest from the cache.
+    """
+
+    # Writes are batched, one pack transaction per batch.
+    _FLUSH_SIZE = 1000
+
+    def __init__(self, path):
+        self.pack = packstore.PackStore(path, writable=True)
+        self._pending = {}
+
+    @staticmethod
+    def _key(name, path):
+        return f"{name}:{path}"
+
+    def get(self, name, path=""):
+        """
+        Returns:
+            The cached value of the component, or None if it hasn't been computed yet.
+        """
+        key = self._key(name, path)
+        if key in self._pending:
+            return self._pending[key]
+
+        entry = self.pack.get(key)
+        if entry is None:
+            return None
+        data, _, _ = entry
+        return json.loads(data)
+
+    def has(self, name, path=""):
+        """Whether the component has been computed, without reading it."""
+        key = self._key(name, path)
+        return key in self._pending or key in self.pack
+
+    def put(self, name, path, value):
+        self._pending[self._key(name, path)] = value
+        if len(self._pending) >= self._FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        self.pack.put_many(
+            (key, json.dumps(value).encode(), 0, None) for key, value in self._pending.items())
+        self._pending = {}
+
+    def close(self):
+        self.flush()
+        self.pack.close()
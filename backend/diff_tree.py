@@ -1,218 +1,210 @@
-import utils
+import sys
+
+import compact_tree
 
 
 class DiffTree(object):
+    """The tree of changed files (or processes) shown by the frontend, built from a finished result set.
+
+    Only the results are read (differ.diffs and differ.diff_type), never the images: parent
+    directories that aren't in the results are added as "unchanged" nodes. Nodes are gathered
+    into flat lists by index, then packed into a CompactTree, which produces node JSON on demand.
+    """
+
+    PROCESS_ROOT_KEY = "Processes"
 
     def __init__(self, differ):
+        # Node index by key.
         self.nodes = {}
-        self.children_map = {}
+        self.keys = []
+        self.titles = []
+        self.statuses = []
+        self.is_dirs = []
+        self.lines_added = []
+        self.lines_removed = []
+        self.diff_bytes = []
 
-        # Parents of leaf nodes only
-        self.leaf_parents = {}
-
-        # Create the nested array structure that will be the tree.
-        self.tree = []
         self.root = None
-
-        self.node_parent_ids = {}
+        self.compact = None
 
         self.differ = differ
 
         self.create_file_tree()
 
+    @classmethod
+    def from_compact(cls, compact):
+        """A tree around an already built CompactTree, e.g. one loaded from the cache."""
+        tree = cls.__new__(cls)
+        tree.differ = None
+        tree.root = compact.roots[0] if len(compact.roots) else None
+        tree.compact = compact
+        return tree
+
     def merge(self, other):
         """Combine this diff tree with another (only so it can be cached/uncached)"""
-        self.nodes.update(other.nodes)
-        self.children_map.update(other.children_map)
-        self.tree.extend(other.tree)
+        self.compact = self.compact.merge(other.compact)
         return self
 
     def get_tree(self):
-        return self.tree
+        return self.compact.tree_json()
 
     def get_children_map(self):
-        return self.children_map
+        return self.compact.get_children_map()
 
     def get_children(self, parent_node):
-        key = parent_node["key"]
-        if key not in self.children_map:
-            self.children_map[key] = []
-        return self.children_map[key]
-
-    def add_child(self, parent_node, child):
-        key = parent_node["key"]
-        if key not in self.children_map:
-            self.children_map[key] = []
-        self.children_map[key].append(child)
-
-    def create_node(self, path: str, is_dir=True, is_leaf=False):
-        """Create a node, allowing for children to be added later."""
-
-        if path in self.nodes:
-            return
-
-        if self.differ.diff_type == "disk":
-            p = utils.ensure_posix(path)
-            parent_id = None if p.parent == p else str(p.parent)
-
-            if parent_id is None:
-                text = "/"
-            else:
-                text = p.name
-            key = str(p)
-        elif self.differ.diff_type == "process":
-            node_id = path
-            text = node_id
-            pid = node_id.split("-")[-1]
-            key = pid
-
-        # Defaults (for created parent nodes, mostly)
-        status = "unchanged"
-        lines_added = 0
-        lines_removed = 0
-
-        diff = self.differ.diff(path)
-
+        node = self.compact.find(parent_node["key"])
+        if node is None:
+            return []
+        return self.compact.children_json(node)
+
+    def create_node(self, key, title, is_dir=True, diff=None):
+        """Create a node, with the status of its diff if it has one (otherwise it's an unchanged parent).
+
+        Returns:
+            int: the node's index.
+        """
+        node = len(self.keys)
+        self.keys.append(key)
+        self.titles.append(title)
+        self.statuses.append("unchanged")
+        self.is_dirs.append(is_dir)
+        self.lines_added.append(0)
+        self.lines_removed.append(0)
+        self.diff_bytes.append(0)
         if diff is not None:
-            status = diff.status
-            lines_added = diff.lines_added
-            lines_removed = diff.lines_removed
-
-            if diff.title:
-                text = diff.title
-
-            # This gets fixed later.
-            is_leaf = not diff.is_dir
-            is_dir = diff.is_dir
-
-            ppid = diff.ppid
-            if ppid is not None:
-                # Save which node is this node's parent, if any.
-                self.node_parent_ids[pid] = ppid
-
-        node = {
-            "title": text,
-            "key": key,
-            "isLeaf": is_leaf,
-            "isDirectory": is_dir,
-            "children": [],
-            "status": status,
-            "linesAdded": lines_added,
-            "linesRemoved": lines_removed,
-            "numChildren": 0,
-            "numDirectChildren": 0,
-        }
+            self.set_diff(node, diff)
         self.nodes[key] = node
         return node
 
-    def create_root_process_node(self):
-        key = "Processes"
-        node = {
-            "title": key,
-            "key": key,
-            "isLeaf": False,
-            "isDirectory": False,
-            "children": [],
-            "status": "modified",
-            "linesAdded": 0,
-            "linesRemoved": 0,
-            "numChildren": 0,
-            "numDirectChildren": 0,
-        }
-        self.nodes[key] = node
-        self.node_parent_ids[key] = key
-        self.root = node
-        return node
-
-    def get_parent(self, node):
-        if self.differ.diff_type == "disk":
-            p = utils.ensure_posix(node["key"])
-            parent_path = str(p.parent)
-            parent_node = self.nodes.get(parent_path)
-            return parent_node
-
-        elif self.differ.diff_type == "process":
-            parent_id = self.node_parent_ids.get(node["key"])
-            parent = self.nodes.get(parent_id)
-            if parent is None:
-                return self.root
-            return parent
+    def set_diff(self, node, diff):
+        self.statuses[node] = diff.status
+        self.lines_added[node] = diff.lines_added
+        self.lines_removed[node] = diff.lines_removed
+        self.diff_bytes[node] = diff.bytes_changed
+        self.is_dirs[node] = diff.is_dir
+        if diff.title:
+            self.titles[node] = diff.title
+
+    @staticmethod
+    def split_path(path):
+        """Split a disk path (POSIX or Windows) into its components, interned since names repeat a lot."""
+        if path.startswith("\\"):
+            path = path.replace("\\", "/")
+        return [sys.intern(part) for part in path.split("/") if part and part != "."]
 
     def create_file_tree(self):
 
         # If we're calling this function a second time, we don't need to do anything, the tree is already generated.
-        if len(self.tree) > 0:
+        if self.compact is not None:
             return
 
-        def create_parent_nodes(path: str):
-
-            p = utils.ensure_posix(path)
-            parent_paths = p.parents
-            for parent_path in parent_paths:
-                parent_path = str(parent_path)
-                if parent_path not in self.nodes:
-                    self.nodes[parent_path] = self.create_node(
-                        parent_path, is_dir=True)
-
-        paths = self.differ.diffs.keys()
-
-        # Create flat node index.
-        for path in paths:
-            if self.differ.diff_type == "disk":
-                create_parent_nodes(path)
-
-            self.create_node(path)
-
-        if self.differ.diff_type == "process" and len(self.differ.diffs) > 0:
-            self.create_root_process_node()
-
-        # Link up the nodes to their parents
-        for path, node in sorted(self.nodes.items()):
-
-            parent_node = self.get_parent(node)
+        if self.differ.diff_type == "disk":
+            child_keys = self._create_disk_nodes()
+        elif self.differ.diff_type == "process":
+            child_keys = self._create_process_nodes()
+
+        children = [[] for _ in self.keys]
+        for parent_key, siblings in child_keys.items():
+            children[self.nodes[parent_key]] = [
+                self.nodes[child_key] for child_key in siblings.values()]
+
+        self.compact = compact_tree.CompactTree.build(
+            [] if self.root is None else [self.root], children, self.keys, self.titles, self.statuses, self.is_dirs,
+            self.lines_added, self.lines_removed, self.diff_bytes)
+
+    def _create_disk_nodes(self):
+        """Create a node for every path in the results and every parent directory.
+
+        Returns:
+            dict: {parent key: {child name: child key}}
+        """
+        diffs = self.differ.diffs
+        if not diffs:
+            return {}
+
+        self.root = self.create_node("/", "/")
+        child_keys = {}
+        # Keys of the directories seen so far, by path as given, so each directory is only split once.
+        dir_keys = {"": "/"}
+
+        for path, diff in diffs.items():
+            if path.startswith("\\"):
+                path = path.replace("\\", "/")
+            directory, _, name = path.rstrip("/").rpartition("/")
+
+            key = dir_keys.get(directory)
+            if key is None:
+                key = dir_keys[directory] = self._add_path(
+                    child_keys, "/", self.split_path(directory))
+            if name and name != ".":
+                key = self._add_path(child_keys, key, [sys.intern(name)])
+
+            self.set_diff(self.nodes[key], diff)
+
+        return child_keys
+
+    def _add_path(self, child_keys, key, parts):
+        """Create the nodes of path components under the node key, if they don't exist yet.
+
+        Returns:
+            str: key of the last component's node.
+        """
+        for part in parts:
+            siblings = child_keys.get(key)
+            if siblings is None:
+                siblings = child_keys[key] = {}
+
+            child_key = siblings.get(part)
+            if child_key is None:
+                child_key = f"/{part}" if key == "/" else f"{key}/{part}"
+                siblings[part] = child_key
+                self.create_node(child_key, part)
+            key = child_key
+        return key
+
+    def _create_process_nodes(self):
+        """Create a node for every process in the results, under its parent process (or the root).
+
+        Returns:
+            dict: {parent key: {child key: child key}}
+        """
+        diffs = self.differ.diffs
+        if not diffs:
+            return {}
+
+        self.root = self.create_node(self.PROCESS_ROOT_KEY, self.PROCESS_ROOT_KEY, is_dir=False)
+        self.statuses[self.root] = "modified"
+
+        ppids = {}
+        for node_id, diff in diffs.items():
+            pid = node_id.split("-")[-1]
+            self.create_node(pid, node_id, diff=diff)
+            ppids[pid] = diff.ppid
 
-            # If this node is the root, just add it.
-            if parent_node == node:
-                self.root = node
-                self.tree.append(node)
-                continue
+        parent_keys = {
+            pid: ppid if ppid in ppids and ppid != pid else self.PROCESS_ROOT_KEY for pid, ppid in ppids.items()}
 
-            # Otherwise, insert this node underneath the parent node.
-            # Sorting paths guarantees that parents are inserted first, then children.
-            if parent_node:
-                # Link this node to its parent
-                self.add_child(parent_node, node)
+        # Reused PIDs can make parent cycles, which would never reach the root: hang them off the root instead.
+        reaches_root = set([self.PROCESS_ROOT_KEY])
+        for pid in sorted(parent_keys):
+            ancestors = []
+            key = pid
+            while key not in reaches_root and key not in ancestors:
+                ancestors.append(key)
+                key = parent_keys[key]
+            if key not in reaches_root:
+                parent_keys[key] = self.PROCESS_ROOT_KEY
+            reaches_root.update(ancestors)
 
-        if len(self.tree) > 0:
-            root = self.tree[0]
-        else:
-            root = []
+        child_keys = {}
+        for pid, parent_key in parent_keys.items():
+            child_keys.setdefault(parent_key, {})[pid] = pid
 
-        if len(self.tree) == 0:
-            return []
-        # Fix the tree
-        for node in reversed(list(self.traverse(root))):
-            # Directories without children should be leaves.
-            children = self.get_children(node)
-            if len(children) == 0:
-                node["isLeaf"] = True
-            else:
-                node["isLeaf"] = False
-                # Count the number of file descendants of each node.
-                for child in children:
-                    num_child_children = 0
-                    # Don't count directories as children.
-                    if not child["isDirectory"]:
-                        num_child_children += 1
-                        node["numDirectChildren"] += 1
-
-                    num_child_children += child["numChildren"]
-
-                    node["numChildren"] += num_child_children
-
-        return
+        return child_keys
 
     def traverse(self, node):
-        yield node
-        for child in self.get_children(node):
-            yield from self.traverse(child)
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            yield node
+            pending.extend(reversed(self.get_children(node)))
@@ -1,31 +1,239 @@
+import collections.abc
+import functools
+import io
 import pathlib
 import os
 import logging
 import json
+import shutil
 
+import compact_tree
+import grep_index
+import packstore
+import progress
+import search_index
 import unified_diff
 import utils
 
 DIR_META_FILENAME = ".__this_directory__"
+# Index of a mirrored run: which file holds the diff of each path.
+MANIFEST_FILENAME = ".__manifest__.json"
+# The diff tree of a run, see compact_tree.
+TREE_FILENAME = "tree.bin"
+# Path search index over the tree, see search_index.
+SEARCH_INDEX_FILENAME = "search.bin"
+
+# Stand-ins for the from/to file names in the headers of diffs stored in a pack.
+_NAME_PLACEHOLDERS = ("\0a\0", "\0b\0")
+
+
+class CachedResults(collections.abc.Mapping):
+    """Read-only mapping of path -> UnifiedDiff over a cached run.
+
+    Only the paths are loaded up front. Diffs are loaded when they're accessed,
+    and the most recently used ones are kept in memory.
+    """
+
+    _LRU_SIZE = 4096
+
+    def __init__(self, paths, load_diff):
+        """
+        Args:
+            paths (iterable[str]): paths of every diff in the run.
+            load_diff (callable): loads the UnifiedDiff of a path.
+        """
+        self._paths = frozenset(paths)
+        self._load_diff = functools.lru_cache(maxsize=self._LRU_SIZE)(load_diff)
+
+    def __getitem__(self, path):
+        if path not in self._paths:
+            raise KeyError(path)
+        return self._load_diff(path)
+
+    def __contains__(self, path):
+        return path in self._paths
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __len__(self):
+        return len(self._paths)
 
 
 class DiffCache(object):
 
-    def __init__(self, run_disk_path, run_tree_path, run_process_path=None):
+    def __init__(self, run_disk_path, run_tree_path, run_process_path=None, storage="pack"):
+        """
+        Args:
+            storage (str): "pack" to store diffs in a pack file with an index, or "mirror"
+                to write one file per diff, mirroring the VM's directory tree.
+        """
         self.run_path = pathlib.Path(run_disk_path)
         self.tree_path = pathlib.Path(run_tree_path)
         self.run_process_path = pathlib.Path(str(run_process_path))
         if run_process_path:
             os.makedirs(self.run_process_path, exist_ok=True)
 
+        self.storage = storage
+        # Pack stores by path, opened on first use.
+        self._packs = {}
+        # Index of the diffs' added and removed lines, started by the first results written.
+        self._grep_index = None
+        # Manifest of the mirrored diffs written so far, as results can be cached a batch at a time.
+        self._manifest = {}
+
+    def _get_pack(self, path, writable=False):
+        pack = self._packs.get(path)
+        if pack is not None and (pack.writable or not writable):
+            return pack
+
+        if not writable and not packstore.PackStore.exists(path):
+            return None
+
+        if pack is not None:
+            pack.close()
+        pack = packstore.PackStore(path, writable=writable)
+        self._packs[path] = pack
+        return pack
+
+    def _encode_diff(self, diff):
+        """Encode a diff for the pack store, with the file names in its headers replaced by placeholders.
+
+        Without the names, diffs like "Binary files differ" or the same metadata change
+        to many files have identical bodies, so the pack store only keeps one copy.
+
+        The meta also keeps the diff's hunk index, so windows of it can be served without parsing it,
+        and its statistics, so it can be loaded without reading it (see _load_packed_diff).
+
+        Returns:
+            tuple: (data: bytes, meta: str) where meta is JSON of the replaced names, the hunk index and the stats.
+        """
+        lines = diff.diff_lines
+        names = ["", ""]
+        header_length = 0
+        for line in lines:
+            if line.startswith("@@"):
+                break
+            if line.startswith("--- "):
+                names[0] = line[4:].rstrip("\n")
+            elif line.startswith("+++ "):
+                names[1] = line[4:].rstrip("\n")
+            header_length += 1
+
+        header = "".join(lines[:header_length])
+        body = "".join(lines[header_length:])
+        # Of the lines as they'll be read back, which can be split differently.
+        hunk_index = unified_diff.get_hunk_index(
+            io.StringIO(header + body, newline=None).readlines())
+        if "\0" in header:
+            # Can't tell placeholders from the header's own contents, so store it as is.
+            names = ["", ""]
+
+        for name, placeholder in zip(names, _NAME_PLACEHOLDERS):
+            if name:
+                header = header.replace(name, placeholder)
+
+        return (header + body).encode("utf8"), json.dumps({"names": names, "hunks": hunk_index, "stats": diff.stats()})
+
+    def _pack_items(self, keyed_diffs):
+        for key, diff in keyed_diffs:
+            data, meta = self._encode_diff(diff)
+            flags = packstore.PackStore.FLAG_DIR if diff.is_dir else 0
+            yield key, data, flags, meta
+
+    def _decode_meta(self, meta):
+        meta = json.loads(meta)
+        if isinstance(meta, list):
+            # Packs written before the hunk index only kept the names.
+            return {"names": meta, "hunks": None, "stats": None}
+        # Or before the stats.
+        meta.setdefault("stats", None)
+        return meta
+
+    def _decode_diff_lines(self, data, names):
+        text = data.decode("utf8")
+
+        if text.startswith("@@"):
+            header_end = 0
+        else:
+            header_end = text.find("\n@@") + 1 or len(text)
+
+        header = text[:header_end]
+        # Undo the replacements in reverse order.
+        for name, placeholder in reversed(list(zip(names, _NAME_PLACEHOLDERS))):
+            if name:
+                header = header.replace(placeholder, name)
+        text = header + text[header_end:]
+
+        # Same line splitting (and newline translation) as reading the mirrored text files.
+        return io.StringIO(text, newline=None).readlines()
+
+    def _log_pack_stats(self, pack):
+        stats = pack.stats()
+        logical_mib = stats["logical_bytes"] / 1024 / 1024
+        unique_mib = stats["unique_bytes"] / 1024 / 1024
+        stored_mib = stats["stored_bytes"] / 1024 / 1024
+        dedupe_ratio = stats["logical_bytes"] / (stats["unique_bytes"] or 1)
+        compression_ratio = stats["unique_bytes"] / (stats["stored_bytes"] or 1)
+        logging.info(
+            f"{pack.path}: {stats['entries']} diffs in {stats['blobs']} unique blobs. "
+            f"Dedupe: {logical_mib:.1f}MiB -> {unique_mib:.1f}MiB ({dedupe_ratio:.1f}x), "
+            f"compression: {unique_mib:.1f}MiB -> {stored_mib:.1f}MiB ({compression_ratio:.1f}x)")
+
+    def _index_diffs(self, keyed_diffs):
+        """Add diffs to the grep index as they're written.
+
+        Args:
+            keyed_diffs (iterable): (key, UnifiedDiff), the key being what get_diff_lines takes.
+        """
+        if self._grep_index is None:
+            self._grep_index = grep_index.GrepIndex(self.tree_path, writable=True)
+        for key, diff in keyed_diffs:
+            self._grep_index.add(key, diff.diff_lines)
+            yield key, diff
+
+    def _log_grep_index_stats(self):
+        self._grep_index.flush()
+        stats = self._grep_index.stats()
+        logging.info(
+            f"{self._grep_index.path / grep_index.GrepIndex.FILENAME}: {stats['words']} words in "
+            f"{stats['docs']} diffs, {stats['size'] / 1024 / 1024:.1f}MiB, built in {stats['build_time']:.2f}s")
+
+    def log_stats(self):
+        """Log the sizes of the packs and the grep index written, once every batch of results has been
+        cached (they take a pass over the whole index).
+        """
+        for pack in self._packs.values():
+            if pack.writable:
+                self._log_pack_stats(pack)
+        if self._grep_index is not None and self._grep_index.writable:
+            self._log_grep_index_stats()
+
     def cache_results(self, results):
+        """Write the diffs of all the results"""
+
+        keyed_diffs = self._index_diffs(
+            (str(utils.ensure_posix(path)), diff) for path, diff in results.items())
+
+        if self.storage == "pack":
+            pack = self._get_pack(self.run_path, writable=True)
+            pack.put_many(self._pack_items(keyed_diffs))
+        else:
+            self._cache_results_mirror(keyed_diffs)
+        self._grep_index.flush()
+
+    def _cache_results_mirror(self, keyed_diffs):
         """Create output directory, and write the same filesystem into it as in the results"""
 
         os.makedirs(self.run_path, exist_ok=True)
+        manifest = self._manifest
+        # The entries written (or changed) by this batch, appended to the manifest.
+        changed = {}
         # Sort by path, so we only create parent directories after children.
-        for path, diff in sorted(results.items(), key=lambda tup: tup[0]):
+        for path, diff in sorted(keyed_diffs, key=lambda tup: tup[0]):
 
             path = utils.ensure_posix(path)
+            original_path = str(path)
 
             if diff.is_dir:
                 path = path / pathlib.Path(DIR_META_FILENAME)
@@ -44,8 +252,16 @@ class DiffCache(object):
                 # This means a path has changed from a directory to a file.
                 # Whatever, tho
                 # Limitation: Let's keep it as a directory
-                result_path.parent.rename(
-                    result_path.parent.with_suffix(".__renamed__"))
+                renamed_path = result_path.parent.with_suffix(".__renamed__")
+                result_path.parent.rename(renamed_path)
+
+                # Keep the manifest pointing at the parent's diff.
+                parent_file_path = str(
+                    result_path.parent.relative_to(self.run_path))
+                for entry_path, entry in manifest.items():
+                    if entry[0] == parent_file_path:
+                        entry[0] = str(renamed_path.relative_to(self.run_path))
+                        changed[entry_path] = entry
 
                 result_path.parent.mkdir(parents=True, exist_ok=True)
 
@@ -61,6 +277,63 @@ class DiffCache(object):
             with open(result_path, "w") as f:
                 f.writelines(diff.diff_lines)
 
+            manifest[original_path] = changed[original_path] = [
+                str(result_path.relative_to(self.run_path)), bool(diff.is_dir), diff.stats()]
+
+        self._append_manifest(changed)
+
+    def _append_manifest(self, entries):
+        """Add a line of entries to the manifest, overriding any earlier ones for the same paths.
+
+        Only the batch is written, rather than the whole manifest again, and readers skip a line
+        that's still being written.
+        """
+        with open(self.run_path / MANIFEST_FILENAME, "a") as f:
+            f.write(json.dumps(entries) + "\n")
+
+    def _write_manifest(self, manifest):
+        """Replace the manifest atomically, since a reader may be reading it."""
+        temp_path = self.run_path / f"{MANIFEST_FILENAME}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(json.dumps(manifest) + "\n")
+        os.replace(temp_path, self.run_path / MANIFEST_FILENAME)
+
+    def _read_manifest(self):
+        """Get the index of a mirrored run, building it from the directory tree if the run predates manifests.
+
+        Returns:
+            dict: {path: [relative_file_path: str, is_dir: bool, stats: dict]}, the stats
+                missing from runs cached before them.
+        """
+        try:
+            with open(self.run_path / MANIFEST_FILENAME) as f:
+                manifest = {}
+                # A line of entries per batch of results (or a single one, for runs cached before batches).
+                for line in f:
+                    try:
+                        manifest.update(json.loads(line))
+                    except ValueError:
+                        logging.debug(f"Skipping a partly written line of {self.run_path / MANIFEST_FILENAME}")
+                return manifest
+        except FileNotFoundError:
+            pass
+
+        logging.info(f"No manifest in {self.run_path}, indexing its files")
+        manifest = {}
+        for path, subdirs, files in os.walk(self.run_path):
+            for filename in files:
+                if filename == MANIFEST_FILENAME:
+                    continue
+                is_dir = filename == DIR_META_FILENAME
+                relative_path = pathlib.Path(
+                    path, filename).relative_to(self.run_path)
+                original_path = relative_path.parent if is_dir else relative_path
+                manifest[os.path.join("/", original_path)] = [
+                    str(relative_path), is_dir]
+
+        self._write_manifest(manifest)
+        return manifest
+
     def ensure_posix(self, path):
         if path.startswith("\\"):
             # Force POSIX path so that we can create the directory structure in the Docker container, even if the path is Windows.
@@ -69,7 +342,15 @@ class DiffCache(object):
         return path
 
     def cache_process_results(self, results):
-        for pid, diff in results.items():
+        keyed_diffs = self._index_diffs(results.items())
+
+        if self.storage == "pack":
+            pack = self._get_pack(self.run_process_path, writable=True)
+            pack.put_many(self._pack_items(keyed_diffs))
+            self._grep_index.flush()
+            return
+
+        for pid, diff in keyed_diffs:
 
             filename = pid
 
@@ -78,26 +359,80 @@ class DiffCache(object):
             # Write the diff file.
             with open(result_path, "w") as f:
                 f.writelines(diff.diff_lines)
+        self._grep_index.flush()
+
+    def _read_process_diff(self, pid):
+        """
+        Returns:
+            list[str]: lines of the process's diff, or None.
+        """
+        if self.storage == "pack":
+            pack = self._get_pack(self.run_process_path)
+            entry = pack.get(pid) if pack else None
+            if entry is None:
+                logging.warning(f"Process diff cache not found: {pid}")
+                return None
+            data, _, meta = entry
+            return self._decode_diff_lines(data, self._decode_meta(meta)["names"])
 
-    def get_process_diff_from_cache(self, pid):
         filename = pid
         result_path = self.run_process_path / filename
         try:
             with open(result_path, "r") as f:
-                lines = f.readlines()
-                diff = unified_diff.UnifiedDiff(lines)
-                return diff
+                return f.readlines()
         except FileNotFoundError:
-            print(f"Process diff cache not found: {result_path}")
+            logging.warning(f"Process diff cache not found: {result_path}")
             return None
 
-    def get_diff_from_cache(self, vm_path):
+    def _load_packed_diff(self, pack, key, is_process=False):
+        """A diff from a pack, without reading its lines until they're used (see UnifiedDiff.from_stats).
+
+        Returns:
+            UnifiedDiff: or None if there's no diff for the key, or no stats stored with it (packs
+                written before them).
+        """
+        entry = pack.get_meta(key) if pack else None
+        if entry is None:
+            return None
+        flags, meta = entry
+        stats = self._decode_meta(meta)["stats"]
+        if stats is None:
+            return None
+        # Processes aren't files, so they're neither a directory nor not one.
+        is_dir = None if is_process else bool(flags & packstore.PackStore.FLAG_DIR)
+        return unified_diff.UnifiedDiff.from_stats(stats, lambda: self.get_diff_lines(key), is_dir)
+
+    def get_process_diff_from_cache(self, pid):
+        if self.storage == "pack":
+            diff = self._load_packed_diff(self._get_pack(self.run_process_path), pid, is_process=True)
+            if diff is not None:
+                return diff
+
+        lines = self._read_process_diff(pid)
+        if lines is None:
+            return None
+        return unified_diff.UnifiedDiff(lines)
+
+    def _read_diff(self, vm_path):
+        """
+        Returns:
+            tuple: (lines: list[str], is_dir: bool) of the path's diff, or None.
+        """
 
         if not self.run_path.exists:
             return None
 
         vm_path = utils.ensure_posix(vm_path)
 
+        if self.storage == "pack":
+            pack = self._get_pack(self.run_path)
+            entry = pack.get(str(vm_path)) if pack else None
+            if entry is None:
+                return None
+            data, flags, meta = entry
+            lines = self._decode_diff_lines(data, self._decode_meta(meta)["names"])
+            return lines, bool(flags & packstore.PackStore.FLAG_DIR)
+
         # Slice off the root (and drive on Windows) from the vm path, so it's not an absolute path
         cache_path = self.run_path.joinpath(*vm_path.parts[1:])
         is_dir = False
@@ -110,9 +445,20 @@ class DiffCache(object):
             return None
 
         with open(cache_path) as f:
-            lines = f.readlines()
-            diff = unified_diff.UnifiedDiff(lines, is_dir)
-            return diff
+            return f.readlines(), is_dir
+
+    def get_diff_from_cache(self, vm_path):
+        if self.storage == "pack":
+            diff = self._load_packed_diff(
+                self._get_pack(self.run_path), str(utils.ensure_posix(vm_path)))
+            if diff is not None:
+                return diff
+
+        entry = self._read_diff(vm_path)
+        if entry is None:
+            return None
+        lines, is_dir = entry
+        return unified_diff.UnifiedDiff(lines, is_dir)
 
     def get_diff(self, key):
         # If the key is a process ID (numeric)
@@ -121,55 +467,176 @@ class DiffCache(object):
         else:
             return self.get_diff_from_cache(key)
 
+    def get_diff_lines(self, key):
+        """The lines of a diff as stored, without parsing them into a UnifiedDiff (for serving).
+
+        Returns:
+            list[str]: or None if there's no diff for the key.
+        """
+        if key.isdigit():
+            return self._read_process_diff(key)
+        entry = self._read_diff(key)
+        return entry[0] if entry is not None else None
+
+    def _read_diff_and_index(self, key):
+        """
+        Returns:
+            tuple: (lines: list[str], hunk index: dict) of the key's diff, or None.
+        """
+        hunk_index = None
+        if self.storage == "pack":
+            if key.isdigit():
+                pack = self._get_pack(self.run_process_path)
+            else:
+                pack = self._get_pack(self.run_path)
+                key = str(utils.ensure_posix(key))
+            entry = pack.get(key) if pack else None
+            if entry is None:
+                return None
+            data, _, meta = entry
+            meta = self._decode_meta(meta)
+            lines = self._decode_diff_lines(data, meta["names"])
+            hunk_index = meta["hunks"]
+        else:
+            lines = self.get_diff_lines(key)
+            if lines is None:
+                return None
+
+        if hunk_index is None:
+            # Mirrored diffs (and packs from before the index) only have their lines.
+            hunk_index = unified_diff.get_hunk_index(lines)
+        return lines, hunk_index
+
+    def get_diff_window(self, key, start=0, end=None, by_hunk=False, max_lines=None):
+        """Part of a diff, see unified_diff.get_window.
+
+        Args:
+            start (int): first line (or hunk, if by_hunk) of the window.
+            end (int): line (or hunk) after the window, or None for the end of the diff.
+            max_lines (int): most lines of the diff in the window, or None for no limit.
+
+        Returns:
+            dict: or None if there's no diff for the key.
+        """
+        entry = self._read_diff_and_index(key)
+        if entry is None:
+            return None
+        lines, hunk_index = entry
+
+        if by_hunk:
+            hunks = hunk_index["hunks"]
+            start = hunks[start] if start < len(hunks) else len(lines)
+            end = hunks[end] if end is not None and end < len(hunks) else None
+        if end is None:
+            end = len(lines)
+        return unified_diff.get_window(lines, hunk_index, start, end, max_lines)
+
     def cache_exists(self):
-        return self.run_path.exists() and self.tree_cache_exists()
+        """Whether the run was cached completely, rather than interrupted while it published its results."""
+        if self.storage == "pack" and not packstore.PackStore.exists(self.run_path):
+            return False
+        if not self.run_path.exists() or not self.tree_cache_exists():
+            return False
+        run_progress = progress.read_progress(self.tree_path)
+        # Runs from before progress only wrote their tree once they were done.
+        return run_progress is None or run_progress["done"]
+
+    def clear(self):
+        """Delete whatever an earlier (or interrupted) run cached here, to diff it again."""
+        for pack in self._packs.values():
+            pack.close()
+        self._packs = {}
+        if self._grep_index is not None:
+            self._grep_index.close()
+            self._grep_index = None
+        self._manifest = {}
+
+        shutil.rmtree(self.run_path, ignore_errors=True)
+        shutil.rmtree(self.tree_path, ignore_errors=True)
+        if self.process_cache_exists():
+            shutil.rmtree(self.run_process_path, ignore_errors=True)
+            os.makedirs(self.run_process_path, exist_ok=True)
 
     def process_cache_exists(self):
         return self.run_process_path is not None and self.run_process_path.exists()
 
     def get_cached_results(self):
+        """Open the diffs of a cached run.
+
+        Returns:
+            CachedResults: mapping of path -> UnifiedDiff, reading each diff on access.
+        """
 
         if not self.cache_exists():
             raise RuntimeError(f"Cache path {self.run_path} does not exist!")
 
-        results = {}
+        logging.info(f"Loading from diff cache {self.run_path}")
 
-        logging.info(f"Loading from diff cache {self.run_dir}")
-        for path, subdirs, files in os.walk(self.run_path):
-            for filename in files:
-                is_dir = False
-                if filename == DIR_META_FILENAME:
-                    is_dir = True
-                filepath = os.path.join(path, filename)
-                with open(filepath) as f:
-                    lines = f.readlines()
-                    diff = unified_diff.UnifiedDiff(lines, is_dir)
-                    relative_path = pathlib.Path(
-                        filepath).relative_to(self.run_path)
-                    if is_dir:
-                        # Remove dir suffix if this is a dir
-                        relative_path = relative_path.parent
+        if self.storage == "pack":
+            pack = self._get_pack(self.run_path)
+            return CachedResults(pack.keys(), self.get_diff_from_cache)
 
-                    original_path = os.path.join("/", relative_path)
+        manifest = self._read_manifest()
 
-                    results[original_path] = diff
+        def load_diff(path):
+            relative_file_path, is_dir, *stats = manifest[path]
 
-        return results
+            def load_lines():
+                with open(self.run_path / relative_file_path) as f:
+                    return f.readlines()
+
+            if stats:
+                return unified_diff.UnifiedDiff.from_stats(stats[0], load_lines, is_dir)
+            # Manifests from before the stats.
+            return unified_diff.UnifiedDiff(load_lines(), is_dir)
+
+        return CachedResults(manifest.keys(), load_diff)
+
+    def get_cached_process_results(self):
+        """Open the process diffs of a cached run, as get_cached_results.
+
+        Returns:
+            CachedResults: mapping of PID -> UnifiedDiff, empty if the run didn't diff memory.
+        """
+        if not self.process_cache_exists():
+            return CachedResults((), self.get_process_diff_from_cache)
+        if self.storage == "pack":
+            pack = self._get_pack(self.run_process_path)
+            pids = pack.keys() if pack else ()
+        else:
+            pids = os.listdir(self.run_process_path)
+        return CachedResults(pids, self.get_process_diff_from_cache)
+
+    def index_cached_results(self):
+        """Build the grep index of a run cached before it, from the cached diffs."""
+        for results in (self.get_cached_results(), self.get_cached_process_results()):
+            for _ in self._index_diffs(results.items()):
+                pass
+        self._log_grep_index_stats()
 
     def tree_cache_exists(self):
-        return (self.tree_path / "tree.json").exists()
+        return (self.tree_path / TREE_FILENAME).exists()
+
+    def grep_index_cache_exists(self):
+        return grep_index.GrepIndex.exists(self.tree_path)
 
     def cache_tree(self, tree):
         os.makedirs(self.tree_path, exist_ok=True)
-        with open(self.tree_path / "tree.json", "w") as f:
-            json.dump(tree.get_tree(), f)
-        with open(self.tree_path / "children.json", "w") as f:
-            json.dump(tree.get_children_map(), f)
-
-    def get_tree_data_from_cache(self):
-        with open(self.tree_path / "tree.json", "r") as f:
-            tree = json.load(f)
-        with open(self.tree_path / "children.json", "r") as f:
-            children_map = json.load(f)
-
-        return tree, children_map
+        # The index first, so it's there by the time the tree is.
+        search_index.SearchIndex.build(tree.compact).save(
+            self.tree_path / SEARCH_INDEX_FILENAME)
+        tree.compact.save(self.tree_path / TREE_FILENAME)
+
+    def get_compact_tree_from_cache(self):
+        """Memory map the cached tree, see CompactTree.open."""
+        return compact_tree.CompactTree.open(self.tree_path / TREE_FILENAME)
+
+    def get_search_index_from_cache(self, tree):
+        """Memory map the search index of the cached tree."""
+        return search_index.SearchIndex.open(self.tree_path / SEARCH_INDEX_FILENAME, tree)
+
+    def get_grep_index_from_cache(self):
+        """The index of the diffs' added and removed lines, or None for runs cached before it."""
+        if not grep_index.GrepIndex.exists(self.tree_path):
+            return None
+        return grep_index.GrepIndex(self.tree_path)
@@ -0,0 +1,240 @@
+import logging
+import os
+import stat as statlib
+from concurrent import futures
+from datetime import datetime, timezone
+
+import utils
+
+# Same values as dfvfs' FILE_ENTRY_TYPE_* definitions, so stat diffs match the disk image listers.
+_FILE_ENTRY_TYPES = (
+    (statlib.S_ISREG, "file"),
+    (statlib.S_ISDIR, "directory"),
+    (statlib.S_ISLNK, "link"),
+    (statlib.S_ISCHR, "device"),
+    (statlib.S_ISBLK, "device"),
+    (statlib.S_ISFIFO, "pipe"),
+    (statlib.S_ISSOCK, "socket"),
+)
+
+
+class DirectoryPathSpec(object):
+    """Just enough of a dfvfs path spec for the differ: a location, and something to cache by."""
+
+    def __init__(self, source, location):
+        self.location = location
+        self.comparable = f"type: DIRECTORY, source: {source}, location: {location}\n"
+
+
+class DirectoryTime(object):
+    """A timestamp in nanoseconds, quacking like dfvfs date time values."""
+
+    def __init__(self, timestamp_ns):
+        self.timestamp_ns = timestamp_ns
+
+    def CopyToDateTimeStringISO8601(self):
+        if self.timestamp_ns is None:
+            return None
+        seconds, nanoseconds = divmod(self.timestamp_ns, 1000000000)
+        date_time = datetime.fromtimestamp(seconds, tz=timezone.utc)
+        return f"{date_time:%Y-%m-%dT%H:%M:%S}.{nanoseconds:09d}+00:00"
+
+    def __eq__(self, other):
+        return isinstance(other, DirectoryTime) and self.timestamp_ns == other.timestamp_ns
+
+    def __hash__(self):
+        return hash(self.timestamp_ns)
+
+
+class DirectoryStatAttribute(object):
+
+    def __init__(self, stat_result):
+        self.type = DirectoryFileEntry.get_type(stat_result)
+        self.owner_identifier = stat_result.st_uid
+        self.group_identifier = stat_result.st_gid
+        self.mode = statlib.S_IMODE(stat_result.st_mode)
+        self.size = stat_result.st_size
+
+
+class DirectoryAttribute(object):
+    """An extended attribute, read like the macOS dfvfs attributes."""
+
+    def __init__(self, name, value):
+        self.name = name
+        self._value = value
+
+    def read(self):
+        return self._value
+
+
+class DirectoryFileEntry(object):
+    """A file on the host, with the parts of the dfvfs FileEntry interface the differ uses."""
+
+    def __init__(self, source, location, stat_result):
+        self.source = source
+        self.path_spec = DirectoryPathSpec(source, location)
+        self.name = os.path.basename(location) or location
+        self._stat = stat_result
+        self._attributes = None
+
+    @property
+    def host_path(self):
+        return os.path.join(self.source, self.path_spec.location.lstrip("/"))
+
+    @staticmethod
+    def get_type(stat_result):
+        for is_type, file_entry_type in _FILE_ENTRY_TYPES:
+            if is_type(stat_result.st_mode):
+                return file_entry_type
+        return None
+
+    @property
+    def size(self):
+        return self._stat.st_size
+
+    def IsFile(self):
+        return statlib.S_ISREG(self._stat.st_mode)
+
+    def IsDirectory(self):
+        return statlib.S_ISDIR(self._stat.st_mode)
+
+    def IsLink(self):
+        return statlib.S_ISLNK(self._stat.st_mode)
+
+    def IsDevice(self):
+        return statlib.S_ISCHR(self._stat.st_mode) or statlib.S_ISBLK(self._stat.st_mode)
+
+    def IsPipe(self):
+        return statlib.S_ISFIFO(self._stat.st_mode)
+
+    def IsSocket(self):
+        return statlib.S_ISSOCK(self._stat.st_mode)
+
+    def GetStatAttribute(self):
+        return DirectoryStatAttribute(self._stat)
+
+    def GetFileObject(self):
+        if not self.IsFile():
+            return None
+        return open(self.host_path, "rb")
+
+    @property
+    def access_time(self):
+        return DirectoryTime(self._stat.st_atime_ns)
+
+    @property
+    def added_time(self):
+        return DirectoryTime(None)
+
+    @property
+    def change_time(self):
+        return DirectoryTime(self._stat.st_ctime_ns)
+
+    @property
+    def creation_time(self):
+        birthtime = getattr(self._stat, "st_birthtime", None)
+        return DirectoryTime(None if birthtime is None else int(birthtime * 1000000000))
+
+    @property
+    def modification_time(self):
+        return DirectoryTime(self._stat.st_mtime_ns)
+
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            self._attributes = []
+            if hasattr(os, "listxattr"):
+                try:
+                    for name in os.listxattr(self.host_path, follow_symlinks=False):
+                        value = os.getxattr(
+                            self.host_path, name, follow_symlinks=False)
+                        self._attributes.append(DirectoryAttribute(name, value))
+                except OSError:
+                    pass
+        return self._attributes
+
+    @property
+    def number_of_attributes(self):
+        return len(self.attributes)
+
+    @property
+    def sub_file_entries(self):
+        if not self.IsDirectory():
+            return
+        location = self.path_spec.location.rstrip("/")
+        with os.scandir(self.host_path) as entries:
+            for entry in entries:
+                yield DirectoryFileEntry(
+                    self.source, f"{location}/{entry.name}", entry.stat(follow_symlinks=False))
+
+
+class DirectoryLister(object):
+    """Lists an extracted or mounted snapshot on the host, with the same interface as FileEntryLister.
+
+    Uses os.scandir, and stats the entries of each directory in a batch on a thread
+    pool, which keeps network file systems busy.
+    """
+
+    _STAT_WORKERS = 16
+
+    def __init__(self, source, ignore_dirs=None, allow_dirs=None):
+        if ignore_dirs is None:
+            ignore_dirs = set()
+        if allow_dirs is None:
+            allow_dirs = set(["/"])
+
+        self.allow_dirs = allow_dirs
+        self.ignore_dirs = ignore_dirs
+
+        self.source = os.path.abspath(os.path.expanduser(source))
+        if not os.path.isdir(self.source):
+            raise Exception(f'{source}: Not a directory.')
+
+        self.file_entries = {}
+
+    def _stat(self, dir_entry):
+        try:
+            return dir_entry, dir_entry.stat(follow_symlinks=False)
+        except OSError as e:
+            logging.warning(f"{self.source}: Unable to stat {dir_entry.path}: {e}")
+            return dir_entry, None
+
+    def ListFileEntries(self):
+        """Lists all file entries under the source directory."""
+        root = DirectoryFileEntry(self.source, "/", os.lstat(self.source))
+        self.file_entries["/"] = root
+
+        pending = ["/"]
+        with futures.ThreadPoolExecutor(max_workers=self._STAT_WORKERS) as executor:
+            while pending:
+                location = pending.pop()
+                host_path = os.path.join(self.source, location.lstrip("/"))
+                try:
+                    with os.scandir(host_path) as entries:
+                        dir_entries = list(entries)
+                except OSError as e:
+                    logging.error(
+                        f"{self.source}: Unable to list subdirectories for {location}: {e}")
+                    continue
+
+                parent = location.rstrip("/")
+                for dir_entry, stat_result in executor.map(self._stat, dir_entries):
+                    if stat_result is None:
+                        continue
+
+                    sub_location = f"{parent}/{dir_entry.name}"
+                    if not utils.should_list_dir(sub_location, self.allow_dirs, self.ignore_dirs):
+                        continue
+
+                    self.file_entries[sub_location] = DirectoryFileEntry(
+                        self.source, sub_location, stat_result)
+
+                    if statlib.S_ISDIR(stat_result.st_mode):
+                        pending.append(sub_location)
+
+    def GetFileEntry(self, path):
+        try:
+            stat_result = os.lstat(os.path.join(self.source, path.lstrip("/")))
+        except OSError:
+            return None
+        return DirectoryFileEntry(self.source, path, stat_result)
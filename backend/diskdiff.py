@@ -6,10 +6,14 @@ import logging
 import stat as statlib
 
 import sys
+import time
 import os
 import inspect
 
+import extent_map
+import read_scheduler
 import unified_diff
+import utils
 
 
 # Hacks to import the config from the parent directory.
@@ -45,6 +49,19 @@ class DiskDiffer(object):
     _ATTRIBUTE_ATTRIBUTES = set([
         "name",
     ])
+
+    # What differs between two file entries, whether or not the diff options look at it.
+    _DIFFERS_SIZE = 0x1
+    _DIFFERS_STAT = 0x2
+    _DIFFERS_TIMES = 0x4
+    _DIFFERS_ATTRIBUTES = 0x8
+
+    # Filters that list everything, on both POSIX and Windows file systems.
+    _UNFILTERED = set(["/", "\\"])
+
+    # Seconds between handing the results found so far to diff_all's on_results.
+    _RESULTS_INTERVAL = 10
+
     diff_type = "disk"
 
     def __init__(self, a_file_lister, b_file_lister,
@@ -57,6 +74,9 @@ class DiskDiffer(object):
                  ignore_contents_unchanged=False,
                  show_times=False,
                  only_changed_files=False,
+                 schedule_reads=True,
+                 component_cache=None,
+                 progress=None,
                  **kwargs):
         """
         a: { path: str -> file_entry FileEntry }
@@ -80,6 +100,20 @@ class DiskDiffer(object):
         self.ignore_contents_unchanged = ignore_contents_unchanged
         self.show_times = show_times
         self.only_changed_files = only_changed_files
+        self.schedule_reads = schedule_reads
+        # component_cache.ComponentCache shared by runs on the same images, or None to compute everything.
+        self.component_cache = component_cache
+        # progress.Progress to count the paths listed, compared and diffed in, or None.
+        self.progress = progress
+
+        self.a_read_scheduler = read_scheduler.ReadScheduler(self.get_a_file)
+        self.b_read_scheduler = read_scheduler.ReadScheduler(self.get_b_file)
+
+        # Results of reading file data, keyed by path spec, so each file is only read once.
+        self._binary_cache = {}
+        self._hash_cache = {}
+        # Digests of files that are entirely zeros, by size.
+        self._zero_digests = {}
 
         self.changed_file_paths = set()
 
@@ -124,16 +158,30 @@ class DiskDiffer(object):
             return b_file
         return self.get_a_file(path)
 
-    def diff_all(self):
+    def diff_all(self, on_results=None):
+        """
+        Args:
+            on_results (callable): given the results found so far (since it was last called) every
+                _RESULTS_INTERVAL seconds and at the end, so they can be published while the rest are diffed.
+
+        Returns:
+            dict: diffs by path.
+        """
         # Step 1, find files which are different
         changed_file_paths = self.get_changed_files()
         results = {}
+        new_results = {}
+        published = time.monotonic()
 
-        for path in changed_file_paths:
-            if self._should_ignore(path):
-                continue
+        if self.schedule_reads:
+            changed_file_paths = self._prefetch_in_read_order(
+                changed_file_paths)
 
-            result = self.diff(path)
+        for path in changed_file_paths:
+            # Ignored paths are done with too, as they count towards the total of "diffed".
+            result = None if self._should_ignore(path) else self.diff(path)
+            if self.progress is not None:
+                self.progress.add("diffed")
 
             if result is None:
                 logging.debug(f"Ignoring diffing (no diff): {path}")
@@ -142,9 +190,183 @@ class DiskDiffer(object):
             virtual_path = path
 
             results[virtual_path] = result
+            if self.progress is not None:
+                self.progress.add("changed")
+
+            if on_results is not None:
+                new_results[virtual_path] = result
+                if time.monotonic() - published >= self._RESULTS_INTERVAL:
+                    on_results(new_results)
+                    new_results = {}
+                    published = time.monotonic()
+
+        if self.component_cache is not None:
+            self.component_cache.flush()
+
+        if on_results is not None and new_results:
+            on_results(new_results)
+        if self.progress is not None:
+            self.progress.publish(force=True)
 
         return results
 
+    def _prefetch_in_read_order(self, paths):
+        """Read file headers (and hashes, if binaries are diffed) one image at a time, in physical offset order.
+
+        Paths whose components are all cached don't need reading, and are diffed first.
+
+        Returns:
+            list: paths in the order the contents should be diffed.
+        """
+        cached_paths = []
+        if self.component_cache is not None:
+            cached_paths = sorted(
+                path for path in paths if self._is_fully_cached(path))
+            paths = set(paths).difference(cached_paths)
+
+        a_order = self.a_read_scheduler.order(paths)
+        b_order = self.b_read_scheduler.order(paths)
+
+        for get_file, order in ((self.get_a_file, a_order), (self.get_b_file, b_order)):
+            for path in order:
+                file_entry = get_file(path)
+                if self._is_binary(file_entry) and not self.ignore_binary:
+                    self._hash_file(file_entry)
+
+        # Content reads touch both images; follow the "to" image, which is usually the delta disk.
+        return cached_paths + b_order
+
+    def _is_fully_cached(self, path):
+        names = ["facts"]
+        if self.use_stat:
+            names.append("stat")
+        if self.show_times:
+            names.append("times")
+        if self.use_attributes:
+            names.append("attributes")
+        if self.use_contents:
+            names.append(self._contents_component)
+        # Only their index entries, diff() reads the components themselves.
+        return all(self.component_cache.has(name, path) for name in names)
+
+    @property
+    def _contents_component(self):
+        # Contents diffs depend on whether binaries are diffed (by hash) or skipped.
+        return "contents" if self.ignore_binary else "contents-binary"
+
+    def _get_component(self, path, name, compute):
+        """Get a diff component of a path from the component cache, computing (and caching) it if it's missing.
+
+        Args:
+            path (str): path in both images.
+            name (str): component name, e.g. "stat".
+            compute (callable): computes the component from the path.
+        """
+        if self.component_cache is None:
+            return compute(path)
+
+        value = self.component_cache.get(name, path)
+        if value is None:
+            value = compute(path)
+            self.component_cache.put(name, path, value)
+        return value
+
+    def _get_facts(self, path):
+        """
+        Returns:
+            tuple: (a_facts: dict | None, b_facts: dict | None) everything about the files that
+                filtering and headers depend on, None where the file doesn't exist.
+        """
+        a_facts, b_facts = self._get_component(path, "facts", self._read_facts)
+        return a_facts, b_facts
+
+    def _read_facts(self, path):
+        return [self._read_file_facts(self.get_a_file(path)), self._read_file_facts(self.get_b_file(path))]
+
+    def _read_file_facts(self, file):
+        if file is None:
+            return None
+
+        mode = file.GetStatAttribute().mode
+        return {
+            "is_dir": file.IsDirectory(),
+            "is_file": file.IsFile(),
+            "mode": format(mode, "o") if mode is not None else "<unknown>",
+            "is_binary": self._is_binary(file),
+        }
+
+    def _diff_stat(self, path):
+        return list(difflib.unified_diff(
+            self.get_stat_sequence(
+                self.get_a_file(path)), self.get_stat_sequence(self.get_b_file(path)),
+            **self._make_diff_kwargs(path)
+        ))
+
+    def _diff_times(self, path):
+        return list(difflib.unified_diff(
+            self.get_times_sequence(
+                self.get_a_file(path)), self.get_times_sequence(self.get_b_file(path)),
+            **self._make_diff_kwargs(path)
+        ))
+
+    def _diff_attributes(self, path):
+        return list(difflib.unified_diff(
+            self.get_attribute_sequence(
+                self.get_a_file(path)), self.get_attribute_sequence(self.get_b_file(path)),
+            **self._make_diff_kwargs(path)
+        ))
+
+    def _diff_contents(self, path):
+        a_file = self.get_a_file(path)
+        b_file = self.get_b_file(path)
+        contents_diff = []
+
+        # Don't try and diff files larger than MAX_SIZE
+        if (a_file and a_file.size > self.MAX_SIZE) or (b_file and b_file.size > self.MAX_SIZE):
+            logging.info(f"Generating generic diff: (too big): {path}")
+            size = b_file.size if b_file else a_file.size
+            contents_diff = [
+                f"--- {path}\n",
+                f"+++ {path}\n",
+                "@@ 0,0 +0,0 @@\n",
+                # Note the extra space for Unified Diff format.
+                f" File too large to diff ({size}B)\n"
+            ]
+
+        # We're not ignoring binary if we're here, so treat the files as if they might be binary.
+        # If the file is binary, diff it as binary.
+        elif not self.ignore_binary:
+            files = [a_file, b_file]
+            existing_files = [f for f in files if f is not None]
+            binary_files = [
+                self._is_binary(f) for f in existing_files
+            ]
+
+            # If the files are both binary (or one is None and the other is binary), diff them as binary
+            if all(binary_files):
+                if self._compare_binaries(a_file, b_file):
+                    contents_diff = [
+                        f"--- {path}\n",
+                        f"+++ {path}\n",
+                        "@@ 0,0 +0,0 @@\n",
+                        " Binary files differ\n"
+                    ]
+        else:
+            # If at least one file is not binary, do a real diff.
+            # If only one is binary, just consider it the string "Binary File"
+            a_contents_sequence = self.get_contents_sequence(
+                a_file)
+            b_contents_sequence = self.get_contents_sequence(
+                b_file)
+
+            # If both are nonbinary (😎😎😎) diff them as text
+            contents_diff = list(difflib.unified_diff(
+                a_contents_sequence,
+                b_contents_sequence,
+                **self._make_diff_kwargs(path)))
+
+        return contents_diff
+
     def diff(self, path):
         """
             Returns:
@@ -158,88 +380,35 @@ class DiskDiffer(object):
 
         # Step 2, diff those files
         # (Get diffable attributes, then return diff for each one)
-        a_file = self.get_a_file(path)
-        b_file = self.get_b_file(path)
+        a_facts, b_facts = self._get_facts(path)
 
         stat_diff = times_diff = attribute_diff = contents_diff = []
-        diff_kwargs = self._make_diff_kwargs(path)
 
         if self.use_stat:
-            stat_diff = list(difflib.unified_diff(
-                self.get_stat_sequence(
-                    a_file), self.get_stat_sequence(b_file),
-                **diff_kwargs
-            ))
+            stat_diff = self._get_component(path, "stat", self._diff_stat)
 
         if self.show_times:
-            times_diff = list(difflib.unified_diff(
-                self.get_times_sequence(
-                    a_file), self.get_times_sequence(b_file),
-                **diff_kwargs
-            ))
+            times_diff = self._get_component(path, "times", self._diff_times)
 
         if self.use_attributes:
-            attribute_diff = list(difflib.unified_diff(
-                self.get_attribute_sequence(
-                    a_file), self.get_attribute_sequence(b_file),
-                **diff_kwargs
-            ))
+            attribute_diff = self._get_component(
+                path, "attributes", self._diff_attributes)
 
-        has_contents = a_file is not None and a_file.IsFile(
-        ) or b_file is not None and b_file.IsFile()
+        has_contents = a_facts is not None and a_facts["is_file"] or b_facts is not None and b_facts["is_file"]
 
-        # We're not ignoring binary if we're here, so treat the files as if they might be binary.
         if self.use_contents and has_contents:
-            # Don't try and diff files larger than MAX_SIZE
-            if (a_file and a_file.size > self.MAX_SIZE) or (b_file and b_file.size > self.MAX_SIZE):
-                logging.info(f"Generating generic diff: (too big): {path}")
-                size = b_file.size if b_file else a_file.size
-                contents_diff = [
-                    f"--- {path}\n",
-                    f"+++ {path}\n",
-                    "@@ 0,0 +0,0 @@\n",
-                    # Note the extra space for Unified Diff format.
-                    f" File too large to diff ({size}B)\n"
-                ]
-
-            # If the file is binary, diff it as binary.
-            elif not self.ignore_binary:
-                files = [a_file, b_file]
-                existing_files = [f for f in files if f is not None]
-                binary_files = [
-                    self._is_binary(f) for f in existing_files
-                ]
-
-                # If the files are both binary (or one is None and the other is binary), diff them as binary
-                if all(binary_files):
-                    if self._compare_binaries(a_file, b_file):
-                        contents_diff = [
-                            f"--- {path}\n",
-                            f"+++ {path}\n",
-                            "@@ 0,0 +0,0 @@\n",
-                            " Binary files differ\n"
-                        ]
-            else:
-                # If at least one file is not binary, do a real diff.
-                # If only one is binary, just consider it the string "Binary File"
-                a_contents_sequence = self.get_contents_sequence(
-                    a_file)
-                b_contents_sequence = self.get_contents_sequence(
-                    b_file)
-
-                # If both are nonbinary (😎😎😎) diff them as text
-                contents_diff = list(difflib.unified_diff(
-                    a_contents_sequence,
-                    b_contents_sequence,
-                    **self._make_diff_kwargs(path)))
+            contents_diff = self._get_component(
+                path, self._contents_component, self._diff_contents)
 
         if not any((stat_diff, times_diff, attribute_diff, contents_diff)):
             logging.debug(f"Ignoring (no diff): {path}")
             return None
 
+        is_dir = (b_facts or a_facts)["is_dir"]
+
         # If it's a file, and the contents are unchanged, ignore it.
         # (Don't ignore directories though, because they don't have contents.)
-        if not self.get_file(path).IsDirectory() and not contents_diff and self.ignore_contents_unchanged:
+        if not is_dir and not contents_diff and self.ignore_contents_unchanged:
             return None
 
         merged_diff = self.merge_diffs(
@@ -249,27 +418,16 @@ class DiskDiffer(object):
         init_header = f"diff --git {path} {path}"
 
         added_removed_header = ""
-        if a_file is None:
-            mode = b_file.GetStatAttribute().mode
-            if mode is not None:
-                mode = format(mode, "o")
-            else:
-                mode = "<unknown>"
-            added_removed_header = f"new file mode {mode}"
+        if a_facts is None:
+            added_removed_header = f"new file mode {b_facts['mode']}"
 
-        if b_file is None:
-            mode = a_file.GetStatAttribute().mode
-            if mode is not None:
-                mode = format(mode, "o")
-            else:
-                mode = "<unknown>"
-            added_removed_header = f"deleted file mode {mode}"
+        if b_facts is None:
+            added_removed_header = f"deleted file mode {a_facts['mode']}"
 
         self.add_header(merged_diff, added_removed_header)
         self.add_header(merged_diff, init_header)
 
-        diff = unified_diff.UnifiedDiff(
-            merged_diff, is_dir=self.get_file(path).IsDirectory())
+        diff = unified_diff.UnifiedDiff(merged_diff, is_dir=is_dir)
 
         self.diffs[path] = diff
         return diff
@@ -279,15 +437,14 @@ class DiskDiffer(object):
         if not path:
             return True
 
-        a_file = self.get_a_file(path)
-        b_file = self.get_b_file(path)
+        a_facts, b_facts = self._get_facts(path)
 
-        if self.ignore_directories and (a_file and a_file.IsDirectory() or b_file and b_file.IsDirectory()):
+        if self.ignore_directories and (a_facts and a_facts["is_dir"] or b_facts and b_facts["is_dir"]):
             logging.info(f"Ignoring (directory): {path}")
             return True
 
-        a_is_binary = self._is_binary(a_file)
-        b_is_binary = self._is_binary(b_file)
+        a_is_binary = a_facts is not None and a_facts["is_binary"]
+        b_is_binary = b_facts is not None and b_facts["is_binary"]
 
         # Ignore this file if it is or was binary
         if self.ignore_binary and (a_is_binary or b_is_binary):
@@ -373,50 +530,67 @@ class DiskDiffer(object):
     def equal(self, file1, file2):
         """Compares two file_entry objects"""
 
+        return not self._is_changed(self.get_differences(file1, file2))
+
+    def get_differences(self, file1, file2):
+        """Compares two file_entry objects on everything the diff options can select.
+
+        Returns:
+            int: _DIFFERS_* flags of what differs.
+        """
+        differences = 0
+
         if file1.size != file2.size:
-            return False
+            differences |= self._DIFFERS_SIZE
 
         # Compare stat
-        if self.use_stat and not self._equal_stat(file1, file2):
-            return False
+        if not self._equal_stat(file1, file2):
+            differences |= self._DIFFERS_STAT
 
         # Compare times
-        if self.use_times and not self._equal_times(file1, file2):
-            return False
+        if not self._equal_times(file1, file2):
+            differences |= self._DIFFERS_TIMES
 
         # Compare attributes
-        if self.use_attributes and not self._equal_attributes(file1, file2):
-            return False
+        if not self._equal_attributes(file1, file2):
+            differences |= self._DIFFERS_ATTRIBUTES
 
         # TODO: Optionally diff hashes
 
-        return True
+        return differences
 
     def _is_binary(self, file):
 
         if file is None:
             return False
+
+        cache_key = file.path_spec.comparable
+        if cache_key not in self._binary_cache:
+            self._binary_cache[cache_key] = self._read_is_binary(file)
+        return self._binary_cache[cache_key]
+
+    def _read_is_binary(self, file):
+
         textchars = bytearray({7, 8, 9, 10, 12, 13, 27}
                               | set(range(0x20, 0x100)) - {0x7f})  # noqa
 
-        file_obj = file.GetFileObject()
-        if file_obj is None:
-            return False
-        try:
-            header = file_obj.read(512)
-            file_obj.seek(0)
-
+        with utils.open_file_object(file) as file_obj:
+            if file_obj is None:
+                return False
             try:
-                header.decode("utf8", errors="strict")
-            except UnicodeDecodeError:
+                header = file_obj.read(512)
+                file_obj.seek(0)
+            except OSError:
+                logging.warning(f"Failed to read {file.path_spec.location}")
                 return True
 
-            return bool(header.translate(None, textchars))
-
-        except OSError:
-            logging.warning(f"Failed to read {file.path_spec.location}")
+        try:
+            header.decode("utf8", errors="strict")
+        except UnicodeDecodeError:
             return True
 
+        return bool(header.translate(None, textchars))
+
     def _compare_binaries(self, file1, file2):
 
         return self._hash_file(file1) == self._hash_file(file2)
@@ -433,10 +607,21 @@ class DiskDiffer(object):
         if file_entry is None:
             return None
 
+        cache_key = file_entry.path_spec.comparable
+        if cache_key not in self._hash_cache:
+            self._hash_cache[cache_key] = self._read_hash(file_entry)
+        return self._hash_cache[cache_key]
+
+    def _read_hash(self, file_entry):
+
         if file_entry.IsDevice() or file_entry.IsPipe() or file_entry.IsSocket():
             # Ignore devices, FIFOs/pipes and sockets.
             return None
 
+        layout = extent_map.get_extent_map(file_entry)
+        if layout and layout.is_all_zero() and layout.size in self._zero_digests:
+            return self._zero_digests[layout.size]
+
         hash_context = hashlib.sha256()
 
         try:
@@ -451,17 +636,28 @@ class DiskDiffer(object):
             return None
 
         try:
-            data = file_object.read(self._READ_BUFFER_SIZE)
-            while data:
-                hash_context.update(data)
+            if layout:
+                # Zero ranges are hashed from memory, without reading them from the image.
+                for data in layout.read(file_object, self._READ_BUFFER_SIZE):
+                    hash_context.update(data)
+            else:
                 data = file_object.read(self._READ_BUFFER_SIZE)
+                while data:
+                    hash_context.update(data)
+                    data = file_object.read(self._READ_BUFFER_SIZE)
         except IOError as exception:
             logging.warning((
                 'Unable to read from path specification:\n{0:s}'
                 'with error: {1!s}').format(file_entry.path_spec.location, exception))
             return None
+        finally:
+            utils.close_file_object(file_object)
 
-        return hash_context.hexdigest()
+        digest = hash_context.hexdigest()
+        if layout and layout.is_all_zero():
+            self._zero_digests[layout.size] = digest
+
+        return digest
 
     def get_stat_sequence(self, file):
         if file is None:
@@ -521,12 +717,17 @@ class DiskDiffer(object):
         if not self.ignore_binary and self._is_binary(file):
             return ["<Binary file>\n"]
 
-        file_obj = file.GetFileObject()
+        with utils.open_file_object(file) as file_obj:
+            if file_obj is None:
+                return []
 
-        if file_obj is None:
-            return []
+            layout = extent_map.get_extent_map(file)
+            if layout:
+                data = b"".join(layout.read(file_obj, self._READ_BUFFER_SIZE))
+            else:
+                data = file_obj.read()
 
-        contents = file_obj.read().decode("utf8", "ignore")
+        contents = data.decode("utf8", "ignore")
 
         lines = []
         # Make sure all lines end with newlines, to conform with diff format.
@@ -579,37 +780,36 @@ class DiskDiffer(object):
         if self.changed_file_paths:
             return self.changed_file_paths
 
-        # Otherwise, we need to list the files in A and B first
-        # This is the slowest part.
-        self.a_file_lister.ListFileEntries()
-        self.b_file_lister.ListFileEntries()
+        listing = None
+        if self.component_cache is not None:
+            listing = self._get_cached_listing()
+            if listing is not None and self.progress is not None:
+                # Listed and compared in an earlier run.
+                self.progress.add("listed", listing["num_from"] + listing["num_to"])
+                self.progress.add("compared", listing["num_both"])
 
-        # If path doesn't exist, consider it different
-
-        changed_file_paths = set()
+        if listing is None:
+            listing = self._list_differences()
+            if self.component_cache is not None:
+                self.component_cache.put("listing", "", listing)
+                self.component_cache.flush()
 
-        a_paths_set = set(self.a_file_lister.file_entries.keys())
-        b_paths_set = set(self.b_file_lister.file_entries.keys())
-        self.added_files = b_paths_set - a_paths_set
-        self.deleted_files = a_paths_set - b_paths_set
+        self.added_files = set(listing["added"])
+        self.deleted_files = set(listing["deleted"])
 
+        # If path doesn't exist, consider it different
+        changed_file_paths = set()
         if not self.only_changed_files:
             changed_file_paths = changed_file_paths | self.added_files | self.deleted_files
 
-        # Get all files in A but not B (and vice versa), and consider them different
-        remaining_paths = a_paths_set & b_paths_set
-
-        # These paths are guaranteed to be in both A and B
-        for path in remaining_paths:
-            a_file = self.get_a_file(path)
-            b_file = self.get_b_file(path)
-
-            if not self.equal(a_file, b_file):
+        # Only count the comparisons this run cares about.
+        for path, differences in listing["differences"].items():
+            if self._is_changed(differences):
                 changed_file_paths.add(path)
 
-        logging.info(f"Files (from): {len(a_paths_set)}")
-        logging.info(f"Files (to): {len(b_paths_set)}")
-        logging.info(f"Files (both): {len(remaining_paths)}")
+        logging.info(f"Files (from): {listing['num_from']}")
+        logging.info(f"Files (to): {listing['num_to']}")
+        logging.info(f"Files (both): {listing['num_both']}")
         logging.info(f"Files added: {len(self.added_files)}")
         logging.info(f"Files deleted: {len(self.deleted_files)}")
         logging.info(
@@ -618,5 +818,150 @@ class DiskDiffer(object):
         logging.debug(changed_file_paths)
 
         self.changed_file_paths = changed_file_paths
+        if self.progress is not None:
+            self.progress.set_total("diffed", len(changed_file_paths))
 
         return self.changed_file_paths
+
+    def _list_differences(self):
+        """List both images, and record how the files in both differ, whatever the diff options.
+
+        Returns:
+            dict: added and deleted paths, differences (_DIFFERS_* flags) by path, file counts,
+                and the filters the images were listed with.
+        """
+        # Otherwise, we need to list the files in A and B first
+        # This is the slowest part.
+        for lister in (self.a_file_lister, self.b_file_lister):
+            lister.ListFileEntries()
+            if self.progress is not None:
+                self.progress.add("listed", len(lister.file_entries))
+
+        a_paths_set = set(self.a_file_lister.file_entries.keys())
+        b_paths_set = set(self.b_file_lister.file_entries.keys())
+
+        # Get all files in A but not B (and vice versa), and consider them different
+        remaining_paths = a_paths_set & b_paths_set
+        if self.progress is not None:
+            self.progress.set_total("compared", len(remaining_paths))
+
+        # These paths are guaranteed to be in both A and B
+        differences = {}
+        for path in remaining_paths:
+            path_differences = self.get_differences(
+                self.get_a_file(path), self.get_b_file(path))
+            if path_differences:
+                differences[path] = path_differences
+            if self.progress is not None:
+                self.progress.add("compared")
+
+        return {
+            "filters": self._get_filters(),
+            "added": sorted(b_paths_set - a_paths_set),
+            "deleted": sorted(a_paths_set - b_paths_set),
+            "differences": differences,
+            "num_from": len(a_paths_set),
+            "num_to": len(b_paths_set),
+            "num_both": len(remaining_paths),
+        }
+
+    def _get_filters(self):
+        return {
+            "allow_dirs": sorted(self.a_file_lister.allow_dirs),
+            "ignore_dirs": sorted(self.a_file_lister.ignore_dirs),
+        }
+
+    def _get_cached_listing(self):
+        """Get the cached listing of both images, narrowed down to the current filters.
+
+        Returns:
+            dict: the listing (see _list_differences), or None if there's no listing these filters can be derived from.
+        """
+        listing = self.component_cache.get("listing")
+        if listing is None:
+            return None
+
+        filters = self._get_filters()
+        if listing["filters"] == filters:
+            logging.info("Using cached file listing")
+            return listing
+
+        # Anything listed without filters can be filtered now; anything else has to be listed again.
+        if listing["filters"]["ignore_dirs"] or not self._UNFILTERED.issubset(listing["filters"]["allow_dirs"]):
+            return None
+
+        logging.info(f"Filtering cached file listing with {filters}")
+        allowed = {}
+
+        def is_listed(path):
+            if path in allowed:
+                return allowed[path]
+            separator = "\\" if path.startswith("\\") else "/"
+            # The root is always listed, and anything else if the lister would have descended to it.
+            if path == separator:
+                return True
+            parent = path.rsplit(separator, 1)[0] or separator
+            result = is_listed(parent) and utils.should_list_dir(
+                path, filters["allow_dirs"], filters["ignore_dirs"])
+            allowed[path] = result
+            return result
+
+        added = [path for path in listing["added"] if is_listed(path)]
+        deleted = [path for path in listing["deleted"] if is_listed(path)]
+        return dict(
+            listing,
+            filters=filters,
+            added=added,
+            deleted=deleted,
+            differences={
+                path: differences for path, differences in listing["differences"].items() if is_listed(path)},
+        )
+
+    def _is_changed(self, differences):
+        """Whether the _DIFFERS_* flags of a path count as a change with the current options."""
+        mask = self._DIFFERS_SIZE
+        if self.use_stat:
+            mask |= self._DIFFERS_STAT
+        if self.use_times:
+            mask |= self._DIFFERS_TIMES
+        if self.use_attributes:
+            mask |= self._DIFFERS_ATTRIBUTES
+        return bool(differences & mask)
+
+
+class DiskResults(object):
+    """Diff results of one or more volumes, merged into a single tree rooted by volume identifier.
+
+    Stands in for a DiskDiffer when rendering and caching results diffed in worker processes.
+    """
+    diff_type = "disk"
+
+    def __init__(self, prefix_volumes=False, sinks=None):
+        """
+        Args:
+            sinks (list): objects with an add_results(results) method, given each volume's results as they're added.
+        """
+        self.prefix_volumes = prefix_volumes
+        self.sinks = sinks or []
+        self.diffs = {}
+
+    def add(self, volume_identifier, results):
+        if self.prefix_volumes and volume_identifier:
+            results = {
+                self.volume_path(volume_identifier, path): diff for path, diff in results.items()}
+        self.diffs.update(results)
+
+        for sink in self.sinks:
+            sink.add_results(results)
+
+    @staticmethod
+    def volume_path(volume_identifier, path):
+        """Root a path under its volume identifier, keeping the path's separator style."""
+        separator = "\\" if path.startswith("\\") else "/"
+        volume_root = separator + volume_identifier.replace("/", separator)
+        if path == separator:
+            return volume_root
+        return volume_root + path
+
+    def diff(self, path):
+        return self.diffs.get(path)
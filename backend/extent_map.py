@@ -0,0 +1,176 @@
+import logging
+
+from dfvfs.lib import definitions as dfvfs_definitions
+from dfvfs.lib import errors
+from dfvfs.path import factory
+from dfvfs.volume import gpt_volume_system
+from dfvfs.volume import tsk_volume_system
+
+import vmdk_grains
+
+_VOLUME_SYSTEMS = {
+    dfvfs_definitions.TYPE_INDICATOR_GPT: gpt_volume_system.GPTVolumeSystem,
+    dfvfs_definitions.TYPE_INDICATOR_TSK_PARTITION: tsk_volume_system.TSKVolumeSystem,
+}
+
+# Grain maps by image path, and volume offsets by path spec, since they're shared by every file.
+_grain_maps = {}
+_volume_offsets = {}
+
+
+class ExtentMap(object):
+    """Logical layout of a file's data: which ranges hold data, and which are known to read as zeros.
+
+    Zero ranges come from the file system's sparse runs, and from data runs that
+    only cover grains that aren't allocated anywhere in the VMDK delta chain.
+    """
+
+    _ZEROS = bytes(1024 * 1024)
+
+    def __init__(self, size, ranges):
+        """
+        Args:
+            size (int): file size.
+            ranges (list[tuple[int, int, bool]]): (offset, length, is_zero) covering the file, in order.
+        """
+        self.size = size
+        self.ranges = ranges
+
+    @property
+    def zero_bytes(self):
+        return sum(length for _, length, is_zero in self.ranges if is_zero)
+
+    def is_all_zero(self):
+        return self.zero_bytes == self.size
+
+    def read(self, file_object, buffer_size):
+        """Yield the file's data in chunks, only reading the data ranges from file_object.
+
+        The chunks are exactly what reading the whole file would return.
+        """
+        zeros = memoryview(self._ZEROS)
+        for offset, length, is_zero in self.ranges:
+            if is_zero:
+                while length > 0:
+                    chunk = zeros[:min(length, len(zeros))]
+                    yield chunk
+                    length -= len(chunk)
+                continue
+
+            file_object.seek(offset)
+            while length > 0:
+                data = file_object.read(min(buffer_size, length))
+                if not data:
+                    # The file ended early; a full read would stop here too.
+                    return
+                yield data
+                length -= len(data)
+
+
+def get_extent_map(file_entry):
+    """Build the extent map of a file entry's default data stream.
+
+    Returns:
+        ExtentMap: or None if the file has no zero ranges, or the layout can't be determined.
+    """
+    if file_entry is None or not file_entry.IsFile():
+        return None
+
+    try:
+        extents = file_entry.GetExtents()
+    except (AttributeError, NotImplementedError, errors.BackEndError, OSError):
+        return None
+
+    size = file_entry.size or 0
+    if not extents or not size:
+        return None
+
+    grain_map, volume_offset = _get_grain_map(file_entry.path_spec)
+
+    ranges = []
+    logical_offset = 0
+    for extent in extents:
+        if logical_offset >= size:
+            break
+
+        # The last extent is rounded up to a whole cluster.
+        length = min(extent.size, size - logical_offset)
+
+        if extent.extent_type == dfvfs_definitions.EXTENT_TYPE_SPARSE:
+            is_zero = True
+        elif extent.extent_type == dfvfs_definitions.EXTENT_TYPE_DATA:
+            is_zero = grain_map is not None and grain_map.is_zero(
+                volume_offset + extent.offset, length)
+        else:
+            # Compressed extents don't map to logical offsets one to one.
+            return None
+
+        if ranges and ranges[-1][2] == is_zero:
+            previous_offset, previous_length, _ = ranges.pop()
+            ranges.append((previous_offset, previous_length + length, is_zero))
+        else:
+            ranges.append((logical_offset, length, is_zero))
+        logical_offset += length
+
+    if logical_offset < size:
+        ranges.append((logical_offset, size - logical_offset, False))
+
+    if not any(is_zero for _, _, is_zero in ranges):
+        return None
+
+    return ExtentMap(size, ranges)
+
+
+def _get_grain_map(path_spec):
+    """Find the VMDK image and volume offset underneath a file system path spec.
+
+    Returns:
+        tuple: (vmdk_grains.GrainMap | None, volume_offset: int)
+    """
+    volume_offset = 0
+    parent = path_spec.parent
+    while parent is not None:
+        type_indicator = parent.type_indicator
+
+        if type_indicator in _VOLUME_SYSTEMS:
+            volume_offset = _get_volume_offset(parent)
+            if volume_offset is None:
+                return None, 0
+
+        elif type_indicator == dfvfs_definitions.TYPE_INDICATOR_VMDK:
+            image_path = getattr(parent.parent, "location", None)
+            if not image_path:
+                return None, 0
+            if image_path not in _grain_maps:
+                _grain_maps[image_path] = vmdk_grains.GrainMap.from_image(
+                    image_path)
+            return _grain_maps[image_path], volume_offset
+
+        else:
+            # Volumes that aren't contiguous on the disk (LVM, encrypted volumes...)
+            return None, 0
+
+        parent = parent.parent
+
+    return None, 0
+
+
+def _get_volume_offset(path_spec):
+    if path_spec.comparable in _volume_offsets:
+        return _volume_offsets[path_spec.comparable]
+
+    offset = None
+    location = getattr(path_spec, "location", None)
+    if location:
+        try:
+            volume_system = _VOLUME_SYSTEMS[path_spec.type_indicator]()
+            volume_system.Open(factory.Factory.NewPathSpec(
+                path_spec.type_indicator, location="/", parent=path_spec.parent))
+            volume = volume_system.GetVolumeByIdentifier(location.lstrip("/"))
+            if volume is not None and volume.extents:
+                offset = volume.extents[0].offset
+        except (errors.BackEndError, OSError) as e:
+            logging.debug(f"Unable to get volume offset of {location}: {e}")
+
+    _volume_offsets[path_spec.comparable] = offset
+    return offset
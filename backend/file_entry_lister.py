@@ -1,4 +1,3 @@
-import re
 import logging
 
 
@@ -8,6 +7,25 @@ from dfvfs.lib import errors
 from dfvfs.resolver import resolver
 from dfvfs.path import factory
 
+import utils
+
+
+def get_volume_identifier(base_path_spec):
+    """Identify the volume a base path spec is on, e.g. "p1", or "p2/lvm1" for a logical volume in a partition.
+
+    Returns an empty string if the file system isn't inside a volume system.
+    """
+    locations = []
+    path_spec = base_path_spec.parent
+    while path_spec is not None:
+        if path_spec.type_indicator in dfvfs_definitions.VOLUME_SYSTEM_TYPE_INDICATORS:
+            location = getattr(path_spec, "location", None)
+            if location:
+                locations.insert(0, location.strip("/"))
+        path_spec = path_spec.parent
+
+    return "/".join(locations)
+
 
 class FileEntryLister(volume_scanner.VolumeScanner):
     """File entry lister."""
@@ -17,11 +35,15 @@ class FileEntryLister(volume_scanner.VolumeScanner):
         value: '\\x{0:02x}'.format(value)
         for value in _NON_PRINTABLE_CHARACTERS})
 
-    def __init__(self, source, volume_scanner_options, mediator=None, ignore_dirs=None, allow_dirs=None):
+    def __init__(self, source, volume_scanner_options=None, mediator=None, ignore_dirs=None, allow_dirs=None, base_path_specs=None):
         """Initializes a file entry lister.
 
         Args:
+          source (str): path of the source image.
+          volume_scanner_options (VolumeScannerOptions): options to scan the source with,
+              if base_path_specs isn't given.
           mediator (VolumeScannerMediator): a volume scanner mediator.
+          base_path_specs (list[dfvfs.PathSpec]): already scanned base path specs to list.
         """
         super(FileEntryLister, self).__init__(mediator=mediator)
 
@@ -35,8 +57,10 @@ class FileEntryLister(volume_scanner.VolumeScanner):
 
         self._list_only_files = False
 
-        self.base_path_specs = self.GetBasePathSpecs(
-            source, options=volume_scanner_options)
+        if base_path_specs is None:
+            base_path_specs = self.GetBasePathSpecs(
+                source, options=volume_scanner_options)
+        self.base_path_specs = base_path_specs
 
         self.source = source
 
@@ -44,7 +68,7 @@ class FileEntryLister(volume_scanner.VolumeScanner):
             raise Exception(
                 f'{source}: No supported file system found in source.')
 
-        # TODO: Support multiple base path specs
+        # Paths of different volumes would collide in file_entries, so vmdiff.py creates one lister per volume.
         self.base_path_spec = self.base_path_specs[0]
         self.file_system = resolver.Resolver.OpenFileSystem(
             self.base_path_spec)
@@ -87,16 +111,7 @@ class FileEntryLister(volume_scanner.VolumeScanner):
 
         location = file_entry.path_spec.location
 
-        for allow_dir in self.allow_dirs:
-            if location.startswith(allow_dir) or allow_dir.startswith(location):
-                for ignore_dir in self.ignore_dirs:
-                    # Convert to raw string so backslashes aren't interpreted as escapes.
-                    ignore_dir = repr(ignore_dir).strip("'")
-                    if re.search(ignore_dir, location):
-                        return False
-                return True
-
-        return False
+        return utils.should_list_dir(location, self.allow_dirs, self.ignore_dirs)
 
     def _ListFileEntry(
             self, file_entry):
@@ -151,7 +166,7 @@ class FileEntryLister(volume_scanner.VolumeScanner):
 
         for base_path_spec in self.base_path_specs:
             path_spec = factory.Factory.NewPathSpec(
-                base_path_spec.type_indicator, location=path, parent=self.base_path_spec.parent)
+                base_path_spec.type_indicator, location=path, parent=base_path_spec.parent)
             try:
                 file_entry = resolver.Resolver.OpenFileEntry(path_spec)
                 if file_entry:
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import re
+
+import vmdk_grains
+
+# Blocks sampled evenly across each image file, including the first and last block.
+_SAMPLE_COUNT = 16
+_SAMPLE_SIZE = 4096
+
+_CONTENT_IDS = re.compile(r'^\s*(CID|parentCID)\s*=\s*(\w+)', re.MULTILINE)
+
+
+def get_image_fingerprint(path):
+    """Cheap identifier for the current contents of an image, independent of its filename.
+
+    Built from the size and mtime of the image (and its extent files), the VMDK content
+    IDs, and hashes of a few sampled blocks, so it takes milliseconds even for large
+    images. Directory snapshots are identified by their location, and the path, mode, size
+    and mtime of every entry in them (see _add_directory), as a change anywhere in the tree
+    leaves the top directory's mtime alone; that stats every entry, so it takes time in
+    proportion to the number of files. Either way, the CLI computes it once per run and
+    passes it on (config.FROM_DISK_FINGERPRINT and friends).
+
+    Returns:
+        str: 16 hex digits.
+    """
+    digest = hashlib.sha1()
+
+    if os.path.isdir(path):
+        digest.update(f"{os.path.realpath(path)}\n".encode())
+        _add_directory(digest, path)
+        return digest.hexdigest()[:16]
+
+    _add_file(digest, path)
+
+    if path.lower().endswith(".vmdk"):
+        descriptor = vmdk_grains.read_descriptor(path)
+        for name, content_id in _CONTENT_IDS.findall(descriptor):
+            digest.update(f"{name}={content_id}\n".encode())
+
+        # Split and delta disks keep their data in separate extent files.
+        for extent_path in vmdk_grains.get_extent_paths(path, descriptor):
+            if os.path.exists(extent_path) and not os.path.samefile(extent_path, path):
+                _add_file(digest, extent_path)
+
+    return digest.hexdigest()[:16]
+
+
+def _add_file(digest, path):
+    stat = os.stat(path)
+    digest.update(f"{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+
+    with open(path, "rb") as f:
+        for offset in _get_sample_offsets(stat.st_size):
+            digest.update(os.pread(f.fileno(), _SAMPLE_SIZE, offset))
+
+
+def _add_directory(digest, path):
+    """Stat every entry in a directory tree (without reading any files), in a stable order."""
+    path = os.fspath(path)
+    pending = [""]
+    while pending:
+        relative_path = pending.pop()
+        try:
+            with os.scandir(path + relative_path) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError as e:
+            digest.update(f"{relative_path}:{e.errno}\n".encode())
+            continue
+
+        for entry in entries:
+            entry_path = f"{relative_path}/{entry.name}"
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError as e:
+                digest.update(f"{entry_path}:{e.errno}\n".encode())
+                continue
+            digest.update(f"{entry_path}:{stat.st_mode}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry_path)
+
+
+def _get_sample_offsets(size):
+    if size <= _SAMPLE_COUNT * _SAMPLE_SIZE:
+        # Small enough to read the whole file.
+        return range(0, size, _SAMPLE_SIZE)
+
+    last_offset = size - _SAMPLE_SIZE
+    return [last_offset * sample // (_SAMPLE_COUNT - 1) for sample in range(_SAMPLE_COUNT)]
@@ -0,0 +1,300 @@
+import array
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+
+# Words are what's indexed, lower case.
+_WORD = re.compile(r"[a-z0-9_]+")
+# Longer words are cut to this length in the index.
+_MAX_WORD_LENGTH = 64
+
+# Results (diffs) returned per query, at most.
+MAX_RESULTS = 1000
+# Matching lines returned per diff, at most.
+MAX_MATCHES_PER_DIFF = 20
+# Below this many candidate diffs, look up a word's postings for each of them, instead of reading all of them.
+_INTERSECT_SIZE = 256
+
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+
+
+class GrepIndex(object):
+    """Inverted index from the words of the added and removed lines of a run's diffs to where they are.
+
+    Built while the diffs are written: each word maps to the diffs it's in, with the
+    indices of the lines it's on, so a query only reads the diffs that have all of its
+    words, and only checks those lines.
+    """
+
+    FILENAME = "grep.sqlite"
+
+    # Diffs indexed per transaction.
+    _BATCH_SIZE = 1000
+
+    def __init__(self, path, writable=False):
+        """
+        Args:
+            path (str): directory of the index.
+            writable (bool): start a new index (replacing any existing one) to add diffs to.
+        """
+        self.path = pathlib.Path(path)
+        self.writable = writable
+        self._lock = threading.Lock()
+
+        index_path = self.path / self.FILENAME
+        if writable:
+            os.makedirs(self.path, exist_ok=True)
+            self._db = sqlite3.connect(index_path, check_same_thread=False)
+            self._create_schema()
+        else:
+            self._db = sqlite3.connect(
+                f"{index_path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+
+        self._pending = []
+        self._next_doc = 0
+        # Seconds spent indexing, for the stats.
+        self.build_time = 0.0
+
+    @classmethod
+    def exists(cls, path):
+        return (pathlib.Path(path) / cls.FILENAME).exists()
+
+    def _create_schema(self):
+        with self._db:
+            for table in ("docs", "words", "postings"):
+                self._db.execute(f"DROP TABLE IF EXISTS {table}")
+            self._db.execute(
+                "CREATE TABLE docs (id INTEGER PRIMARY KEY, key TEXT NOT NULL)")
+            # Number of diffs each word is in, to start queries from their rarest word.
+            self._db.execute(
+                "CREATE TABLE words (word TEXT PRIMARY KEY, docs INTEGER NOT NULL) WITHOUT ROWID")
+            self._db.execute(
+                "CREATE TABLE postings (word TEXT NOT NULL, doc INTEGER NOT NULL, lines BLOB NOT NULL, "
+                "PRIMARY KEY (word, doc)) WITHOUT ROWID")
+
+    def add(self, key, diff_lines):
+        """Index the added and removed lines of a diff (written in batches).
+
+        Args:
+            key (str): the key the diff is served by, a path or a PID.
+        """
+        self._pending.append((key, diff_lines))
+        if len(self._pending) >= self._BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        start = time.perf_counter()
+        docs = []
+        postings = {}
+        for key, diff_lines in self._pending:
+            doc = self._next_doc
+            self._next_doc += 1
+            docs.append((doc, key))
+
+            lines = {}
+            for index, line in enumerate(diff_lines):
+                if not line.startswith(("+", "-")) or line.startswith(("+++", "---")):
+                    continue
+                for word in set(_WORD.findall(line[1:].lower())):
+                    lines.setdefault(word[:_MAX_WORD_LENGTH], []).append(index)
+            for word, word_lines in lines.items():
+                postings[(word, doc)] = array.array("I", word_lines).tobytes()
+        self._pending = []
+
+        word_docs = {}
+        for word, _ in postings:
+            word_docs[word] = word_docs.get(word, 0) + 1
+
+        with self._lock, self._db:
+            self._db.executemany("INSERT INTO docs VALUES (?, ?)", docs)
+            self._db.executemany(
+                "INSERT INTO postings VALUES (?, ?, ?)",
+                ((word, doc, lines) for (word, doc), lines in postings.items()))
+            self._db.executemany(
+                "INSERT INTO words VALUES (?, ?) ON CONFLICT (word) DO UPDATE SET docs = docs + excluded.docs",
+                word_docs.items())
+        self.build_time += time.perf_counter() - start
+
+    def stats(self):
+        """
+        Returns:
+            dict: docs, words, postings, size (bytes on disk) and build_time (seconds, of this instance).
+        """
+        with self._lock:
+            docs = self._db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+            words = self._db.execute("SELECT COUNT(*) FROM words").fetchone()[0]
+            postings = self._db.execute(
+                "SELECT COALESCE(SUM(docs), 0) FROM words").fetchone()[0]
+        return {
+            "docs": docs,
+            "words": words,
+            "postings": postings,
+            "size": os.path.getsize(self.path / self.FILENAME),
+            "build_time": self.build_time,
+        }
+
+    def _get_doc_frequency(self, word, prefix):
+        with self._lock:
+            if prefix:
+                return self._db.execute(
+                    "SELECT COALESCE(SUM(docs), 0) FROM words WHERE word >= ? AND word < ?",
+                    (word, _get_prefix_end(word))).fetchone()[0]
+            row = self._db.execute(
+                "SELECT docs FROM words WHERE word = ?", (word,)).fetchone()
+        return row[0] if row else 0
+
+    def _get_postings(self, word, prefix, docs=None):
+        """
+        Args:
+            prefix (bool): match all the words starting with word.
+            docs (iterable[int]): only these docs, or None for all.
+
+        Returns:
+            dict: doc -> set of line indices.
+        """
+        if prefix:
+            query = "SELECT doc, lines FROM postings WHERE word >= ? AND word < ?"
+            args = (word, _get_prefix_end(word))
+        else:
+            query = "SELECT doc, lines FROM postings WHERE word = ?"
+            args = (word,)
+
+        if docs is None or len(docs) > _INTERSECT_SIZE:
+            with self._lock:
+                rows = self._db.execute(query, args).fetchall()
+        else:
+            rows = []
+            with self._lock:
+                for doc in docs:
+                    rows.extend(self._db.execute(
+                        query + " AND doc = ?", args + (doc,)).fetchall())
+
+        postings = {}
+        for doc, lines in rows:
+            if docs is not None and doc not in docs:
+                continue
+            postings.setdefault(doc, set()).update(array.array("I", lines))
+        return postings
+
+    def _get_keys(self, docs):
+        with self._lock:
+            return {doc: self._db.execute("SELECT key FROM docs WHERE id = ?", (doc,)).fetchone()[0]
+                    for doc in docs}
+
+    def search(self, query, get_diff_lines, limit=100):
+        """Find the added or removed lines containing query (case insensitive), starting at a word.
+
+        Only diffs with all of the query's words are read, and only the lines with all of them are checked.
+
+        Args:
+            get_diff_lines (callable): key -> diff lines, e.g. DiffCache.get_diff_lines.
+            limit (int): maximum number of diffs.
+
+        Returns:
+            dict: results ({key, matches: [{line, hunk, oldLine, newLine, text}]} per diff), total
+                (diffs checked that matched) and truncated (whether there were more candidates).
+        """
+        query = query.lower()
+        words = [(match.group(), match.end() == len(query))
+                 for match in _WORD.finditer(query)]
+        if not words:
+            raise ValueError("Search for at least one letter or number")
+
+        # The last word can be the start of a longer word, the others are whole words.
+        terms = [(word[:_MAX_WORD_LENGTH], is_last and len(word) < _MAX_WORD_LENGTH)
+                 for word, is_last in words]
+        terms.sort(key=lambda term: self._get_doc_frequency(*term))
+
+        candidates = self._get_postings(*terms[0])
+        for term in terms[1:]:
+            if not candidates:
+                break
+            postings = self._get_postings(*term, docs=candidates.keys())
+            candidates = {doc: lines & postings[doc]
+                          for doc, lines in candidates.items() if lines & postings.get(doc, set())}
+
+        pattern = re.compile(
+            ("(?<![a-z0-9_])" if query[0].isalnum() or query[0] == "_" else "") + re.escape(query))
+        results = []
+        checked = 0
+        keys = self._get_keys(sorted(candidates)[:max(limit, MAX_RESULTS)])
+        for doc, key in keys.items():
+            if len(results) >= limit:
+                break
+            checked += 1
+            diff_lines = get_diff_lines(key)
+            if diff_lines is None:
+                continue
+            matches = [index for index in sorted(candidates[doc])
+                       if index < len(diff_lines) and pattern.search(diff_lines[index][1:].lower())]
+            if matches:
+                results.append({
+                    "key": key,
+                    "matches": get_locations(diff_lines, matches[:MAX_MATCHES_PER_DIFF]),
+                })
+
+        return {
+            "results": results,
+            "total": len(results),
+            "truncated": checked < len(candidates),
+        }
+
+    def close(self):
+        if self.writable:
+            self.flush()
+        with self._lock:
+            self._db.close()
+
+
+def _get_prefix_end(prefix):
+    """The first word after all the words starting with prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def get_locations(diff_lines, indices):
+    """Where lines of a diff are: their hunk, and their line numbers in the old and new file.
+
+    Args:
+        indices (list[int]): sorted line indices.
+
+    Returns:
+        list[dict]: line (index in the diff), hunk (its header), oldLine, newLine (None if the
+            line isn't in that side), and text.
+    """
+    locations = []
+    hunk = None
+    old_line = new_line = 0
+    wanted = iter(indices)
+    next_index = next(wanted, None)
+    for index, line in enumerate(diff_lines):
+        if next_index is None:
+            break
+
+        header = _HUNK_HEADER.match(line)
+        if header:
+            hunk = line.rstrip("\n")
+            old_line, new_line = int(header.group(1)), int(header.group(2))
+            continue
+
+        if index == next_index:
+            locations.append({
+                "line": index,
+                "hunk": hunk,
+                "oldLine": old_line if not line.startswith("+") else None,
+                "newLine": new_line if not line.startswith("-") else None,
+                "text": line.rstrip("\n"),
+            })
+            next_index = next(wanted, None)
+
+        if hunk is not None:
+            if not line.startswith("+"):
+                old_line += 1
+            if not line.startswith("-"):
+                new_line += 1
+    return locations
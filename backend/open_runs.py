@@ -0,0 +1,212 @@
+import collections
+import logging
+import os
+import pathlib
+import threading
+
+import diffcache
+import progress
+import results_store
+import search_index
+
+
+class OpenRun(object):
+    """A run being served: its cache, and the tree and indexes opened from it on first use.
+
+    The tree is opened again whenever a newer one is written, so a run in progress is served
+    as it's published. Holds a RunLock, so the run isn't evicted while it's open.
+    """
+
+    def __init__(self, results_dir, run_id, storage, create=False):
+        """
+        Args:
+            create (bool): create the run if it doesn't exist yet, see RunLock.acquire.
+
+        Raises:
+            FileNotFoundError: if the run doesn't exist (or was evicted) and create is False.
+        """
+        self.run_id = run_id
+        self.path = pathlib.Path(results_dir) / run_id
+        self.cache = diffcache.DiffCache(
+            self.path / "disk", self.path / "tree", self.path / "memory", storage=storage)
+
+        self._lock = results_store.RunLock(self.path).acquire(create=create)
+        results_store.ResultsStore(results_dir).touch(self.path)
+
+        # The tree opened last, and its version.
+        self._opened = None
+        self._search_index = None
+        self._grep_index = None
+        self._tree_lock = threading.Lock()
+
+    def get_tree_version(self):
+        """Identifies the tree written last, which changes while a run in progress publishes results.
+
+        Returns:
+            str: or "" if there's no tree yet.
+        """
+        try:
+            stat = os.stat(self.cache.tree_path / diffcache.TREE_FILENAME)
+        except FileNotFoundError:
+            return ""
+        return f"{stat.st_ino}-{stat.st_mtime_ns}"
+
+    def get_tree(self):
+        """The tree, opened once it's been written, and again whenever a newer one is.
+
+        Raises:
+            FileNotFoundError: if nothing's been published yet.
+        """
+        return self.get_versioned_tree()[0]
+
+    def get_versioned_tree(self):
+        """
+        Returns:
+            tuple: the tree (see get_tree) and the version it was opened at (see get_tree_version).
+        """
+        version = self.get_tree_version()
+        opened = self._opened
+        if opened is None or version != opened[1]:
+            with self._tree_lock:
+                opened = self._opened
+                if opened is None or version != opened[1]:
+                    opened = self._opened = (self.cache.get_compact_tree_from_cache(), version)
+                    # Built from the tree it was opened with.
+                    self._search_index = None
+                    logging.debug(f"{self.run_id}: {len(opened[0])} nodes")
+        return opened
+
+    def get_search_index(self):
+        tree = self.get_tree()
+        index = self._search_index
+        if index is None or index.tree is not tree:
+            try:
+                index = self.cache.get_search_index_from_cache(tree)
+            except (FileNotFoundError, ValueError) as e:
+                # Runs cached before search was added, or the index of a tree published since this one was opened.
+                logging.info(f"{self.run_id}: No search index cached for this tree ({e}), building it")
+                index = search_index.SearchIndex.build(tree)
+            self._search_index = index
+        return index
+
+    def get_grep_index(self):
+        """
+        Returns:
+            grep_index.GrepIndex: or None for runs cached before it (or before their first results).
+        """
+        if self._grep_index is None:
+            # Not kept while it's missing, as a run in progress writes it with its first results.
+            self._grep_index = self.cache.get_grep_index_from_cache()
+        return self._grep_index
+
+    def get_progress(self):
+        """Progress of the run, see progress.read_progress; runs from before progress are done."""
+        run_progress = progress.read_progress(self.cache.tree_path)
+        if run_progress is None:
+            run_progress = dict.fromkeys(progress.COUNTERS, 0)
+            run_progress.update(totals={}, generation=0, done=True)
+        return run_progress
+
+    def close(self):
+        """Let the run be evicted. Memory maps are left to requests still using them."""
+        self._lock.release()
+
+
+class OpenRuns(object):
+    """The runs in RESULTS_DIR, opened on first use and kept in a bounded LRU.
+
+    Runs are looked up by ID when they're asked for, so runs written after the server
+    started (or while it's running) are served without a restart. Pinned runs are kept
+    open besides those.
+    """
+
+    def __init__(self, results_dir, storage, size):
+        """
+        Args:
+            storage (str): how the runs' diffs are stored, see diffcache.DiffCache.
+            size (int): most runs kept open.
+        """
+        self.results_dir = pathlib.Path(results_dir)
+        self.storage = storage
+        self.size = size
+        self._runs = collections.OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+
+    def pin(self, run_id):
+        """Open a run and keep it open, whether or not it's been written yet (e.g. the server's own run)."""
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+            if run is not None:
+                self._pinned[run_id] = run
+                return run
+
+        run = OpenRun(self.results_dir, run_id, self.storage, create=True)
+        with self._lock:
+            self._pinned[run_id] = run
+        return run
+
+    def is_run_id(self, run_id):
+        """Whether run_id names a run in RESULTS_DIR (and nothing outside of it)."""
+        return (bool(run_id) and run_id == os.path.basename(run_id) and not run_id.startswith(".")
+                and run_id not in results_store.ResultsStore.ARTIFACT_DIRS
+                and (self.results_dir / run_id / "tree").is_dir())
+
+    def get(self, run_id):
+        """
+        Returns:
+            OpenRun: or None if there's no such run.
+        """
+        with self._lock:
+            run = self._pinned.get(run_id) or self._runs.get(run_id)
+            if run is not None:
+                if run_id in self._runs:
+                    self._runs.move_to_end(run_id)
+                return run
+
+        if not self.is_run_id(run_id):
+            return None
+
+        # Opened outside the lock, as it waits for the run while it's being evicted.
+        try:
+            opened = OpenRun(self.results_dir, run_id, self.storage)
+        except FileNotFoundError:
+            return None
+        if not self.is_run_id(run_id):
+            # Evicted before it was locked.
+            opened.close()
+            return None
+
+        with self._lock:
+            run = self._pinned.get(run_id) or self._runs.get(run_id)
+            if run is not None:
+                # Opened by another request meanwhile.
+                opened.close()
+                return run
+            self._runs[run_id] = opened
+            if len(self._runs) > self.size:
+                _, evicted = self._runs.popitem(last=False)
+                logging.debug(f"Closing run {evicted.run_id}")
+                evicted.close()
+            return opened
+
+    def list(self):
+        """Every run in RESULTS_DIR, most recently used first.
+
+        Returns:
+            list[dict]: id, lastAccess (seconds since the epoch), and the run's progress (see OpenRun.get_progress).
+        """
+        store = results_store.ResultsStore(self.results_dir)
+        runs = []
+        for entry in os.scandir(self.results_dir):
+            if not entry.is_dir() or not self.is_run_id(entry.name):
+                continue
+            run_progress = progress.read_progress(pathlib.Path(entry.path) / "tree")
+            runs.append({
+                "id": entry.name,
+                "lastAccess": store.get_last_access(entry.path),
+                "done": run_progress["done"] if run_progress is not None else True,
+                "generation": run_progress["generation"] if run_progress is not None else 0,
+            })
+        runs.sort(key=lambda run: run["lastAccess"], reverse=True)
+        return runs
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import pathlib
+import sqlite3
+import threading
+import zlib
+
+
+class PackStore(object):
+    """Append-only pack file of compressed, content-addressed blobs, with a SQLite index.
+
+    Each key maps to a blob by content hash, so identical blobs are stored once.
+    Reading a blob is one index lookup and one positioned read, instead of a
+    directory walk and an open() per file.
+    """
+
+    DATA_FILENAME = "diffs.pack"
+    INDEX_FILENAME = "index.sqlite"
+
+    # Bumped whenever the index layout changes; stores with another version are rewritten.
+    SCHEMA_VERSION = 2
+
+    FLAG_DIR = 0x1
+
+    CODEC_NONE = 0
+    CODEC_ZLIB = 1
+
+    # Fast rather than small: most diffs are a few KB and highly repetitive anyway.
+    _ZLIB_LEVEL = 1
+    # Not worth compressing blobs smaller than this.
+    _MIN_COMPRESS_SIZE = 128
+
+    def __init__(self, path, writable=False):
+        self.path = pathlib.Path(path)
+        self.writable = writable
+
+        if writable:
+            os.makedirs(self.path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        index_path = self.path / self.INDEX_FILENAME
+        if writable:
+            self._index = sqlite3.connect(index_path, check_same_thread=False)
+            self._create_schema()
+        else:
+            self._index = sqlite3.connect(
+                f"{index_path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+            if self._get_schema_version() != self.SCHEMA_VERSION:
+                raise RuntimeError(
+                    f"{self.path} was written by another version of vmdiff, regenerate it with --no-cache.")
+
+        self._data = open(self.path / self.DATA_FILENAME,
+                          "ab+" if writable else "rb")
+
+    def _get_schema_version(self):
+        return self._index.execute("PRAGMA user_version").fetchone()[0]
+
+    def _create_schema(self):
+        version = self._get_schema_version()
+        if version not in (0, self.SCHEMA_VERSION):
+            # Start over, the old index can't point into the new layout.
+            with self._index:
+                self._index.execute("DROP TABLE IF EXISTS entries")
+                self._index.execute("DROP TABLE IF EXISTS blobs")
+            open(self.path / self.DATA_FILENAME, "wb").close()
+
+        with self._index:
+            self._index.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                "hash TEXT PRIMARY KEY, offset INTEGER NOT NULL, length INTEGER NOT NULL, "
+                "raw_length INTEGER NOT NULL, codec INTEGER NOT NULL)")
+            self._index.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, hash TEXT NOT NULL, flags INTEGER NOT NULL, meta TEXT)")
+            self._index.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    @classmethod
+    def exists(cls, path):
+        return (pathlib.Path(path) / cls.INDEX_FILENAME).exists()
+
+    def _compress(self, data):
+        if len(data) >= self._MIN_COMPRESS_SIZE:
+            compressed = zlib.compress(data, self._ZLIB_LEVEL)
+            if len(compressed) < len(data):
+                return compressed, self.CODEC_ZLIB
+        return data, self.CODEC_NONE
+
+    def _decompress(self, data, codec):
+        if codec == self.CODEC_ZLIB:
+            return zlib.decompress(data)
+        return data
+
+    def put(self, key, data, flags=0, meta=None):
+        self.put_many([(key, data, flags, meta)])
+
+    def put_many(self, items):
+        """Store blobs (once per distinct content) and index them in a single transaction.
+
+        Args:
+            items (iterable[tuple[str, bytes, int, str]]): (key, data, flags, meta), where
+                meta is an opaque string stored with the key.
+        """
+        entries = []
+        blobs = []
+        with self._lock:
+            known_hashes = set()
+            self._data.seek(0, os.SEEK_END)
+            offset = self._data.tell()
+            for key, data, flags, meta in items:
+                blob_hash = hashlib.sha1(data).hexdigest()
+                entries.append((key, blob_hash, flags, meta))
+
+                if blob_hash in known_hashes:
+                    continue
+                known_hashes.add(blob_hash)
+                if self._index.execute(
+                        "SELECT 1 FROM blobs WHERE hash = ?", (blob_hash,)).fetchone():
+                    continue
+
+                stored, codec = self._compress(data)
+                self._data.write(stored)
+                blobs.append((blob_hash, offset, len(stored), len(data), codec))
+                offset += len(stored)
+
+            # Make sure the data is there before the index points at it.
+            self._data.flush()
+            with self._index:
+                self._index.executemany(
+                    "INSERT INTO blobs VALUES (?, ?, ?, ?, ?)", blobs)
+                self._index.executemany(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", entries)
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: (data: bytes, flags: int, meta: str), or None if the key isn't in the store.
+        """
+        with self._lock:
+            row = self._index.execute(
+                "SELECT blobs.offset, blobs.length, blobs.codec, entries.flags, entries.meta "
+                "FROM entries JOIN blobs ON entries.hash = blobs.hash WHERE entries.key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        offset, length, codec, flags, meta = row
+        data = os.pread(self._data.fileno(), length, offset)
+        return self._decompress(data, codec), flags, meta
+
+    def get_meta(self, key):
+        """
+        Returns:
+            tuple: (flags: int, meta: str), without reading any data, or None if the key isn't in the store.
+        """
+        with self._lock:
+            return self._index.execute(
+                "SELECT flags, meta FROM entries WHERE key = ?", (key,)).fetchone()
+
+    def keys(self):
+        with self._lock:
+            return [key for key, in self._index.execute("SELECT key FROM entries")]
+
+    def items_flags(self):
+        """Yield (key, flags) for every entry, without reading any data."""
+        with self._lock:
+            rows = self._index.execute("SELECT key, flags FROM entries").fetchall()
+        yield from rows
+
+    def stats(self):
+        """Storage statistics: how much dedupe and compression saved.
+
+        Returns:
+            dict: entries, blobs, logical_bytes (every entry's data), unique_bytes (each blob's data
+                once) and stored_bytes (after compression).
+        """
+        with self._lock:
+            entries, logical_bytes = self._index.execute(
+                "SELECT COUNT(*), COALESCE(SUM(blobs.raw_length), 0) FROM entries JOIN blobs ON entries.hash = blobs.hash").fetchone()
+            blobs, unique_bytes, stored_bytes = self._index.execute(
+                "SELECT COUNT(*), COALESCE(SUM(raw_length), 0), COALESCE(SUM(length), 0) FROM blobs").fetchone()
+
+        return {
+            "entries": entries,
+            "blobs": blobs,
+            "logical_bytes": logical_bytes,
+            "unique_bytes": unique_bytes,
+            "stored_bytes": stored_bytes,
+        }
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._index.execute(
+                "SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._index.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._data.close()
+            self._index.close()
@@ -0,0 +1,98 @@
+import json
+import os
+import pathlib
+import time
+
+# Paths listed in both images, compared between them, and diffed; and changes found.
+COUNTERS = ("listed", "compared", "diffed", "changed")
+
+
+class Progress(object):
+    """Counters of one part of a run (a volume, the memory diff, the published results), published
+    to a file in the run's progress directory, for the server to show while the run is in progress.
+
+    Each part writes its own file, so parts diffed in other processes don't share any state.
+    Files are replaced atomically, at most every PUBLISH_INTERVAL seconds (besides publish(force=True)).
+    """
+
+    DIRNAME = "progress"
+
+    PUBLISH_INTERVAL = 1.0
+
+    def __init__(self, tree_path, name):
+        """
+        Args:
+            tree_path (str): RUN_TREE_PATH.
+            name (str): what's being counted, unique within the run.
+        """
+        self.path = pathlib.Path(tree_path) / self.DIRNAME / f"{name.replace('/', '_') or 'root'}.json"
+        os.makedirs(self.path.parent, exist_ok=True)
+
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        # How many paths there are to compare and diff, once known.
+        self.totals = {}
+        self.generation = 0
+        self.done = False
+        self._published = 0.0
+        self.publish(force=True)
+
+    def add(self, counter, count=1):
+        self.counters[counter] += count
+        self.publish()
+
+    def set_total(self, counter, total):
+        self.totals[counter] = total
+        self.publish()
+
+    def finish(self):
+        self.done = True
+        self.publish(force=True)
+
+    def publish(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._published < self.PUBLISH_INTERVAL:
+            return
+        self._published = now
+
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "counters": self.counters,
+                "totals": self.totals,
+                "generation": self.generation,
+                "done": self.done,
+            }, f)
+        os.replace(tmp_path, self.path)
+
+
+def read_progress(tree_path):
+    """The progress of a run, summed over its parts.
+
+    Returns:
+        dict: the COUNTERS, totals (of the parts that know them), generation (of the published
+            results) and done (whether every part has finished), or None for runs from before progress.
+    """
+    progress_dir = pathlib.Path(tree_path) / Progress.DIRNAME
+    try:
+        filenames = sorted(os.listdir(progress_dir))
+    except FileNotFoundError:
+        return None
+
+    progress = dict.fromkeys(COUNTERS, 0)
+    progress.update(totals={}, generation=0, done=True)
+    for filename in filenames:
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(progress_dir / filename) as f:
+                part = json.load(f)
+        except (OSError, ValueError):
+            # Removed since it was listed.
+            continue
+        for counter, count in part["counters"].items():
+            progress[counter] += count
+        for counter, total in part["totals"].items():
+            progress["totals"][counter] = progress["totals"].get(counter, 0) + total
+        progress["generation"] = max(progress["generation"], part["generation"])
+        progress["done"] = progress["done"] and part["done"]
+    return progress
@@ -0,0 +1,56 @@
+import logging
+import time
+
+import diff_tree
+import diskdiff
+
+
+class ResultsPublisher(object):
+    """Publishes disk results to the run while it's diffed, so they can be served before it's done.
+
+    A sink for diskdiff.DiskResults: diffs are cached as soon as they're added, and the tree of
+    all the results so far is rewritten every so often, bumping the generation in the run's progress.
+    """
+
+    # Least seconds between trees.
+    TREE_INTERVAL = 30
+    # Also wait this many times as long as the last tree took, so big trees aren't rebuilt all the time.
+    TREE_BACKOFF = 10
+
+    def __init__(self, cache, progress):
+        """
+        Args:
+            cache (diffcache.DiffCache): the run's cache.
+            progress (progress.Progress): the run's part of the progress that holds the tree's generation.
+        """
+        self.cache = cache
+        self.progress = progress
+        self.results = diskdiff.DiskResults()
+        # Publish the first results straight away.
+        self._next_tree = time.monotonic()
+
+    def add_results(self, results):
+        if not results:
+            return
+        self.cache.cache_results(results)
+        self.results.add("", results)
+        if time.monotonic() >= self._next_tree:
+            self.publish_tree()
+
+    def publish_tree(self, tree=None):
+        """Write a tree (by default, of the disk results so far) for the server to pick up.
+
+        Args:
+            tree (diff_tree.DiffTree): e.g. the final tree, merged with the memory results.
+        """
+        start = time.monotonic()
+        if tree is None:
+            tree = diff_tree.DiffTree(self.results)
+        self.cache.cache_tree(tree)
+        self.progress.generation += 1
+        self.progress.publish(force=True)
+
+        elapsed = time.monotonic() - start
+        logging.info(
+            f"Published {len(tree.compact)} nodes (generation {self.progress.generation}) in {elapsed:.2f}s")
+        self._next_tree = time.monotonic() + max(self.TREE_INTERVAL, self.TREE_BACKOFF * elapsed)
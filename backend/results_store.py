@@ -0,0 +1,270 @@
+import fcntl
+import json
+import logging
+import os
+import pathlib
+import shutil
+import time
+
+
+class RunLock(object):
+    """Shared lock on a run, held while the run is being written or served, so it isn't evicted.
+
+    Uses flock on a file in the run, which also works between containers sharing the results volume.
+    """
+
+    def __init__(self, run_path):
+        self.run_path = pathlib.Path(run_path)
+        self._file = None
+
+    def acquire(self, create=True):
+        """
+        Args:
+            create (bool): create the run's directory if it doesn't exist, for runs being written.
+
+        Raises:
+            FileNotFoundError: if the run doesn't exist (or is evicted while waiting for the lock) and create is False.
+        """
+        lock_path = self.run_path / ResultsStore.LOCK_FILENAME
+        while True:
+            if create:
+                os.makedirs(self.run_path, exist_ok=True)
+            self._file = open(lock_path, "a")
+            # Blocks while the run is being evicted.
+            fcntl.flock(self._file, fcntl.LOCK_SH)
+            try:
+                # Eviction deletes the lock file along with the run, so the lock is only on the run if it's still there.
+                if os.path.samestat(os.fstat(self._file.fileno()), os.stat(lock_path)):
+                    return self
+            except FileNotFoundError:
+                pass
+            self.release()
+            if not create:
+                raise FileNotFoundError(f"{self.run_path} was evicted")
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class ResultsStore(object):
+    """Keeps RESULTS_DIR within a byte budget, by evicting the least recently used runs and artifacts.
+
+    Runs are the RUN_PATH directories. Artifacts are the caches runs are built from (memory
+    plugin output, diff components and volume scans); each run records the ones it uses in
+    its run.json. Artifacts that no run uses are evicted first, then runs from least to most
+    recently used, skipping runs that are locked by a RunLock.
+    """
+
+    RUN_FILENAME = "run.json"
+    LOCK_FILENAME = ".lock"
+    ACCESS_FILENAME = ".last_access"
+
+    # Directories of RESULTS_DIR that hold artifacts rather than runs.
+    ARTIFACT_DIRS = ("memory", "components", "volumes")
+
+    # Artifacts written this recently may belong to a run that hasn't registered yet.
+    GRACE_PERIOD = 60 * 60
+
+    def __init__(self, results_dir, budget=0):
+        """
+        Args:
+            results_dir (str): RESULTS_DIR.
+            budget (int): maximum size of the results in bytes, 0 for no limit.
+        """
+        self.results_dir = pathlib.Path(results_dir)
+        self.budget = budget
+
+    def register_run(self, run_path, artifacts):
+        """Record which artifacts a run uses, and mark it as just used.
+
+        Runs register when they start, so their artifacts are kept while they're written (they're
+        locked, so they aren't evicted), and again once they're done, to record their size.
+
+        Args:
+            artifacts (list[str]): artifact paths, absolute or relative to the results directory.
+        """
+        run_path = pathlib.Path(run_path)
+        artifacts = sorted(set(
+            os.path.relpath(artifact, self.results_dir) for artifact in artifacts))
+        with open(run_path / self.RUN_FILENAME, "w") as f:
+            json.dump({"artifacts": artifacts, "size": get_size(run_path)}, f)
+        self.touch(run_path)
+
+    def touch(self, run_path):
+        """Mark a run as just used."""
+        pathlib.Path(run_path, self.ACCESS_FILENAME).touch()
+
+    def _read_run(self, run_path):
+        try:
+            with open(run_path / self.RUN_FILENAME) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get_last_access(self, path):
+        """When a run was last used, in seconds since the epoch."""
+        path = pathlib.Path(path)
+        try:
+            return os.stat(path / self.ACCESS_FILENAME).st_mtime
+        except OSError:
+            return os.stat(path).st_mtime
+
+    def _list_runs(self):
+        """
+        Returns:
+            list[dict]: path, size, last_access and artifacts of every run.
+        """
+        runs = []
+        for entry in os.scandir(self.results_dir):
+            if not entry.is_dir() or entry.name in self.ARTIFACT_DIRS:
+                continue
+            path = pathlib.Path(entry.path)
+            run = self._read_run(path)
+            runs.append({
+                "path": path,
+                "size": run.get("size") or get_size(path),
+                "last_access": self.get_last_access(path),
+                "artifacts": set(run.get("artifacts", [])),
+            })
+        return runs
+
+    def _list_artifacts(self):
+        """
+        Returns:
+            list[dict]: path, name (relative to the results directory), size and last_access of every artifact.
+        """
+        artifacts = []
+        for artifact_dir in self.ARTIFACT_DIRS:
+            try:
+                entries = list(os.scandir(self.results_dir / artifact_dir))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                path = pathlib.Path(entry.path)
+                artifacts.append({
+                    "path": path,
+                    "name": os.path.relpath(path, self.results_dir),
+                    "size": get_size(path),
+                    "last_access": self.get_last_access(path),
+                })
+        return artifacts
+
+    def _evict_run(self, run):
+        """Delete a run, unless it's locked.
+
+        Returns:
+            bool: whether the run was deleted.
+        """
+        try:
+            lock_file = open(run["path"] / self.LOCK_FILENAME, "a")
+        except OSError:
+            return False
+
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info(f"Not evicting {run['path']}: in use")
+                return False
+
+            logging.info(
+                f"Evicting run {run['path']} ({run['size'] / 1024 / 1024:.1f}MiB)")
+            shutil.rmtree(run["path"], ignore_errors=True)
+        return True
+
+    def _evict_artifact(self, artifact):
+        logging.info(
+            f"Evicting {artifact['path']} ({artifact['size'] / 1024 / 1024:.1f}MiB)")
+        if artifact["path"].is_dir():
+            shutil.rmtree(artifact["path"], ignore_errors=True)
+        else:
+            artifact["path"].unlink()
+
+    def collect(self):
+        """Evict unused artifacts, then least recently used runs, until the results fit in the budget.
+
+        Returns:
+            int: bytes freed.
+        """
+        if not self.budget or not self.results_dir.exists():
+            return 0
+
+        runs = self._list_runs()
+        artifacts = self._list_artifacts()
+        total = sum(run["size"] for run in runs) + \
+            sum(artifact["size"] for artifact in artifacts)
+
+        logging.info(
+            f"Results: {total / 1024 / 1024:.1f}MiB in {len(runs)} runs, budget {self.budget / 1024 / 1024:.1f}MiB")
+        if total <= self.budget:
+            return 0
+
+        now = time.time()
+        freed = 0
+        remaining_runs = sorted(runs, key=lambda run: run["last_access"])
+        remaining_artifacts = sorted(
+            artifacts, key=lambda artifact: artifact["last_access"])
+
+        while total - freed > self.budget:
+            used = set().union(*(run["artifacts"] for run in remaining_runs))
+            orphans = [
+                artifact for artifact in remaining_artifacts
+                if artifact["name"] not in used and now - artifact["last_access"] > self.GRACE_PERIOD]
+
+            if orphans:
+                artifact = orphans[0]
+                self._evict_artifact(artifact)
+                remaining_artifacts.remove(artifact)
+                freed += artifact["size"]
+                continue
+
+            evicted = False
+            for run in remaining_runs:
+                if self._evict_run(run):
+                    remaining_runs.remove(run)
+                    freed += run["size"]
+                    evicted = True
+                    break
+
+            if not evicted:
+                logging.warning(
+                    f"Results are {(total - freed) / 1024 / 1024:.1f}MiB, over budget, but everything left is in use.")
+                break
+
+        logging.info(f"Freed {freed / 1024 / 1024:.1f}MiB")
+        return freed
+
+
+def get_size(path):
+    """Total size of the files under path (or of path, if it's a file)."""
+    path = str(path)
+    if not os.path.isdir(path):
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return 0
+
+    size = 0
+    pending = [path]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                else:
+                    size += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+    return size
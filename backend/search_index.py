@@ -0,0 +1,494 @@
+import array
+import bisect
+import re
+
+import compact_tree
+
+SEARCH_MODES = ("substring", "glob", "regex")
+
+_MAGIC = b"VMDSRCH\0"
+
+# Matches collected (and ranked) per query, at most.
+MAX_MATCHES = 10000
+# Above this many candidates, narrow them down by intersecting posting lists before checking them.
+_INTERSECT_SIZE = 4096
+
+# Regex characters that end a literal run; the quantifiers also make the previous character optional.
+_REGEX_SPECIAL = ".^$()[]{}|\\"
+_REGEX_QUANTIFIERS = "*?{"
+# Constructs that look outside of a match, so they can't be searched for in the texts blob.
+_REGEX_CONTEXT = ("(?=", "(?!", "(?<", "\\A", "\\Z")
+# Characters re.IGNORECASE also matches to "i" and "s", which lower() leaves as they are.
+_FOLDS = str.maketrans({"\u0131": "i", "\u017f": "s"})
+
+
+class SearchIndex(object):
+    """Search over the paths of the changed files (and the titles of the changed processes) of a tree.
+
+    Rather than indexing every full path, which repeats each directory once per file,
+    it indexes the trigrams of the distinct node names. A substring of one name matches
+    the whole subtree of every node with that name, which in the tree's preorder is a
+    contiguous range of entries. Queries spanning several names (with a "/") use the
+    longest name-sized piece to find candidates, which are then checked against the
+    full path. Entries are the changed nodes, in preorder.
+    """
+
+    def __init__(self, tree, sections):
+        """
+        Args:
+            tree (compact_tree.CompactTree): the tree the index was built from.
+            sections (dict): name -> array (or memoryview), see build.
+        """
+        self.tree = tree
+        self.sections = sections
+        self.entries = sections["entries"]
+        self.texts = compact_tree.StringTable(
+            sections["text_offsets"], sections["text_blob"])
+        self.names = compact_tree.StringTable(
+            sections["name_offsets"], sections["name_blob"])
+        self.trigrams = sections["trigrams"]
+        # The texts blob decoded, and the offsets of the texts in it, for scans.
+        self._decoded = None
+
+    @classmethod
+    def build(cls, tree):
+        """
+        Args:
+            tree (compact_tree.CompactTree)
+        """
+        num_nodes = len(tree)
+
+        # Lower case names, deduplicated, and the nodes with each of them.
+        name_ids = {}
+        node_names = array.array("I", bytes(4 * num_nodes))
+        title_names = {}
+        for node in range(num_nodes):
+            title_id = tree.title_id[node]
+            name_id = title_names.get(title_id)
+            if name_id is None:
+                name = _fold(tree.titles[title_id])
+                name_id = title_names[title_id] = name_ids.setdefault(
+                    name, len(name_ids))
+            node_names[node] = name_id
+        name_nodes, name_node_offsets = _group(node_names, len(name_ids))
+
+        # Trigrams of the names.
+        postings = {}
+        for name, name_id in name_ids.items():
+            for trigram in _get_trigrams(name.encode("utf8")):
+                posting = postings.get(trigram)
+                if posting is None:
+                    posting = postings[trigram] = array.array("I")
+                posting.append(name_id)
+        trigrams = array.array("I", sorted(postings))
+        posting_offsets = array.array("Q", [0])
+        all_postings = array.array("I")
+        for trigram in trigrams:
+            all_postings.extend(postings[trigram])
+            posting_offsets.append(len(all_postings))
+
+        # Changed nodes in preorder, and the range of entries under each node.
+        entries = array.array("I")
+        texts = []
+        entry_start = array.array("I", bytes(4 * num_nodes))
+        entry_end = array.array("I", bytes(4 * num_nodes))
+        pending = [(root, False) for root in reversed(tree.roots)]
+        while pending:
+            node, done = pending.pop()
+            if done:
+                entry_end[node] = len(entries)
+                continue
+
+            entry_start[node] = len(entries)
+            # Roots are "/" and "Processes", not results.
+            if tree.status[node] != compact_tree.STATUS_CODES["unchanged"] and tree.parent[node] != compact_tree.NO_PARENT:
+                entries.append(node)
+                # Separated, so the texts can be scanned as one blob.
+                texts.append(cls._get_node_text(tree, node) + "\n")
+
+            if tree.is_dir[node] == compact_tree.DIR_TRUE:
+                pending.append((node, True))
+            else:
+                # Only directory names are part of their children's paths (not process titles).
+                entry_end[node] = len(entries)
+            pending.extend((child, False)
+                           for child in reversed(tree.get_children(node)))
+
+        # Number of entries under the nodes with each name, to pick the rarest part of a query.
+        name_entries = array.array("Q", bytes(8 * len(name_ids)))
+        for node in range(num_nodes):
+            name_entries[node_names[node]] += entry_end[node] - entry_start[node]
+
+        names = compact_tree.StringTable.from_strings(name_ids)
+        text_table = compact_tree.StringTable.from_strings(texts)
+        return cls(tree, {
+            "entries": entries,
+            "entry_start": entry_start,
+            "entry_end": entry_end,
+            "text_offsets": text_table.offsets,
+            "text_blob": text_table.blob,
+            "name_offsets": names.offsets,
+            "name_blob": names.blob,
+            "name_nodes": name_nodes,
+            "name_node_offsets": name_node_offsets,
+            "name_entries": name_entries,
+            "trigrams": trigrams,
+            "posting_offsets": posting_offsets,
+            "postings": all_postings,
+        })
+
+    @staticmethod
+    def _get_node_text(tree, node):
+        """What a node's entry is matched against: the path of files, the title of processes."""
+        if tree.is_dir[node] == compact_tree.DIR_NONE:
+            return _fold(tree.get_title(node))
+        return _fold(tree.get_key(node))
+
+    _TYPECODES = {
+        "entries": "I",
+        "entry_start": "I",
+        "entry_end": "I",
+        "text_offsets": "Q",
+        "name_offsets": "Q",
+        "name_nodes": "I",
+        "name_node_offsets": "Q",
+        "name_entries": "Q",
+        "trigrams": "I",
+        "posting_offsets": "Q",
+        "postings": "I",
+    }
+
+    def save(self, path):
+        compact_tree.write_sections(
+            path, _MAGIC, len(self.entries), list(self.sections.items()))
+
+    @classmethod
+    def open(cls, path, tree):
+        """Memory map a saved index of tree.
+
+        Raises:
+            ValueError: if it's the index of another tree, e.g. a newer one published while the run is in progress.
+        """
+        _, sections = compact_tree.read_sections(
+            compact_tree.map_file(path), _MAGIC, cls._TYPECODES)
+        if len(sections["entry_start"]) != len(tree):
+            raise ValueError(f"{path} is the index of another tree")
+        return cls(tree, sections)
+
+    def _get_posting(self, trigram):
+        position = bisect.bisect_left(self.trigrams, trigram)
+        if position == len(self.trigrams) or self.trigrams[position] != trigram:
+            return ()
+        offsets = self.sections["posting_offsets"]
+        return self.sections["postings"][offsets[position]:offsets[position + 1]]
+
+    def _find_names(self, piece):
+        """
+        Returns:
+            list[int]: ids of the names containing piece (at least 3 bytes long).
+        """
+        postings = sorted((self._get_posting(trigram)
+                          for trigram in _get_trigrams(piece.encode("utf8"))), key=len)
+        candidates = postings[0]
+        if len(candidates) > _INTERSECT_SIZE:
+            candidates = set(candidates)
+            for posting in postings[1:]:
+                if len(candidates) <= _INTERSECT_SIZE:
+                    break
+                candidates.intersection_update(posting)
+        return sorted(name_id for name_id in candidates if piece in self.names[name_id])
+
+    def _iter_literal_candidates(self, literals):
+        """Yield entries that may contain all the literals, and whether they certainly do.
+
+        A literal within one name matches everything under the nodes with that name. The
+        candidates are the entries under the piece (between "/"s) of the literals with the
+        fewest entries under it.
+
+        Returns None if the index can't help (no piece of at least 3 bytes), so every entry has to be checked.
+        """
+        name_entries = self.sections["name_entries"]
+        best = None
+        for literal in literals:
+            for piece in literal.split("/"):
+                if len(piece.encode("utf8")) < 3:
+                    continue
+                name_ids = self._find_names(piece)
+                num_entries = sum(name_entries[name_id] for name_id in name_ids)
+                if best is None or num_entries < best[0]:
+                    certain = len(literals) == 1 and "/" not in literal
+                    best = (num_entries, name_ids, certain)
+
+        if best is None:
+            return None
+        _, name_ids, certain = best
+        return ((entry, certain) for entry in self._iter_name_entries(name_ids))
+
+    def _iter_name_entries(self, name_ids):
+        """Yield the entries at or under the nodes with the names."""
+        offsets = self.sections["name_node_offsets"]
+        name_nodes = self.sections["name_nodes"]
+        entry_start = self.sections["entry_start"]
+        entry_end = self.sections["entry_end"]
+        for name_id in name_ids:
+            for node in name_nodes[offsets[name_id]:offsets[name_id + 1]]:
+                yield from range(entry_start[node], entry_end[node])
+
+    def _iter_named_entries(self, name_ids):
+        """Yield the entries of the nodes with the names (not the rest of their subtrees)."""
+        offsets = self.sections["name_node_offsets"]
+        name_nodes = self.sections["name_nodes"]
+        entry_start = self.sections["entry_start"]
+        entry_end = self.sections["entry_end"]
+        for name_id in name_ids:
+            for node in name_nodes[offsets[name_id]:offsets[name_id + 1]]:
+                entry = entry_start[node]
+                if entry < entry_end[node] and self.entries[entry] == node:
+                    yield entry
+
+    def _find_matching_names(self, literals, pattern):
+        """
+        Returns:
+            list[int]: ids of the names that fully match pattern, which contains the literals.
+        """
+        pieces = [literal for literal in literals if len(literal.encode("utf8")) >= 3]
+        if pieces:
+            name_ids = self._find_names(max(pieces, key=len))
+        else:
+            name_ids = range(len(self.names))
+        return [name_id for name_id in name_ids if pattern.fullmatch(self.names[name_id])]
+
+    def _get_text(self, entry):
+        return self.texts[entry][:-1]
+
+    def _get_decoded(self):
+        """
+        Returns:
+            tuple: the texts blob as a str, and the offset of each text in it (the byte offsets, if it's ASCII).
+        """
+        if self._decoded is None:
+            blob = bytes(self.texts.blob).decode("utf8")
+            offsets = self.texts.offsets
+            if len(blob) != len(self.texts.blob):
+                offsets = array.array("Q", [0])
+                for entry in range(len(self.texts)):
+                    offsets.append(offsets[-1] + len(self.texts[entry]))
+            self._decoded = (blob, offsets)
+        return self._decoded
+
+    def _scan(self, blob_pattern, matches):
+        """Yield the entries whose text matches, checking every entry.
+
+        Args:
+            blob_pattern (re.Pattern): pattern finding (at least) the matching entries in the
+                decoded texts blob, where each text ends with a newline; None to check each entry.
+            matches (callable): whether the text of an entry matches.
+        """
+        if blob_pattern is None:
+            yield from (entry for entry in range(len(self.entries)) if matches(self._get_text(entry)))
+            return
+
+        blob, offsets = self._get_decoded()
+        position = 0
+        while True:
+            match = blob_pattern.search(blob, position)
+            if match is None:
+                return
+            entry = bisect.bisect_right(offsets, match.start()) - 1
+            if entry >= len(self.entries):
+                return
+            if matches(self._get_text(entry)):
+                yield entry
+            position = offsets[entry + 1]
+
+    def search(self, query, mode="substring", limit=100):
+        """
+        Args:
+            query (str): case insensitive. Windows paths may use "\\" (except in regexes, which match "/").
+            mode (str): "substring", "glob" (matching whole paths, or just file names) or "regex".
+            limit (int): maximum number of results.
+
+        Returns:
+            dict: results (node JSON, best first), total (matches found) and truncated
+                (whether there were more than MAX_MATCHES, which were neither counted nor ranked).
+        """
+        if not query:
+            return {"results": [], "total": 0, "truncated": False}
+
+        if mode == "substring":
+            query = _fold(query).replace("\\", "/")
+            literals = [query]
+            blob_pattern = re.compile(re.escape(query))
+
+            def matches(text):
+                return query in text
+        elif mode == "glob":
+            query = _fold(query).replace("\\", "/")
+            regex = _glob_to_regex(query)
+            pattern = re.compile(regex, re.DOTALL)
+            literals = re.split(r"\*|\?|\[[^\]]*\]?", query)
+            # The whole text, or what follows any "/".
+            blob_pattern = re.compile(f"(?:^|/){regex}$", re.MULTILINE)
+
+            def matches(text):
+                return bool(pattern.fullmatch(text) or pattern.fullmatch(text.rpartition("/")[2]))
+        elif mode == "regex":
+            pattern = re.compile(query, re.IGNORECASE)
+            # Only their ASCII runs: re.IGNORECASE matches some other characters that lower() doesn't.
+            literals = [_fold(literal) for run in _get_regex_literals(query)
+                        for literal in re.split(r"[^\x00-\x7f]+", run) if literal]
+            blob_pattern = None
+            if not any(context in query for context in _REGEX_CONTEXT):
+                blob_pattern = re.compile(query, re.IGNORECASE | re.MULTILINE)
+
+            def matches(text):
+                return pattern.search(text) is not None
+        else:
+            raise ValueError(
+                f"Unknown search mode {mode}, expected one of {SEARCH_MODES}")
+
+        if mode == "glob" and "/" not in query and query[0] not in "*?[":
+            # Paths start with "/", so this can only match names: check the distinct names instead of the paths.
+            found = self._iter_named_entries(
+                self._find_matching_names(literals, pattern))
+        else:
+            candidates = self._iter_literal_candidates(literals)
+            if candidates is None:
+                found = self._scan(blob_pattern, matches)
+            else:
+                found = (entry for entry, certain in candidates
+                         if certain and mode == "substring" or matches(self._get_text(entry)))
+
+        matched = set()
+        for entry in found:
+            matched.add(entry)
+            if len(matched) > MAX_MATCHES:
+                break
+        truncated = len(matched) > MAX_MATCHES
+
+        ranked = sorted(matched, key=lambda entry: self._rank(
+            self._get_text(entry), query if mode == "substring" else None))
+        return {
+            "results": [self.tree.node_json(self.entries[entry]) for entry in ranked[:limit]],
+            "total": min(len(matched), MAX_MATCHES),
+            "truncated": truncated,
+        }
+
+    @staticmethod
+    def _rank(text, substring):
+        """Sort key: matches in the file name first, then names starting with the query, then short paths."""
+        name = text.rpartition("/")[2]
+        if substring is None:
+            return (0, 0, len(text), text)
+        return (substring not in name, not name.startswith(substring), len(text), text)
+
+
+def _fold(text):
+    """Lower case text as it's indexed and searched, see _FOLDS."""
+    return text.lower().translate(_FOLDS)
+
+
+def _get_trigrams(data):
+    """
+    Args:
+        data (bytes)
+
+    Returns:
+        set[int]: the distinct 3-byte sequences of data, as integers.
+    """
+    return set(int.from_bytes(data[i:i + 3], "big") for i in range(len(data) - 2))
+
+
+def _group(values, num_groups):
+    """Group indices by value.
+
+    Returns:
+        tuple: (indices ordered by value, offsets of each value's indices)
+    """
+    counts = array.array("Q", bytes(8 * (num_groups + 1)))
+    for value in values:
+        counts[value + 1] += 1
+    for group in range(num_groups):
+        counts[group + 1] += counts[group]
+
+    positions = array.array("Q", counts)
+    grouped = array.array("I", bytes(4 * len(values)))
+    for index, value in enumerate(values):
+        grouped[positions[value]] = index
+        positions[value] += 1
+    return grouped, counts
+
+
+def _glob_to_regex(glob):
+    """A glob as a regex, where * and ? match any characters including "/"."""
+    parts = []
+    position = 0
+    while position < len(glob):
+        char = glob[position]
+        position += 1
+        if char == "*":
+            parts.append(".*")
+        elif char == "?":
+            parts.append(".")
+        elif char == "[":
+            end = glob.find("]", position + 1)
+            if end == -1:
+                parts.append(re.escape(char))
+                continue
+            contents = glob[position:end]
+            if contents.startswith("!"):
+                contents = "^" + contents[1:]
+            parts.append(f"[{contents}]")
+            position = end + 1
+        else:
+            parts.append(re.escape(char))
+    return "".join(parts)
+
+
+def _get_regex_literals(pattern):
+    """Runs of literal characters every match of a regex must contain (none if unsure).
+
+    Conservative: only characters outside groups and classes, not followed by an optional quantifier.
+    """
+    if "|" in pattern:
+        return []
+
+    runs = [""]
+    depth = 0
+    position = 0
+    while position < len(pattern):
+        char = pattern[position]
+        position += 1
+        if char == "\\" and position < len(pattern):
+            escaped = pattern[position]
+            position += 1
+            if escaped.isalnum() or depth:
+                # A character class like \d, or a reference.
+                runs.append("")
+            else:
+                runs[-1] += escaped
+        elif char == "[":
+            # Skip the class, including a leading "]" or "^]".
+            end = pattern.find("]", position + 2 if pattern[position:position + 2] == "^]" else position + 1)
+            position = len(pattern) if end == -1 else end + 1
+            runs.append("")
+        elif char == "(":
+            depth += 1
+            runs.append("")
+        elif char == ")":
+            depth = max(0, depth - 1)
+            runs.append("")
+        elif depth:
+            continue
+        elif char in _REGEX_QUANTIFIERS:
+            # The previous character may not be there at all.
+            runs[-1] = runs[-1][:-1]
+            if char == "{":
+                end = pattern.find("}", position)
+                position = len(pattern) if end == -1 else end + 1
+            runs.append("")
+        elif char == "+" or char in _REGEX_SPECIAL:
+            runs.append("")
+        else:
+            runs[-1] += char
+    return [run for run in runs if run]
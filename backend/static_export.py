@@ -0,0 +1,212 @@
+import collections
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import threading
+from concurrent import futures
+
+import compact_tree
+import utils
+
+
+class StaticExport(object):
+    """Writes the API data of the static site (tree/json) as results come out of the diff pipeline.
+
+    Diffs are written when they're produced, and children lists when the tree is built,
+    so nothing is read back from the cache. Files are named by the SHA-1 of their key,
+    and written on a thread pool.
+    """
+
+    _WRITE_WORKERS = 8
+    # Writes queued at most, so the data waiting to be written doesn't pile up in memory.
+    _MAX_PENDING = 64
+
+    def __init__(self, dump_dir):
+        self.dump_dir = pathlib.Path(dump_dir)
+
+        logging.info(f"Dumping API data to {self.dump_dir}")
+        os.makedirs(self.dump_dir, exist_ok=True)
+
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=self._WRITE_WORKERS)
+        self._pending = collections.deque()
+        self._kind_dirs = set()
+
+    @staticmethod
+    def get_filename(key):
+        # Make sure to also encode the "/" character.
+        return hashlib.sha1(key.encode("utf8")).hexdigest()
+
+    def _write_json(self, path, data):
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    def _submit(self, function, *args):
+        """Write on the thread pool, once fewer than _MAX_PENDING writes are queued."""
+        pending = self._pending
+        while pending and (pending[0].done() or len(pending) >= self._MAX_PENDING):
+            # Raises the write's error, if it failed.
+            pending.popleft().result()
+        pending.append(self._executor.submit(function, *args))
+
+    def _add(self, kind, key, data):
+        """Export the data of one node.
+
+        Args:
+            kind (str): "children", "subtree" or "diff".
+        """
+        kind_dir = self.dump_dir / kind
+        if kind not in self._kind_dirs:
+            os.makedirs(kind_dir, exist_ok=True)
+            self._kind_dirs.add(kind)
+        self._submit(self._write_json, kind_dir /
+                     self.get_filename(key), data)
+
+    def add_results(self, results):
+        """Write the diffs of results (path or PID -> UnifiedDiff), keyed like the tree nodes, as
+        {lines, stats}, stats being the whole diff's statistics as in /diff windows.
+        """
+        for path, diff in results.items():
+            if diff is None or not diff.diff_lines:
+                continue
+            diff_lines = diff.diff_lines
+            self._add("diff", str(utils.ensure_posix(path)), {
+                "lines": diff_lines,
+                "stats": {
+                    "lines": len(diff_lines),
+                    "hunks": sum(line.startswith("@@") for line in diff_lines),
+                    "linesAdded": diff.lines_added,
+                    "linesRemoved": diff.lines_removed,
+                },
+            })
+
+    def add_tree(self, tree):
+        """Write the root of the tree, and the children of each node, in pages like the /children API,
+        and the subtree below each directory like /subtree.
+
+        The first page by name is keyed by the node's key; directories with more than one page also
+        get the pages of every other sort (smaller ones can be sorted by the client).
+        """
+        self._submit(self._write_json, self.dump_dir /
+                     "changed_files", tree.get_tree())
+
+        compact = tree.compact
+        for node in range(len(compact)):
+            key = compact.get_key(node)
+            sorts = compact_tree.SORTS if compact.child_count[node] > compact_tree.PAGE_SIZE else ("name",)
+            for sort in sorts:
+                for cursor, page in compact.iter_pages(node, sort):
+                    self._add("children", compact_tree.get_page_key(
+                        key, sort, cursor), page)
+
+            # What the frontend prefetches when a directory is expanded, like /subtree?changed=true.
+            if compact.child_count[node]:
+                self._add("subtree", key, compact.subtree_json(
+                    node, changed_only=True))
+
+    def close(self):
+        """Wait for all the files to be written, raising the first error."""
+        self._executor.shutdown(wait=True)
+        pending, self._pending = self._pending, collections.deque()
+        for future in pending:
+            future.result()
+
+
+class BundledExport(StaticExport):
+    """Static API data packed into a few large bundle files, instead of a file per node.
+
+    Each node's JSON is gzipped on its own and appended to the current bundle, so it
+    can be fetched with a Range request and decompressed by the browser. Index files,
+    addressed by a prefix of the node's hash, give the bundle, offset and length of each
+    node, and bundles/manifest.json tells the frontend how to find them:
+
+        bundles/manifest.json
+        bundles/index/<hash prefix>.json  {"children": {hash: [bundle, offset, length]}, "subtree": {...}, "diff": {...}}
+        bundles/<bundle>.bundle
+    """
+
+    KINDS = ("children", "subtree", "diff")
+    MAX_BUNDLE_SIZE = 32 * 1024 * 1024
+    # Index files are split by hash prefix, until they hold about this many nodes.
+    _INDEX_SIZE = 2048
+    _GZIP_LEVEL = 6
+
+    def __init__(self, dump_dir):
+        super(BundledExport, self).__init__(dump_dir)
+        self.bundle_dir = self.dump_dir / "bundles"
+        os.makedirs(self.bundle_dir / "index", exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._index = {kind: {} for kind in self.KINDS}
+        self._bundle_number = -1
+        self._bundle = None
+        self._bundle_size = 0
+
+    def _next_bundle(self):
+        if self._bundle is not None:
+            self._bundle.close()
+        self._bundle_number += 1
+        self._bundle = open(self.bundle_dir / f"{self._bundle_number}.bundle", "wb")
+        self._bundle_size = 0
+
+    def _append(self, kind, filename, data):
+        # mtime=0 so the same data always compresses to the same bytes.
+        payload = gzip.compress(json.dumps(data).encode(
+            "utf8"), compresslevel=self._GZIP_LEVEL, mtime=0)
+
+        with self._lock:
+            if self._bundle is None or (self._bundle_size and self._bundle_size + len(payload) > self.MAX_BUNDLE_SIZE):
+                self._next_bundle()
+            self._index[kind][filename] = [
+                self._bundle_number, self._bundle_size, len(payload)]
+            self._bundle.write(payload)
+            self._bundle_size += len(payload)
+
+    def _add(self, kind, key, data):
+        self._submit(self._append, kind, self.get_filename(key), data)
+
+    def _get_prefix_length(self):
+        num_entries = sum(len(entries) for entries in self._index.values())
+        prefix_length = 1
+        while num_entries / 16 ** prefix_length > self._INDEX_SIZE:
+            prefix_length += 1
+        return prefix_length
+
+    def close(self):
+        super(BundledExport, self).close()
+        if self._bundle is not None:
+            self._bundle.close()
+
+        prefix_length = self._get_prefix_length()
+        indexes = {}
+        for kind, entries in self._index.items():
+            for filename, entry in entries.items():
+                index = indexes.setdefault(
+                    filename[:prefix_length], {kind: {} for kind in self.KINDS})
+                index[kind][filename] = entry
+
+        for prefix, index in indexes.items():
+            self._write_json(self.bundle_dir / "index" / f"{prefix}.json", index)
+
+        self._write_json(self.bundle_dir / "manifest.json", {
+            "version": 1,
+            "compression": "gzip",
+            "prefixLength": prefix_length,
+            "numBundles": self._bundle_number + 1,
+        })
+        logging.info(
+            f"Bundled {len(self._index['children'])} children lists and {len(self._index['diff'])} diffs "
+            f"into {self._bundle_number + 1} bundles in {self.bundle_dir}")
+
+
+def get_exporter(dump_dir, export_format="files"):
+    """
+    Args:
+        export_format (str): "files" for a JSON file per node, or "bundles" for gzipped bundles.
+    """
+    if export_format == "bundles":
+        return BundledExport(dump_dir)
+    return StaticExport(dump_dir)
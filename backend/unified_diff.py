@@ -1,9 +1,22 @@
+import bisect
+import re
+
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+
 
 class UnifiedDiff(object):
+    """A diff of a file, directory or process, and its summary statistics.
+
+    Diffs loaded from the cache are built from their stored statistics with from_stats,
+    and only read their lines when diff_lines is first used.
+    """
+
+    __slots__ = ("_diff_lines", "_load_lines", "is_dir", "title", "ppid",
+                 "status", "lines_added", "lines_removed", "bytes_changed")
 
     def __init__(self, diff_lines, is_dir=None, ppid=None, title=None):
-        self.diff_lines = diff_lines
-        self._iter = iter(diff_lines)
+        self._diff_lines = diff_lines
+        self._load_lines = None
         self.is_dir = is_dir
 
         self.title = title
@@ -11,22 +24,181 @@ class UnifiedDiff(object):
         # Parent PID if this is a process node.
         self.ppid = ppid
 
-        header = diff_lines[1]
-        if header.startswith("new"):
-            self.status = "added"
-        elif header.startswith("deleted"):
-            self.status = "removed"
-        else:
-            self.status = "modified"
-
-        self.lines_added = 0
-        self.lines_removed = 0
-        for line in diff_lines:
-            # Ignore --- and +++ lines
-            if line.startswith("+") and not line.startswith("++"):
-                self.lines_added += 1
-            if line.startswith("-") and not line.startswith("--"):
-                self.lines_removed += 1
-
-    def __next__(self):
-        return next(self._iter)
+        self._set_stats(get_stats(diff_lines))
+
+    @classmethod
+    def from_stats(cls, stats, load_lines, is_dir=None, ppid=None, title=None):
+        """A diff whose lines are read when they're needed.
+
+        Args:
+            stats (dict): from get_stats (or UnifiedDiff.stats), as stored with the diff.
+            load_lines (callable): returns the diff's lines.
+        """
+        diff = cls.__new__(cls)
+        diff._diff_lines = None
+        diff._load_lines = load_lines
+        diff.is_dir = is_dir
+        diff.title = title
+        diff.ppid = ppid
+        diff._set_stats(stats)
+        return diff
+
+    def _set_stats(self, stats):
+        self.status = stats["status"]
+        self.lines_added = stats["linesAdded"]
+        self.lines_removed = stats["linesRemoved"]
+        # Size of the added and removed lines.
+        self.bytes_changed = stats["bytesChanged"]
+
+    @property
+    def diff_lines(self):
+        if self._diff_lines is None:
+            self._diff_lines = self._load_lines()
+            self._load_lines = None
+        return self._diff_lines
+
+    def stats(self):
+        """
+        Returns:
+            dict: as get_stats, to store with the diff.
+        """
+        return {
+            "status": self.status,
+            "linesAdded": self.lines_added,
+            "linesRemoved": self.lines_removed,
+            "bytesChanged": self.bytes_changed,
+        }
+
+
+def get_stats(diff_lines):
+    """
+    Returns:
+        dict: status ("added", "removed" or "modified"), linesAdded, linesRemoved and
+            bytesChanged (size of the added and removed lines).
+    """
+    header = diff_lines[1]
+    if header.startswith("new"):
+        status = "added"
+    elif header.startswith("deleted"):
+        status = "removed"
+    else:
+        status = "modified"
+
+    # Only lines in hunks, not the ---, +++ headers before them. Changed lines can start
+    # with ++ or -- too, so counted the same way as _count_changes (and get_hunk_index).
+    hunk_lines = diff_lines[_get_header_end(diff_lines):]
+    added = [len(line) for line in hunk_lines if line[:1] == "+"]
+    removed = [len(line) for line in hunk_lines if line[:1] == "-"]
+    return {
+        "status": status,
+        "linesAdded": len(added),
+        "linesRemoved": len(removed),
+        "bytesChanged": sum(added) + sum(removed) - len(added) - len(removed),
+    }
+
+
+def get_hunk_index(diff_lines):
+    """Where the hunks of a diff start, and its summary statistics, to read windows of it with get_window.
+
+    Returns:
+        dict: lines (number of lines), hunks (line index of each hunk header),
+            linesAdded and linesRemoved.
+    """
+    hunks = [index for index, line in enumerate(diff_lines) if line.startswith("@@")]
+    # Not counting the headers (---, +++) before the first hunk, as get_stats.
+    lines_added, lines_removed = _count_changes(diff_lines[hunks[0]:]) if hunks else (0, 0)
+    return {
+        "lines": len(diff_lines),
+        "hunks": hunks,
+        "linesAdded": lines_added,
+        "linesRemoved": lines_removed,
+    }
+
+
+def get_window(diff_lines, hunk_index, start, end, max_lines=None):
+    """A window of a diff that's still a diff on its own: the diff's headers, then lines [start, end).
+
+    If the window starts within a hunk, it gets a hunk header of its own, numbered from
+    where it starts in the old and new file.
+
+    Args:
+        hunk_index (dict): from get_hunk_index.
+        max_lines (int): end the window sooner, after this many of the diff's lines.
+
+    Returns:
+        dict: lines (to render), start, end (the lines of the diff in the window), hunkStart,
+            hunkEnd (the hunks in the window, or partly in it) and stats (of the whole diff).
+    """
+    hunks = hunk_index["hunks"]
+    header_end = hunks[0] if hunks else len(diff_lines)
+    start = min(max(start, header_end), len(diff_lines))
+    end = min(max(end, start), len(diff_lines))
+    if max_lines is not None:
+        end = min(end, start + max_lines)
+
+    lines = diff_lines[:header_end]
+    hunk = bisect.bisect_right(hunks, start) - 1
+    if hunk >= 0 and hunks[hunk] != start and start < end:
+        old_line, new_line = _get_line_numbers(diff_lines, hunks[hunk], start)
+        hunk_end = hunks[hunk + 1] if hunk + 1 < len(hunks) else len(diff_lines)
+        lines.append(_get_hunk_header(old_line, new_line, diff_lines[start:min(hunk_end, end)]))
+    lines.extend(diff_lines[start:end])
+
+    # A hunk that starts in the window but is cut off by its end gets the counts of what's in it.
+    last_hunk = bisect.bisect_left(hunks, end) - 1
+    next_hunk = hunks[last_hunk + 1] if last_hunk + 1 < len(hunks) else len(diff_lines)
+    if last_hunk >= 0 and hunks[last_hunk] >= start and end < next_hunk:
+        header = _HUNK_HEADER.match(diff_lines[hunks[last_hunk]])
+        if header:
+            position = len(lines) - (end - hunks[last_hunk])
+            lines[position] = _get_hunk_header(
+                int(header.group(1)), int(header.group(2)), diff_lines[hunks[last_hunk] + 1:end])
+
+    return {
+        "lines": lines,
+        "start": start,
+        "end": end,
+        "hunkStart": max(hunk, 0),
+        "hunkEnd": bisect.bisect_left(hunks, end),
+        "stats": {
+            "lines": hunk_index["lines"],
+            "hunks": len(hunks),
+            "linesAdded": hunk_index["linesAdded"],
+            "linesRemoved": hunk_index["linesRemoved"],
+        },
+    }
+
+
+def _get_header_end(diff_lines):
+    """Index of the first hunk header, after the diff's headers."""
+    for index, line in enumerate(diff_lines):
+        if line.startswith("@@"):
+            return index
+    return len(diff_lines)
+
+
+def _count_changes(lines):
+    """
+    Args:
+        lines (list[str]): lines within hunks, where every line starting with + or - is a change.
+
+    Returns:
+        tuple: (added, removed) lines.
+    """
+    # By line, as get_stats counts: a line can have a newline within it (e.g. an xattr value).
+    return sum(line[:1] == "+" for line in lines), sum(line[:1] == "-" for line in lines)
+
+
+def _get_hunk_header(old_line, new_line, lines):
+    """A hunk header for lines of a hunk, starting at these line numbers."""
+    added, removed = _count_changes(lines)
+    return f"@@ -{old_line},{len(lines) - added} +{new_line},{len(lines) - removed} @@\n"
+
+
+def _get_line_numbers(diff_lines, hunk_start, index):
+    """The old and new file's line numbers at a line within the hunk starting at hunk_start."""
+    header = _HUNK_HEADER.match(diff_lines[hunk_start])
+    old_line, new_line = (int(header.group(1)), int(header.group(2))) if header else (0, 0)
+    added, removed = _count_changes(diff_lines[hunk_start + 1:index])
+    num_lines = index - hunk_start - 1
+    return old_line + num_lines - added, new_line + num_lines - removed
@@ -1,8 +1,45 @@
+import contextlib
 import pathlib 
+import re
 
 def ensure_posix(path):
     if path.startswith("\\"):
         # Force POSIX path so that we can create the directory structure in the Docker container, even if the path is Windows.
         path = pathlib.PureWindowsPath(path).as_posix()
     path = pathlib.Path(path)
-    return path
\ No newline at end of file
+    return path
+
+
+def should_list_dir(location, allow_dirs, ignore_dirs):
+    """Whether a location is inside (or above) an allowed directory, and doesn't match an ignored path."""
+    for allow_dir in allow_dirs:
+        if location.startswith(allow_dir) or allow_dir.startswith(location):
+            for ignore_dir in ignore_dirs:
+                # Convert to raw string so backslashes aren't interpreted as escapes.
+                ignore_dir = repr(ignore_dir).strip("'")
+                if re.search(ignore_dir, location):
+                    return False
+            return True
+
+    return False
+
+
+def close_file_object(file_object):
+    """Close a file entry's file object, if it can be.
+
+    Files opened by the directory lister hold a file handle until they're closed; dfvfs
+    file objects are closed when they're dereferenced, and may have no close().
+    """
+    close = getattr(file_object, "close", None)
+    if close is not None:
+        close()
+
+
+@contextlib.contextmanager
+def open_file_object(file_entry):
+    """The file entry's file object (or None), closed afterwards, see close_file_object."""
+    file_object = file_entry.GetFileObject()
+    try:
+        yield file_object
+    finally:
+        close_file_object(file_object)
@@ -2,21 +2,29 @@
 # -*- coding: utf-8 -*-
 """Script to list file entries."""
 
+from concurrent import futures
 from dfvfs.helpers import command_line
 from dfvfs.helpers import volume_scanner
+from dfvfs.resolver import resolver
+from dfvfs.serializer import json_serializer
 import memdiff
 import diff_tree
 import diffcache
+import component_cache
 import diskdiff
+import directory_lister
 import file_entry_lister
+import progress
+import results_publisher
+import results_store
+import static_export
+import volume_cache
 import logging
 import sys
 import os
 import json
 import inspect
 
-import hashlib
-
 
 # Hacks to import the config from the parent directory.
 currentdir = os.path.dirname(os.path.abspath(
@@ -46,10 +54,14 @@ class CachingStdinInputReader(command_line.StdinInputReader):
         return self.last_input
 
 
+def get_memory_run_path():
+    """Where memdiff.sh saves the memory plugin output for the from and to memory images."""
+    memory_run_name = f"{config.FROM_MEMORY_FINGERPRINT}__{config.TO_MEMORY_FINGERPRINT}"
+    return os.path.join(config.RESULTS_DIR, "memory", memory_run_name)
+
+
 def load_memory_results():
-    memory_run_name = f"{config.FROM_MEMORY_IMAGE_FILENAME}__{config.TO_MEMORY_IMAGE_FILENAME}"
-    memory_run_path = os.path.join(
-        config.RESULTS_DIR, "memory", memory_run_name)
+    memory_run_path = get_memory_run_path()
     results = {}
     for plugin in config.MEMORY_PLUGINS:
 
@@ -65,58 +77,171 @@ def load_memory_results():
     return results
 
 
-def dump_api_data(cache):
+def scan_volumes(source, volume_scanner_options, mediator):
+    """Scan an image for volumes, once.
+
+    Returns:
+        dict: base path specs by volume identifier.
+    """
+    scanner = volume_scanner.VolumeScanner(mediator=mediator)
+    base_path_specs = scanner.GetBasePathSpecs(
+        source, options=volume_scanner_options)
+
+    if not base_path_specs:
+        raise Exception(
+            f'{source}: No supported file system found in source.')
+
+    return {
+        file_entry_lister.get_volume_identifier(base_path_spec): base_path_spec
+        for base_path_spec in base_path_specs
+    }
+
 
-    run_path = cache.tree_path
+def diff_volume(volume_identifier, from_path_spec_json, to_path_spec_json, on_results=None):
+    """Diff one volume of the from and to disks. Runs in a worker process, so path specs are passed serialized.
 
-    dump_dir = run_path / "json"
-    children_dir = dump_dir / "children"
-    diff_dir = dump_dir / "diff"
+    Args:
+        on_results (callable): see DiskDiffer.diff_all, only when diffing in this process.
+    """
+    from_base_path_spec = json_serializer.JsonPathSpecSerializer.ReadSerialized(
+        from_path_spec_json)
+    to_base_path_spec = json_serializer.JsonPathSpecSerializer.ReadSerialized(
+        to_path_spec_json)
 
-    if config.USE_CACHE and dump_dir.exists():
-        return
+    parent_lister = file_entry_lister.FileEntryLister(
+        config.FROM_DISK_PATH, base_path_specs=[from_base_path_spec], ignore_dirs=config.ignore_dirs, allow_dirs=config.allow_dirs)
+    delta_lister = file_entry_lister.FileEntryLister(
+        config.TO_DISK_PATH, base_path_specs=[to_base_path_spec], ignore_dirs=config.ignore_dirs, allow_dirs=config.allow_dirs)
 
-    logging.info(f"Generating API data for static site: {dump_dir}")
+    cache = None
+    if config.USE_CACHE:
+        cache = component_cache.ComponentCache(
+            get_component_cache_path(volume_identifier))
 
-    os.makedirs(dump_dir, exist_ok=True)
-    os.makedirs(children_dir, exist_ok=True)
-    os.makedirs(diff_dir, exist_ok=True)
+    volume_progress = progress.Progress(
+        config.RUN_TREE_PATH, f"disk-{volume_identifier}")
+    differ = diskdiff.DiskDiffer(
+        parent_lister, delta_lister,
+        component_cache=cache,
+        progress=volume_progress,
+        **config.diff_config
+    )
+    differ.get_changed_files()
+    results = differ.diff_all(on_results)
 
-    logging.info(f"Dumping API data to {dump_dir}")
+    if cache is not None:
+        cache.close()
+    volume_progress.finish()
 
-    tree, children_map = cache.get_tree_data_from_cache()
+    logging.info(
+        f"Volume {volume_identifier or '/'}: {len(results)} differences found.")
+    return volume_identifier, results
 
-    json.dump(tree, open(dump_dir / "changed_files", "w"))
 
-    # Dump all the data with url encoded keys, so we can serve it statically later
-    for key, children in children_map.items():
+def get_component_cache_dir():
+    """Where the diff components of the from and to disks are cached, whatever the diff options."""
+    images = f"{config.FROM_DISK_FINGERPRINT}--{config.TO_DISK_FINGERPRINT}"
+    return os.path.join(config.COMPONENT_CACHE_PATH, images)
 
-        # Make sure to also encode the "/" character.
-        filename = hashlib.sha1(key.encode("utf8")).hexdigest()
 
-        path = children_dir / filename
-        json.dump(children, open(path, "w"))
+def get_component_cache_path(volume_identifier):
+    return os.path.join(get_component_cache_dir(), volume_identifier.replace("/", "_") or "root")
 
-        # Get the diff and dump it too.
-        diff = cache.get_diff(key)
-        if diff is None:
-            result = None
-        else:
-            result = diff.diff_lines
 
-        if result:
-            path = diff_dir / filename
-            json.dump(result, open(path, "w"))
+def get_artifacts():
+    """Caches this run is built from, which the results store keeps as long as the run."""
+    artifacts = []
+    if config.USE_DISK and config.DISK_LISTER != "directory":
+        cache = volume_cache.VolumeCache(config.VOLUME_CACHE_PATH)
+        artifacts.extend([
+            get_component_cache_dir(),
+            cache.entry_path(config.FROM_DISK_FINGERPRINT),
+            cache.entry_path(config.TO_DISK_FINGERPRINT),
+        ])
+    if config.USE_MEMORY:
+        artifacts.append(get_memory_run_path())
+    return artifacts
 
 
-def Main():
+def diff_directories(sinks=None):
+    """Diff two snapshots that are directory trees on the host, e.g. exported or mounted read-only."""
+    parent_lister = directory_lister.DirectoryLister(
+        config.FROM_DISK_PATH, ignore_dirs=config.ignore_dirs, allow_dirs=config.allow_dirs)
+    delta_lister = directory_lister.DirectoryLister(
+        config.TO_DISK_PATH, ignore_dirs=config.ignore_dirs, allow_dirs=config.allow_dirs)
+
+    disk_progress = progress.Progress(config.RUN_TREE_PATH, "disk")
+    differ = diskdiff.DiskDiffer(
+        parent_lister, delta_lister,
+        progress=disk_progress,
+        **config.diff_config
+    )
+    differ.get_changed_files()
+
+    disk_results = diskdiff.DiskResults(sinks=sinks)
+    # Hand the results to the sinks while the rest are diffed.
+    differ.diff_all(lambda results: disk_results.add("", results))
+    disk_progress.finish()
+    return disk_results
+
+
+def diff_volumes(from_volumes, to_volumes, sinks=None):
+    """Diff every volume found in both disks, each in its own worker process.
+
+    Args:
+        sinks (list): passed on to diskdiff.DiskResults, to handle each volume's results as soon as it's diffed.
+
+    Returns:
+        diskdiff.DiskResults: merged results, rooted by volume identifier if there's more than one volume.
+    """
+    volume_identifiers = [
+        volume_identifier for volume_identifier in from_volumes if volume_identifier in to_volumes]
+
+    for volume_identifier in set(from_volumes) ^ set(to_volumes):
+        logging.warning(
+            f"Volume {volume_identifier} is only in one of the disks, skipping.")
+
+    disk_results = diskdiff.DiskResults(
+        prefix_volumes=len(volume_identifiers) > 1, sinks=sinks)
+
+    jobs = [
+        (volume_identifier,
+         json_serializer.JsonPathSpecSerializer.WriteSerialized(
+             from_volumes[volume_identifier]),
+         json_serializer.JsonPathSpecSerializer.WriteSerialized(to_volumes[volume_identifier]))
+        for volume_identifier in volume_identifiers
+    ]
+
+    if len(jobs) == 1:
+        # In this process, so the results can go to the sinks while the rest are diffed.
+        volume_identifier = jobs[0][0]
+        diff_volume(*jobs[0], on_results=lambda results: disk_results.add(volume_identifier, results))
+        return disk_results
+
+    max_workers = min(len(jobs), os.cpu_count() or 1)
+    with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = [executor.submit(diff_volume, *job) for job in jobs]
+        for future in futures.as_completed(pending):
+            disk_results.add(*future.result())
+
+    return disk_results
+
+
+def scan_disks():
+    """Scan both disks for volumes, asking which partitions to use (once) if PARTITION_IDENTIFIER isn't set.
+
+    Scans are cached per image, so repeat runs (and unattended runs without
+    PARTITION_IDENTIFIER) reuse the previous scan and partition choice.
+
+    Returns:
+        tuple: (from_volumes: dict, to_volumes: dict) base path specs by volume identifier.
+    """
 
     # Leave Blank or invalid for interactive prompt
     partition = config.PARTITION
     VOLUMES = "all"
 
-    logging.basicConfig(
-        level=logging.INFO, format='[%(levelname)s] %(message)s')
+    cache = volume_cache.VolumeCache(config.VOLUME_CACHE_PATH)
 
     caching_input_reader = CachingStdinInputReader()
     mediator = command_line.CLIVolumeScannerMediator(
@@ -129,62 +254,108 @@ def Main():
     volume_scanner_options.volumes = mediator.ParseVolumeIdentifiersString(
         VOLUMES)
 
-    # Init disk file listers.
-    parent_lister = file_entry_lister.FileEntryLister(
-        config.FROM_DISK_PATH, volume_scanner_options, mediator=mediator, ignore_dirs=config.ignore_dirs, allow_dirs=config.allow_dirs)
+    from_volumes = None
+    if config.USE_CACHE:
+        from_volumes, partition_input = cache.get(
+            config.FROM_DISK_PATH, config.FROM_DISK_FINGERPRINT, partition)
 
-    partition_input = partition
-    if not partition_input:
-        # Get the input the user gave the first time, if any.
-        partition_input = caching_input_reader.last_input
+    scanned_interactively = False
+    if from_volumes is None:
+        from_volumes = scan_volumes(
+            config.FROM_DISK_PATH, volume_scanner_options, mediator)
 
-    volume_scanner_options.partitions = list(mediator.ParseVolumeIdentifiersString(
-        partition_input))
+        partition_input = partition
+        if not partition_input:
+            # Get the input the user gave the first time, if any.
+            partition_input = caching_input_reader.last_input
+            scanned_interactively = True
 
-    delta_lister = file_entry_lister.FileEntryLister(
-        config.TO_DISK_PATH, volume_scanner_options, mediator=mediator, ignore_dirs=config.ignore_dirs, allow_dirs=config.allow_dirs)
+        cache.put(config.FROM_DISK_PATH, config.FROM_DISK_FINGERPRINT, from_volumes, partition_input)
+
+    to_volumes = None
+    if config.USE_CACHE:
+        to_volumes, _ = cache.get(config.TO_DISK_PATH, config.TO_DISK_FINGERPRINT, partition_input)
+
+    if to_volumes is None:
+        volume_scanner_options.partitions = list(mediator.ParseVolumeIdentifiersString(
+            partition_input))
+
+        to_volumes = scan_volumes(
+            config.TO_DISK_PATH, volume_scanner_options, mediator)
+        cache.put(config.TO_DISK_PATH, config.TO_DISK_FINGERPRINT, to_volumes, partition_input)
 
     # ls parition to make sure it's the right one:
-    if not partition:
-        entries = list(
-            parent_lister.file_system.GetRootFileEntry().sub_file_entries)
-        ls_root = [e.name for e in entries]
-        logging.info(f"Partition {partition} root files: {ls_root}")
+    if scanned_interactively:
+        for volume_identifier, base_path_spec in from_volumes.items():
+            file_system = resolver.Resolver.OpenFileSystem(base_path_spec)
+            entries = list(
+                file_system.GetRootFileEntry().sub_file_entries)
+            ls_root = [e.name for e in entries]
+            logging.info(
+                f"Partition {volume_identifier} root files: {ls_root}")
+
+    return from_volumes, to_volumes
 
-    diff_config = config.diff_config
-    differ = diskdiff.DiskDiffer(
-        parent_lister, delta_lister,
-        **diff_config
-    )
+
+def Main():
+
+    logging.basicConfig(
+        level=logging.INFO, format='[%(levelname)s] %(message)s')
 
     USE_CACHE = config.USE_CACHE
 
     run_process_path = config.RUN_MEMORY_PATH if config.USE_MEMORY else None
 
+    store = results_store.ResultsStore(
+        config.RESULTS_DIR, config.RESULTS_BUDGET)
+    # Hold the run while it's written, so it isn't evicted by another run's collection.
+    run_lock = results_store.RunLock(config.RUN_PATH).acquire()
+    # Along with the artifacts it's built from, however long it takes.
+    store.register_run(config.RUN_PATH, get_artifacts())
+
     cache = diffcache.DiffCache(
-        config.RUN_DISK_PATH, config.RUN_TREE_PATH, run_process_path)
+        config.RUN_DISK_PATH, config.RUN_TREE_PATH, run_process_path, storage=config.RESULTS_STORAGE)
 
     if USE_CACHE and cache.cache_exists() and (not config.USE_MEMORY or (config.USE_MEMORY and cache.process_cache_exists())):
         # Slice off the leading "/" and trailing "/disk"
         results_dir = os.path.join(*cache.run_path.parts[1:-1])
         logging.info(f"Results already cached at: {str(results_dir)}")
         # The diffs can be accessed via cache.get_diff_from_cache(path)
+        if not cache.grep_index_cache_exists():
+            logging.info("Indexing the cached diffs for grep... ")
+            cache.index_cached_results()
     else:
         logging.info("No cache found, diffing... ")
+        # Including the partial results of an interrupted run.
+        cache.clear()
+
+        # API data for the static site, written as results are produced.
+        exporter = static_export.get_exporter(
+            cache.tree_path / "json", config.STATIC_EXPORT_FORMAT)
+
+        # Results (and progress) published as they're produced, for the server to show the run in progress.
+        run_progress = progress.Progress(cache.tree_path, "results")
+        publisher = results_publisher.ResultsPublisher(cache, run_progress)
 
         if config.USE_DISK:
             logging.info("Diffing disk... ")
 
             # Get results and cache them.
-            differ.get_changed_files()
-            results = differ.diff_all()
+            if config.DISK_LISTER == "directory":
+                disk_results = diff_directories(sinks=[exporter, publisher])
+            else:
+                from_volumes, to_volumes = scan_disks()
+                disk_results = diff_volumes(
+                    from_volumes, to_volumes, sinks=[exporter, publisher])
+            results = disk_results.diffs
 
             if not results:
                 logging.info("No disk differences found.")
-            cache.cache_results(results)
+                # The publisher cached everything else, but the run still needs an (empty) cache.
+                cache.cache_results(results)
 
             # Now render the tree
-            disk_tree = diff_tree.DiffTree(differ)
+            disk_tree = diff_tree.DiffTree(disk_results)
 
         if config.USE_MEMORY:
             logging.info("Diffing memory... ")
@@ -206,10 +377,15 @@ def Main():
                                               to_cmdline=to_cmdline,
                                               ignore_regex=config.IGNORE_PROCESSES_REGEX)
 
+            memory_progress = progress.Progress(cache.tree_path, "memory")
             memdiffs = mem_differ.diff_all()
+            memory_progress.add("diffed", len(mem_differ.all_pids))
+            memory_progress.add("changed", len(memdiffs))
             if not memdiffs:
                 logging.info("No memory differences found.")
             cache.cache_process_results(memdiffs)
+            memory_progress.finish()
+            exporter.add_results(memdiffs)
 
             mem_tree = diff_tree.DiffTree(mem_differ)
 
@@ -223,13 +399,20 @@ def Main():
             raise RuntimeError(
                 "Must set either USE_DISK or USE_MEMORY, otherwise what am I supposed to diff, huh wise guy")
 
-        logging.debug(merged_tree.children_map)
+        logging.debug(f"Tree: {len(merged_tree.compact)} nodes")
 
-        cache.cache_tree(merged_tree)
-        dump_api_data(cache)
+        publisher.publish_tree(merged_tree)
+        cache.log_stats()
+        exporter.add_tree(merged_tree)
+        exporter.close()
+        run_progress.finish()
 
         logging.info(f"Saved results to {cache.run_path}")
 
+    store.register_run(config.RUN_PATH, get_artifacts())
+    store.collect()
+    run_lock.release()
+
     return cache
 
 
@@ -0,0 +1,218 @@
+"""Grain allocation of hosted sparse VMDK images, following delta disks down to the base disk."""
+import logging
+import os
+import re
+import struct
+
+SECTOR_SIZE = 512
+
+# Grain states
+UNALLOCATED = 0
+DATA = 1
+ZERO = 2
+
+_SPARSE_MAGIC = b"KDMV"
+# magicNumber, version, flags, capacity, grainSize, descriptorOffset, descriptorSize,
+# numGTEsPerGT, rgdOffset, gdOffset, overHead
+_SPARSE_HEADER = struct.Struct("<4sIIQQQQIQQQ")
+_GD_AT_END = 0xFFFFFFFFFFFFFFFF
+_FLAG_ZEROED_GRAIN_GTE = 0x4
+
+_MAX_DESCRIPTOR_SIZE = 64 * 1024
+
+_EXTENT_LINE = re.compile(
+    r'^\s*(?:RW|RDONLY|NOACCESS)\s+(\d+)\s+(\w+)(?:\s+"([^"]*)")?', re.MULTILINE)
+_PARENT_HINT = re.compile(r'^\s*parentFileNameHint\s*=\s*"([^"]*)"', re.MULTILINE)
+
+
+class UnsupportedLayout(Exception):
+    pass
+
+
+class GrainMap(object):
+    """Which grains of a virtual disk hold data, and which are known to read as zeros."""
+
+    def __init__(self, grain_size, states):
+        """
+        Args:
+            grain_size (int): grain size in bytes.
+            states (bytes): DATA or ZERO for each grain of the disk.
+        """
+        self.grain_size = grain_size
+        self.states = states
+
+    @classmethod
+    def from_image(cls, path):
+        """Read the grain tables of a VMDK image and all its parents.
+
+        Returns:
+            GrainMap: or None if the image layout isn't supported (e.g. flat or stream optimized).
+        """
+        try:
+            grain_size, states, parent_path = _read_image(path)
+            while parent_path:
+                parent_grain_size, parent_states, parent_path = _read_image(
+                    parent_path)
+                if parent_grain_size != grain_size:
+                    raise UnsupportedLayout(
+                        "Grain size differs between delta and parent disk")
+
+                # Unallocated grains in a delta disk are read from its parent.
+                states = bytearray(
+                    state or parent_state for state, parent_state in zip(states, parent_states))
+        except (OSError, UnsupportedLayout, struct.error) as e:
+            logging.info(f"Not using grain allocation for {path}: {e}")
+            return None
+
+        # Grains unallocated all the way down to the base disk read as zeros.
+        states = bytes(states).replace(bytes([UNALLOCATED]), bytes([ZERO]))
+        return cls(grain_size, states)
+
+    def is_zero(self, offset, length):
+        """Whether the byte range of the virtual disk is known to read as zeros."""
+        if length <= 0:
+            return False
+
+        first = offset // self.grain_size
+        last = (offset + length - 1) // self.grain_size
+        if last >= len(self.states):
+            return False
+
+        return self.states.find(DATA, first, last + 1) == -1
+
+
+def read_descriptor(path):
+    """Read the descriptor of a VMDK image, either a text file or embedded in a monolithic sparse extent.
+
+    Returns:
+        str: the descriptor, empty if the image has none.
+    """
+    with open(path, "rb") as f:
+        header = f.read(_SPARSE_HEADER.size)
+        if not header.startswith(_SPARSE_MAGIC):
+            f.seek(0)
+            return f.read(_MAX_DESCRIPTOR_SIZE).decode("ascii", "ignore")
+
+        if len(header) < _SPARSE_HEADER.size:
+            return ""
+        descriptor_offset, descriptor_size = _SPARSE_HEADER.unpack(header)[5:7]
+        if not descriptor_offset:
+            return ""
+        f.seek(descriptor_offset * SECTOR_SIZE)
+        return f.read(descriptor_size * SECTOR_SIZE).decode("ascii", "ignore").rstrip("\0")
+
+
+def get_extent_paths(path, descriptor):
+    """Paths of the extent files listed in a descriptor, relative to the image at path."""
+    return [os.path.join(os.path.dirname(path), filename)
+            for _, _, filename in _EXTENT_LINE.findall(descriptor) if filename]
+
+
+def _read_image(path):
+    """
+    Returns:
+        tuple: (grain_size: int, states: bytearray, parent_path: str | None)
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(_SPARSE_MAGIC))
+
+    if magic == _SPARSE_MAGIC:
+        # Monolithic sparse: the descriptor is embedded in the (only) extent.
+        grain_size, states, descriptor = _read_sparse_extent(path)
+        return grain_size, states, _get_parent_path(path, descriptor)
+
+    with open(path, "rb") as f:
+        descriptor = f.read(_MAX_DESCRIPTOR_SIZE).decode("ascii", "ignore")
+
+    extents = _EXTENT_LINE.findall(descriptor)
+    if not extents:
+        raise UnsupportedLayout("No extents found in descriptor")
+
+    # Work out the grain size from the sparse extents first, so flat extents can be counted in grains.
+    sparse_extents = {}
+    for sectors, extent_type, filename in extents:
+        if extent_type == "SPARSE":
+            extent_path = os.path.join(os.path.dirname(path), filename)
+            sparse_extents[filename] = _read_sparse_extent(extent_path)
+
+    grain_sizes = set(grain_size for grain_size, _, _ in sparse_extents.values())
+    if len(grain_sizes) != 1:
+        raise UnsupportedLayout("No sparse extents, or mixed grain sizes")
+    grain_size = grain_sizes.pop()
+
+    states = bytearray()
+    for sectors, extent_type, filename in extents:
+        num_grains = -(-int(sectors) * SECTOR_SIZE // grain_size)
+        if extent_type == "SPARSE":
+            extent_states = sparse_extents[filename][1][:num_grains]
+        elif extent_type == "ZERO":
+            extent_states = bytes([ZERO]) * num_grains
+        elif extent_type in ("FLAT", "VMFS"):
+            extent_states = bytes([DATA]) * num_grains
+        else:
+            raise UnsupportedLayout(f"Unsupported extent type {extent_type}")
+        states.extend(extent_states)
+
+    return grain_size, states, _get_parent_path(path, descriptor)
+
+
+def _read_sparse_extent(path):
+    """
+    Returns:
+        tuple: (grain_size: int, states: bytearray, embedded_descriptor: str)
+    """
+    with open(path, "rb") as f:
+        (magic, version, flags, capacity, grain_size, descriptor_offset, descriptor_size,
+         num_gtes_per_gt, rgd_offset, gd_offset, overhead) = _SPARSE_HEADER.unpack(
+            f.read(_SPARSE_HEADER.size))
+
+        if magic != _SPARSE_MAGIC:
+            raise UnsupportedLayout(f"{path} is not a sparse extent")
+        if gd_offset == _GD_AT_END or not grain_size or not num_gtes_per_gt:
+            raise UnsupportedLayout(
+                f"{path}: stream optimized extents are not supported")
+
+        descriptor = ""
+        if descriptor_offset:
+            f.seek(descriptor_offset * SECTOR_SIZE)
+            descriptor = f.read(descriptor_size * SECTOR_SIZE).decode(
+                "ascii", "ignore").rstrip("\0")
+
+        num_grains = -(-capacity // grain_size)
+        num_gdes = -(-num_grains // num_gtes_per_gt)
+
+        f.seek(gd_offset * SECTOR_SIZE)
+        grain_directory = struct.unpack(
+            f"<{num_gdes}I", f.read(num_gdes * 4))
+
+        zeroed_grain_gte = flags & _FLAG_ZEROED_GRAIN_GTE
+        states = bytearray(num_grains)
+        for gde_index, gt_sector in enumerate(grain_directory):
+            # No grain table means none of its grains are allocated.
+            if not gt_sector:
+                continue
+
+            first_grain = gde_index * num_gtes_per_gt
+            num_gtes = min(num_gtes_per_gt, num_grains - first_grain)
+            f.seek(gt_sector * SECTOR_SIZE)
+            grain_table = struct.unpack(
+                f"<{num_gtes}I", f.read(num_gtes * 4))
+
+            for gte_index, grain_sector in enumerate(grain_table):
+                if not grain_sector:
+                    continue
+                if grain_sector == 1 and zeroed_grain_gte:
+                    states[first_grain + gte_index] = ZERO
+                else:
+                    states[first_grain + gte_index] = DATA
+
+    return grain_size * SECTOR_SIZE, states, descriptor
+
+
+def _get_parent_path(path, descriptor):
+    match = _PARENT_HINT.search(descriptor)
+    if not match:
+        return None
+
+    # Same lookup as pyvmdk_delta: the parent is expected next to the delta disk.
+    return os.path.join(os.path.dirname(path), match.group(1))
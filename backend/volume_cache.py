@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import pathlib
+
+from dfvfs.lib import definitions as dfvfs_definitions
+from dfvfs.serializer import json_serializer
+
+
+class VolumeCache(object):
+    """Remembers the volume scan of each image (and which partitions were chosen), keyed by image fingerprint
+    (config.FROM_DISK_FINGERPRINT and TO_DISK_FINGERPRINT, computed once by the CLI).
+
+    This lets repeat runs skip dfvfs volume scanning, and lets unattended runs reuse
+    the partition that was picked interactively the first time.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = pathlib.Path(cache_path)
+
+    def entry_path(self, image_fingerprint):
+        return self.cache_path / f"{image_fingerprint}.json"
+
+    def get(self, image_path, image_fingerprint, partitions=None):
+        """Get the cached volumes of an image.
+
+        Args:
+            image_path (str): path of the image.
+            image_fingerprint (str): see fingerprint.get_image_fingerprint.
+            partitions (str): partition identifiers that must have been chosen, or empty to accept the cached choice.
+
+        Returns:
+            tuple: (volumes: dict | None, partitions: str | None) base path specs by volume identifier,
+                and the partitions they were scanned with. (None, None) on a cache miss.
+        """
+        entry_path = self.entry_path(image_fingerprint)
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None, None
+
+        if partitions and partitions != entry["partitions"]:
+            logging.info(
+                f"{image_path}: partitions {partitions} differ from cached scan ({entry['partitions']}), rescanning.")
+            return None, None
+
+        volumes = {}
+        for volume_identifier, volume in entry["volumes"].items():
+            base_path_spec = json_serializer.JsonPathSpecSerializer.ReadSerialized(
+                volume["path_spec"])
+            self._relocate(base_path_spec, image_path)
+            volumes[volume_identifier] = base_path_spec
+
+        logging.info(
+            f"{image_path}: using cached volume scan (partitions: {entry['partitions']}, volumes: {list(volumes)})")
+        return volumes, entry["partitions"]
+
+    def put(self, image_path, image_fingerprint, volumes, partitions):
+        """Cache the volume scan of an image.
+
+        Args:
+            image_path (str): path of the image.
+            image_fingerprint (str): see fingerprint.get_image_fingerprint.
+            volumes (dict): base path specs by volume identifier.
+            partitions (str): partition identifiers chosen for the scan.
+        """
+        entry = {
+            "image": os.path.basename(image_path),
+            "partitions": partitions or "",
+            "volumes": {
+                volume_identifier: {
+                    "file_system": base_path_spec.type_indicator,
+                    "path_spec": json_serializer.JsonPathSpecSerializer.WriteSerialized(base_path_spec),
+                }
+                for volume_identifier, base_path_spec in volumes.items()
+            }
+        }
+
+        os.makedirs(self.cache_path, exist_ok=True)
+        with open(self.entry_path(image_fingerprint), "w") as f:
+            json.dump(entry, f, indent=2)
+
+    def _relocate(self, base_path_spec, image_path):
+        """Point the cached path spec at the image's current location, in case it was moved or mounted elsewhere."""
+        path_spec = base_path_spec
+        while path_spec.parent is not None:
+            path_spec = path_spec.parent
+
+        if path_spec.type_indicator == dfvfs_definitions.TYPE_INDICATOR_OS:
+            path_spec.location = os.path.abspath(image_path)
@@ -0,0 +1,84 @@
+"""Time building the diff tree from a result set, and saving and loading it.
+
+Usage:
+    python benchmarks/bench_diff_tree.py [--paths 1000000]
+"""
+import argparse
+import os
+import random
+import tempfile
+
+import bench_utils
+
+
+class FakeDiff(object):
+    """Just the attributes of a UnifiedDiff the tree reads."""
+
+    def __init__(self, status, lines_added, lines_removed, is_dir=False):
+        self.status = status
+        self.lines_added = lines_added
+        self.lines_removed = lines_removed
+        self.bytes_changed = 40 * (lines_added + lines_removed)
+        self.is_dir = is_dir
+        self.title = None
+        self.ppid = None
+
+
+class FakeResults(object):
+    diff_type = "disk"
+
+    def __init__(self, diffs):
+        self.diffs = diffs
+
+
+def make_results(num_paths, seed=0):
+    """Windows-style paths, about 20 changed files per directory, with file names repeated across directories."""
+    rng = random.Random(seed)
+    statuses = ("added", "removed", "modified")
+
+    dirs = ["\\Windows"]
+    for i in range(max(1, num_paths // 20)):
+        dirs.append(f"{rng.choice(dirs)}\\dir{i}")
+
+    diffs = {}
+    while len(diffs) < num_paths:
+        path = f"{rng.choice(dirs)}\\file{rng.randint(0, 500)}.dll"
+        diffs[path] = FakeDiff(rng.choice(statuses), rng.randint(0, 20), rng.randint(0, 20))
+    return diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--paths", type=int, default=1000000)
+    args = parser.parse_args()
+
+    bench_utils.setup()
+    import compact_tree
+    import diff_tree
+
+    diffs = make_results(args.paths)
+
+    with bench_utils.Timer() as timer:
+        tree = diff_tree.DiffTree(FakeResults(diffs))
+    bench_utils.report(f"build ({len(diffs)} paths)", timer.elapsed, count=len(diffs))
+    root = tree.compact.roots[0]
+    print(f"{len(tree.compact)} nodes, {tree.compact.num_children[root]} files under the root")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "tree.bin")
+        with bench_utils.Timer() as timer:
+            tree.compact.save(path)
+        num_bytes = os.path.getsize(path)
+        bench_utils.report("save", timer.elapsed, num_bytes=num_bytes)
+
+        with bench_utils.Timer() as timer:
+            loaded = compact_tree.CompactTree.load(path)
+        bench_utils.report("load", timer.elapsed, num_bytes=num_bytes)
+
+    with bench_utils.Timer() as timer:
+        loaded.children_json(loaded.find("/Windows"))
+    bench_utils.report("children of /Windows", timer.elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Compare write and read throughput of the diff cache storage backends.
+
+Usage:
+    python benchmarks/bench_diffcache.py [--paths 100000]
+"""
+import argparse
+import random
+import shutil
+import tempfile
+
+import bench_utils
+
+
+def make_results(num_paths):
+    import unified_diff
+
+    results = {}
+    for i in range(num_paths):
+        path = f"\\Windows\\dir{i % 97}\\sub{i % 13}\\file{i}.txt"
+        diff_lines = [
+            f"diff --git {path} {path}\n",
+            f"--- {path}\n",
+            f"+++ {path}\n",
+            "@@ -1,2 +1,2 @@\n",
+            f"-old line {i}\n",
+            f"+new line {i}\n",
+            " unchanged\n",
+        ]
+        results[path] = unified_diff.UnifiedDiff(diff_lines, is_dir=False)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--paths", type=int, default=100000)
+    parser.add_argument("--reads", type=int, default=20000,
+                        help="Number of random diffs to read back.")
+    args = parser.parse_args()
+
+    bench_utils.setup()
+    import diffcache
+    import utils
+
+    results = make_results(args.paths)
+    num_bytes = sum(len("".join(diff.diff_lines)) for diff in results.values())
+    keys = [str(utils.ensure_posix(path)) for path in results]
+    read_keys = random.Random(0).sample(keys, min(args.reads, len(keys)))
+
+    for storage in ("mirror", "pack"):
+        run_dir = tempfile.mkdtemp(prefix=f"vmdiff-bench-{storage}-")
+        try:
+            cache = diffcache.DiffCache(
+                f"{run_dir}/disk", f"{run_dir}/tree", storage=storage)
+            with bench_utils.Timer() as timer:
+                cache.cache_results(results)
+            bench_utils.report(f"{storage}: write", timer.elapsed,
+                               count=len(results), num_bytes=num_bytes)
+
+            # Reopen, so the reads don't benefit from anything cached while writing.
+            cache = diffcache.DiffCache(
+                f"{run_dir}/disk", f"{run_dir}/tree", storage=storage)
+            with bench_utils.Timer() as timer:
+                for key in read_keys:
+                    assert cache.get_diff(key).lines_added is not None
+            bench_utils.report(f"{storage}: random loads (stats only)",
+                               timer.elapsed, count=len(read_keys))
+            with bench_utils.Timer() as timer:
+                for key in read_keys:
+                    assert cache.get_diff(key).diff_lines
+            bench_utils.report(f"{storage}: random reads",
+                               timer.elapsed, count=len(read_keys))
+        finally:
+            shutil.rmtree(run_dir)
+
+
+if __name__ == "__main__":
+    main()
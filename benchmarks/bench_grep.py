@@ -0,0 +1,75 @@
+"""Time building the grep index while the diffs are cached, and queries against it.
+
+Usage:
+    python benchmarks/bench_grep.py [--paths 100000]
+"""
+import argparse
+import random
+import shutil
+import tempfile
+
+import bench_utils
+
+QUERIES = (
+    "10.1.2.3",
+    "connect 10.3",
+    "user4",
+    "password",
+    "zz",
+)
+
+
+def make_results(num_paths):
+    import unified_diff
+
+    rng = random.Random(0)
+    results = {}
+    for i in range(num_paths):
+        path = f"\\Windows\\dir{i % 97}\\sub{i % 13}\\file{i}.txt"
+        diff_lines = [
+            f"--- {path}\n",
+            f"+++ {path}\n",
+            "@@ -1,4 +1,4 @@\n",
+            f" HKLM\\Software\\Vendor{rng.randrange(100)}\\Run\n",
+            f"-connect 10.{rng.randrange(4)}.{rng.randrange(4)}.{rng.randrange(256)} as user{rng.randrange(1000)}\n",
+            f"+connect 10.{rng.randrange(4)}.{rng.randrange(4)}.{rng.randrange(256)} as user{rng.randrange(1000)}\n",
+            f"+{'password' if i % 1000 == 0 else 'setting'}={rng.randrange(1 << 32):x}\n",
+        ]
+        results[path] = unified_diff.UnifiedDiff(diff_lines, is_dir=False)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--paths", type=int, default=100000)
+    args = parser.parse_args()
+
+    bench_utils.setup()
+    import diffcache
+
+    results = make_results(args.paths)
+    run_dir = tempfile.mkdtemp(prefix="vmdiff-bench-grep-")
+    try:
+        cache = diffcache.DiffCache(f"{run_dir}/disk", f"{run_dir}/tree")
+        with bench_utils.Timer() as timer:
+            cache.cache_results(results)
+        bench_utils.report("write and index", timer.elapsed, count=len(results))
+
+        stats = cache.get_grep_index_from_cache().stats()
+        print(f"index: {stats['words']} words, {stats['postings']} postings, "
+              f"{stats['size'] / 1024 / 1024:.1f}MiB, built in {cache._grep_index.build_time:.3f}s")
+
+        # Reopen, so the queries don't benefit from anything cached while writing.
+        cache = diffcache.DiffCache(f"{run_dir}/disk", f"{run_dir}/tree")
+        index = cache.get_grep_index_from_cache()
+        for query in QUERIES:
+            with bench_utils.Timer() as timer:
+                found = index.search(query, cache.get_diff_lines)
+            truncated = "+" if found["truncated"] else ""
+            bench_utils.report(f"{query} ({found['total']}{truncated})", timer.elapsed)
+    finally:
+        shutil.rmtree(run_dir)
+
+
+if __name__ == "__main__":
+    main()
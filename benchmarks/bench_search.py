@@ -0,0 +1,55 @@
+"""Time building the path search index, and queries against it.
+
+Usage:
+    python benchmarks/bench_search.py [--paths 1000000]
+"""
+import argparse
+import os
+import tempfile
+
+import bench_utils
+from bench_diff_tree import FakeResults, make_results
+
+QUERIES = (
+    ("substring", "file12.dll"),
+    ("substring", "dir4999\\file"),
+    ("substring", ".dll"),
+    ("substring", "zz"),
+    ("glob", "*\\dir4999\\*.dll"),
+    ("glob", "file1?.dll"),
+    ("regex", r"dir49\d\d/file1\.dll$"),
+    ("regex", r"file[0-9]+"),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--paths", type=int, default=1000000)
+    args = parser.parse_args()
+
+    bench_utils.setup()
+    import diff_tree
+    import search_index
+
+    tree = diff_tree.DiffTree(FakeResults(make_results(args.paths))).compact
+
+    with bench_utils.Timer() as timer:
+        index = search_index.SearchIndex.build(tree)
+    bench_utils.report(f"build ({len(index.entries)} entries)", timer.elapsed, count=len(index.entries))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "search.bin")
+        index.save(path)
+        print(f"index size {os.path.getsize(path) / 1024 / 1024:.1f}MiB")
+        index = search_index.SearchIndex.open(path, tree)
+
+        for mode, query in QUERIES:
+            with bench_utils.Timer() as timer:
+                results = index.search(query, mode)
+            truncated = "+" if results["truncated"] else ""
+            bench_utils.report(
+                f"{mode} {query} ({results['total']}{truncated})", timer.elapsed)
+
+
+if __name__ == "__main__":
+    main()
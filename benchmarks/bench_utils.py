@@ -0,0 +1,50 @@
+"""Shared setup for the benchmark scripts.
+
+The backend modules import each other (and `config`) as top-level modules, and
+`config` reads the environment at import time, so call `setup()` before importing them.
+"""
+import os
+import sys
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+backend_dir = os.path.join(repo_dir, "backend")
+
+
+def setup(**env):
+    """Load defaults from `.env`, apply overrides, and make the backend importable."""
+    with open(os.path.join(repo_dir, ".env")) as f:
+        for line in f:
+            key, separator, value = line.strip().partition("=")
+            if separator and not key.startswith("#"):
+                os.environ.setdefault(key, value.strip('"'))
+
+    for key in ("FROM_DISK_IMAGE_FILENAME", "TO_DISK_IMAGE_FILENAME",
+                "FROM_MEMORY_IMAGE_FILENAME", "TO_MEMORY_IMAGE_FILENAME"):
+        os.environ.setdefault(key, "")
+
+    os.environ.update(env)
+
+    sys.path.insert(0, repo_dir)
+    sys.path.insert(0, backend_dir)
+
+
+class Timer(object):
+    """Context manager measuring wall clock time."""
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.elapsed = None
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def report(name, elapsed, count=None, num_bytes=None):
+    parts = [f"{name:<40} {elapsed:8.3f}s"]
+    if count is not None:
+        parts.append(f"{count / elapsed:12.1f} items/s")
+    if num_bytes is not None:
+        parts.append(f"{num_bytes / elapsed / 1024 / 1024:10.1f} MiB/s")
+    print("  ".join(parts))
@@ -0,0 +1,130 @@
+"""Load test a running server: latency of /children and /diff under concurrent clients.
+
+Keys are discovered by walking the tree from /changed_files, then each client
+requests random keys until the test is over.
+
+Usage:
+    python benchmarks/load_test.py [--url http://localhost:5000] [--clients 16] [--duration 10] [--gzip] [--revalidate]
+"""
+import argparse
+import json
+import random
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent import futures
+
+
+def fetch(url, path, headers=None):
+    """
+    Returns:
+        tuple: (status, headers, body)
+    """
+    request = urllib.request.Request(url + path, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+def discover_keys(url, max_keys):
+    """Breadth first walk of the tree.
+
+    Returns:
+        tuple: (keys of nodes with children, keys of changed leaves)
+    """
+    _, _, body = fetch(url, "/changed_files")
+    pending = json.loads(body)
+    parents = []
+    leaves = []
+    while pending and len(parents) + len(leaves) < max_keys:
+        node = pending.pop(0)
+        if node["isLeaf"]:
+            if node["status"] != "unchanged":
+                leaves.append(node["key"])
+            continue
+        parents.append(node["key"])
+        _, _, body = fetch(
+            url, "/children?" + urllib.parse.urlencode({"key": node["key"]}))
+        pending.extend(json.loads(body))
+    return parents, leaves
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_client(url, endpoints, deadline, headers, revalidate, seed):
+    """Request random keys until the deadline.
+
+    Returns:
+        dict: endpoint -> list of (latency, status)
+    """
+    rng = random.Random(seed)
+    etags = {}
+    timings = {endpoint: [] for endpoint in endpoints}
+    while time.monotonic() < deadline:
+        endpoint = rng.choice(list(endpoints))
+        path = f"/{endpoint}?" + \
+            urllib.parse.urlencode({"key": rng.choice(endpoints[endpoint])})
+
+        request_headers = dict(headers)
+        if revalidate and path in etags:
+            request_headers["If-None-Match"] = etags[path]
+
+        start = time.perf_counter()
+        status, response_headers, _ = fetch(url, path, request_headers)
+        timings[endpoint].append((time.perf_counter() - start, status))
+
+        if response_headers.get("ETag"):
+            etags[path] = response_headers["ETag"]
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--keys", type=int, default=10000,
+                        help="maximum number of tree nodes to discover")
+    parser.add_argument("--gzip", action="store_true",
+                        help="accept gzipped responses")
+    parser.add_argument("--revalidate", action="store_true",
+                        help="send If-None-Match for keys already fetched")
+    args = parser.parse_args()
+
+    url = args.url.rstrip("/")
+    parents, leaves = discover_keys(url, args.keys)
+    print(f"{len(parents)} directories, {len(leaves)} changed files")
+    endpoints = {"children": parents, "diff": leaves}
+    endpoints = {endpoint: keys for endpoint, keys in endpoints.items() if keys}
+
+    headers = {"Accept-Encoding": "gzip"} if args.gzip else {}
+    deadline = time.monotonic() + args.duration
+    timings = {endpoint: [] for endpoint in endpoints}
+    with futures.ThreadPoolExecutor(max_workers=args.clients) as executor:
+        clients = [executor.submit(run_client, url, endpoints, deadline, headers, args.revalidate, seed)
+                   for seed in range(args.clients)]
+        for client in clients:
+            for endpoint, client_timings in client.result().items():
+                timings[endpoint].extend(client_timings)
+
+    print(f"{args.clients} clients, {args.duration:.0f}s")
+    for endpoint, endpoint_timings in timings.items():
+        if not endpoint_timings:
+            continue
+        latencies = [latency for latency, _ in endpoint_timings]
+        errors = sum(1 for _, status in endpoint_timings if status >= 400)
+        not_modified = sum(1 for _, status in endpoint_timings if status == 304)
+        print(f"/{endpoint:<10} {len(latencies) / args.duration:10.1f} req/s"
+              f"  p50 {percentile(latencies, 0.5) * 1000:8.2f}ms"
+              f"  p99 {percentile(latencies, 0.99) * 1000:8.2f}ms"
+              f"  304s {not_modified}  errors {errors}")
+
+
+if __name__ == "__main__":
+    main()
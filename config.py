@@ -20,6 +20,18 @@ def as_bool(var):
         f"Environment variable with value {var} is neither True nor False")
 
 
+def as_bytes(var):
+    """Parse a size like "500M" or "20G" (or a plain number of bytes)."""
+    if not var:
+        return 0
+
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    val = var.strip().upper().rstrip("B")
+    if val and val[-1] in units:
+        return int(float(val[:-1]) * units[val[-1]])
+    return int(val)
+
+
 # Read config vars dynamically fron environment (set in `.env`)
 diff_config_keys = [key for key in os.environ if key.startswith("DIFF_")]
 
@@ -48,6 +60,9 @@ FROM_DISK_IMAGE_FILENAME = os.environ.get(
 TO_DISK_IMAGE_FILENAME = os.environ.get(
     "TO_DISK_IMAGE_FILENAME")
 
+# "dfvfs" to read disk images, or "directory" to diff extracted or mounted snapshots on the host.
+DISK_LISTER = os.environ.get("DISK_LISTER") or "dfvfs"
+
 USE_DISK = False
 if FROM_DISK_IMAGE_FILENAME and TO_DISK_IMAGE_FILENAME and as_bool(os.environ.get("USE_DISK")):
     USE_DISK = True
@@ -55,6 +70,11 @@ if FROM_DISK_IMAGE_FILENAME and TO_DISK_IMAGE_FILENAME and as_bool(os.environ.ge
 
 USE_CACHE = as_bool(os.environ.get("USE_CACHE"))
 
+# "pack" to store diffs in one pack file per run with an index, or "mirror" for one file per diff.
+RESULTS_STORAGE = os.environ.get("RESULTS_STORAGE") or "pack"
+# "files" to export the static site's data as a JSON file per node, or "bundles" to pack it into gzipped bundles.
+STATIC_EXPORT_FORMAT = os.environ.get("STATIC_EXPORT_FORMAT") or "files"
+
 
 SNAPSHOT_DIR = os.environ.get(f"SNAPSHOT_DIR{dev}")
 
@@ -65,30 +85,57 @@ TO_DISK_PATH = os.path.join(SNAPSHOT_DIR, TO_DISK_IMAGE_FILENAME)
 FROM_MEMORY_IMAGE_FILENAME = os.environ.get("FROM_MEMORY_IMAGE_FILENAME")
 TO_MEMORY_IMAGE_FILENAME = os.environ.get("TO_MEMORY_IMAGE_FILENAME")
 
+# Fingerprints of the images (see backend/fingerprint.py), computed by the CLI where the images are.
+# Without them, caches fall back to being keyed by filename.
+FROM_DISK_FINGERPRINT = os.environ.get(
+    "FROM_DISK_FINGERPRINT") or FROM_DISK_IMAGE_FILENAME
+TO_DISK_FINGERPRINT = os.environ.get(
+    "TO_DISK_FINGERPRINT") or TO_DISK_IMAGE_FILENAME
+FROM_MEMORY_FINGERPRINT = os.environ.get(
+    "FROM_MEMORY_FINGERPRINT") or FROM_MEMORY_IMAGE_FILENAME
+TO_MEMORY_FINGERPRINT = os.environ.get(
+    "TO_MEMORY_FINGERPRINT") or TO_MEMORY_IMAGE_FILENAME
+
 USE_MEMORY = False
 
 if FROM_MEMORY_IMAGE_FILENAME and TO_MEMORY_IMAGE_FILENAME and as_bool(os.environ.get("USE_MEMORY")):
     USE_MEMORY = True
 
 RESULTS_DIR = os.environ[f"RESULTS_DIR{dev}"]
+# Volume scans of each image, keyed by image fingerprint.
+VOLUME_CACHE_PATH = os.path.join(RESULTS_DIR, "volumes")
+# Size RESULTS_DIR is kept under by evicting least recently used runs, e.g. "50G". 0 for no limit.
+RESULTS_BUDGET = as_bytes(os.environ.get("RESULTS_BUDGET"))
+# Runs the server keeps open at once, see backend/open_runs.py.
+SERVER_OPEN_RUNS = int(os.environ.get("SERVER_OPEN_RUNS") or 8)
+# Per-file diff components of each pair of images, shared by runs with different options.
+COMPONENT_CACHE_PATH = os.path.join(RESULTS_DIR, "components")
 REACT_BUILD_DIR = os.environ[f"REACT_BUILD_DIR{dev}"]
 
 LOG_LEVEL = logging.DEBUG if dev else logging.INFO
 
 
 def get_run_id():
+    # Ordered by option name, so each set of options gets its own bitfield.
     opts_bitfield = "".join(
-        ["1" if opt else "0" for opt in sorted(diff_config.values())])
+        ["1" if opt else "0" for _, opt in sorted(diff_config.items())])
 
     dir_opts = "".join(sorted(allow_dirs)) + "".join(sorted(ignore_dirs))
 
     config_str = opts_bitfield + dir_opts
+    # Other volumes, or another way of reading them, make other results. Only when they're not the
+    # defaults, so the runs cached before these were part of the ID keep theirs. (Partitions picked
+    # interactively aren't known yet: the volume cache offers the same choice again.)
+    if USE_DISK and PARTITION:
+        config_str += "partitions=" + ",".join(sorted(PARTITION.replace(" ", "").split(",")))
+    if USE_DISK and DISK_LISTER != "dfvfs":
+        config_str += "lister=" + DISK_LISTER
     config_hash = hashlib.sha1(config_str.encode()).hexdigest()[:10]
 
     if USE_DISK:
-        filename = f"{FROM_DISK_IMAGE_FILENAME}--{TO_DISK_IMAGE_FILENAME}--{config_hash}"
+        filename = f"{FROM_DISK_FINGERPRINT}--{TO_DISK_FINGERPRINT}--{config_hash}"
     else:
-        filename = f"{FROM_MEMORY_IMAGE_FILENAME}--{TO_MEMORY_IMAGE_FILENAME}--{config_hash}"
+        filename = f"{FROM_MEMORY_FINGERPRINT}--{TO_MEMORY_FINGERPRINT}--{config_hash}"
 
     return filename
 
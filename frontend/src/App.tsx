@@ -5,7 +5,7 @@ import { FolderOutlined, ExperimentOutlined } from '@ant-design/icons';
 
 import type { DataNode } from 'antd/es/tree';
 
-import { Tree, Layout } from 'antd';
+import { Button, Tree, Layout } from 'antd';
 
 import { Typography, Space } from 'antd';
 
@@ -40,6 +40,12 @@ let BASE_URL = ""
 // It's always a demo, though.
 if (DEMO) {
   BASE_URL = window.location.pathname + "json";
+} else {
+  // ?run=<run ID> views another run in RESULTS_DIR (see /runs), rather than the server's own.
+  const run = new URLSearchParams(window.location.search).get("run");
+  if (run) {
+    BASE_URL = `/runs/${encodeURIComponent(run)}`;
+  }
 }
 
 
@@ -55,44 +61,194 @@ const initTreeData: DiffNode[] = [];
 const getInitTreeData = (): Promise<DiffNode[]> => {
 
   return fetch(BASE_URL + "/changed_files").then((response) => {
-    return response.json()
+    // Nothing's been published yet while a run starts (503).
+    return response.ok ? response.json() : []
   });
 }
 
-const getChildrenData = (key: React.Key): Promise<DiffNode[]> => {
+// Progress of a run that's still in progress, from the server's /events.
+type RunProgress = {
+  listed: number,
+  compared: number,
+  diffed: number,
+  changed: number,
+  totals: Record<string, number>,
+  generation: number,
+  done: boolean
+};
 
-  if (DEMO) {
-    const hasher = sha1(String(key))
+const formatProgress = (progress: RunProgress): string => {
+  const count = (counter: "compared" | "diffed") => {
+    const total = progress.totals[counter]
+    return total === undefined ? `${progress[counter]}` : `${progress[counter]}/${total}`
+  }
+  return `Listed ${progress.listed}, compared ${count("compared")}, diffed ${count("diffed")}, ${progress.changed} changes`
+}
+
+type BundleManifest = {
+  version: number,
+  compression: string,
+  prefixLength: number,
+  numBundles: number
+};
+
+// [bundle, offset, length] of a node's gzipped JSON, by hash.
+type BundleIndex = {
+  children: { [hash: string]: [number, number, number] },
+  subtree: { [hash: string]: [number, number, number] },
+  diff: { [hash: string]: [number, number, number] }
+};
 
-    return hasher.then((hash) => {
-      return fetch(BASE_URL + `/children/` + hash).then((response) => {
+let bundleManifest: Promise<BundleManifest | null> | null = null;
+const bundleIndexes = new Map<string, Promise<BundleIndex>>();
+
+// Bundled exports have a manifest, otherwise there's a file per node.
+const getBundleManifest = (): Promise<BundleManifest | null> => {
+  if (bundleManifest === null) {
+    bundleManifest = fetch(BASE_URL + "/bundles/manifest.json").then((response) => {
+      return response.ok ? response.json() : null
+    }).catch(() => null);
+  }
+  return bundleManifest
+}
+
+const getBundleIndex = (prefix: string): Promise<BundleIndex> => {
+  let index = bundleIndexes.get(prefix)
+  if (index === undefined) {
+    index = fetch(BASE_URL + `/bundles/index/${prefix}.json`).then((response) => {
+      return response.json()
+    });
+    bundleIndexes.set(prefix, index)
+  }
+  return index
+}
+
+// Fetch the export of one node, from its own file, or from its range of a bundle.
+const getStaticData = (kind: "children" | "subtree" | "diff", key: React.Key): Promise<any> => {
+  return Promise.all([sha1(String(key)), getBundleManifest()]).then(([hash, manifest]) => {
+    if (manifest === null) {
+      return fetch(BASE_URL + `/${kind}/` + hash).then((response) => {
         return response.json()
       });
+    }
+
+    return getBundleIndex(hash.slice(0, manifest.prefixLength)).then((index) => {
+      const entry = index[kind][hash]
+      if (entry === undefined) {
+        throw new Error(`No ${kind} for ${key}`)
+      }
+      const [bundle, offset, length] = entry
+
+      return fetch(BASE_URL + `/bundles/${bundle}.bundle`, {
+        headers: { Range: `bytes=${offset}-${offset + length - 1}` }
+      }).then((response) => {
+        return response.arrayBuffer().then((buffer) => {
+          // Servers without range support send the whole bundle.
+          return response.status === 206 ? buffer : buffer.slice(offset, offset + length)
+        })
+      }).then((buffer) => {
+        const stream = new Blob([buffer]).stream().pipeThrough(new (window as any).DecompressionStream("gzip"))
+        return new Response(stream).json()
+      });
     });
+  });
+}
+
+// One page of the children of a node, in name order.
+type ChildrenPage = {
+  children: DiffNode[],
+  total: number,
+  nextCursor: string | null
+};
+
+const PAGE_SIZE = 1000
+
+// Key of a page in the static export (see compact_tree.get_page_key); the first page has the node's key.
+const getPageKey = (key: React.Key, cursor: string | null): string => {
+  return cursor === null ? String(key) : `${key}\0name\0${cursor}`
+}
+
+// Resolves to null if the tree has changed since the cursor was made, to list the children again.
+const getChildrenPage = (key: React.Key, cursor: string | null): Promise<ChildrenPage | null> => {
+
+  if (DEMO) {
+    return getStaticData("children", getPageKey(key, cursor)).then((data) => {
+      // Exports from before pagination have the whole list.
+      return Array.isArray(data) ? { children: data, total: data.length, nextCursor: null } : data
+    })
 
   } else {
-    return fetch(BASE_URL + `/children?` + new URLSearchParams({
-      key: String(key)
-    })).then((response) => {
+    const params: Record<string, string> = { key: String(key), limit: String(PAGE_SIZE) }
+    if (cursor !== null) {
+      params.cursor = cursor
+    }
+    return fetch(BASE_URL + `/children?` + new URLSearchParams(params)).then((response) => {
+      if (response.status === 409) {
+        return null
+      }
       return response.json()
     });
   }
 }
-const getDiffString = (key: React.Key): Promise<string[]> => {
+// Several levels below a node, descending into changed directories only; children is null
+// if the node has too many children for one response.
+type Subtree = {
+  children: DiffNode[] | null,
+  numNodes: number,
+  truncated: boolean
+};
+
+const SUBTREE_DEPTH = 3
+
+const getSubtree = (key: React.Key): Promise<Subtree | null> => {
 
   if (DEMO) {
-    const hasher = sha1(String(key))
+    // Exports from before subtrees don't have them.
+    return getStaticData("subtree", key).catch(() => null)
 
-    return hasher.then((hash) => {
-      return fetch(BASE_URL + `/diff/` + hash).then((response) => {
-        return response.json()
-      });
+  } else {
+    return fetch(BASE_URL + `/subtree?` + new URLSearchParams({
+      key: String(key),
+      depth: String(SUBTREE_DEPTH),
+      changed: "true"
+    })).then((response) => {
+      return response.ok ? response.json() : null
     });
+  }
+}
+
+// A window of a diff's lines, which is a diff on its own, and the whole diff's statistics.
+type DiffWindow = {
+  lines: string[],
+  start: number,
+  end: number,
+  stats: {
+    lines: number,
+    // Unknown for static exports from before they had stats.
+    hunks?: number,
+    linesAdded?: number,
+    linesRemoved?: number
+  }
+};
+
+const DIFF_WINDOW_SIZE = 5000
+
+const getDiffWindow = (key: React.Key, start: number): Promise<DiffWindow> => {
+
+  if (DEMO) {
+    // Exported diffs are whole, with their stats (exports from before the stats are just the lines).
+    return getStaticData("diff", key).then((diff: string[] | { lines: string[], stats: DiffWindow["stats"] }) => {
+      const lines = Array.isArray(diff) ? diff : diff.lines
+      const stats = Array.isArray(diff) ? { lines: lines.length } : diff.stats
+      return { lines: lines, start: 0, end: lines.length, stats: stats }
+    })
 
   } else {
 
     return fetch(BASE_URL + `/diff?` + new URLSearchParams({
-      key: String(key)
+      key: String(key),
+      lines: `${start}-`,
+      limit: String(DIFF_WINDOW_SIZE)
     })).then((response) => {
       return response.json()
     });
@@ -150,22 +306,19 @@ function updateTreeData(
   });
 }
 
-const getDiffHtml = (key: React.Key): Promise<string> => {
+const getDiffHtml = (diffLines: string[]): string => {
 
-  return getDiffString(key).then((diffLines) => {
-
-    const unifiedDiffString = diffLines.join("");
-    const diffHtml = Diff2Html.html(
-      unifiedDiffString,
-      {
-        drawFileList: false,
-        matching: "lines",
-        outputFormat: "line-by-line",
-        renderNothingWhenEmpty: false
-      }
-    );
-    return diffHtml
-  })
+  const unifiedDiffString = diffLines.join("");
+  const diffHtml = Diff2Html.html(
+    unifiedDiffString,
+    {
+      drawFileList: false,
+      matching: "lines",
+      outputFormat: "line-by-line",
+      renderNothingWhenEmpty: false
+    }
+  );
+  return diffHtml
 
 }
 
@@ -175,9 +328,18 @@ const App: React.FC = () => {
   const [, setLoadedKeys] = useState<React.Key[]>([]);
   const [autoExpandParent, setAutoExpandParent] = useState(true);
   const [diff, setDiff] = useState("");
+  // The selected diff, and how far into it has been shown.
+  const [diffKey, setDiffKey] = useState<React.Key | null>(null);
+  const [diffEnd, setDiffEnd] = useState(0);
+  const [diffLength, setDiffLength] = useState(0);
   const [collapsed, setCollapsed] = useState(true);
 
-  useEffect(() => {
+  // The run's progress while it's in progress, and the generation of the results shown.
+  const [runProgress, setRunProgress] = useState<RunProgress | null>(null);
+  const [shownGeneration, setShownGeneration] = useState(0);
+
+  const loadTree = (generation: number) => {
+    setShownGeneration(generation)
     getInitTreeData().then((data) => {
       cache(data)
       iconifyAll()
@@ -208,8 +370,41 @@ const App: React.FC = () => {
       setLoadedKeys(newLoadedKeys)
       setTreeData(data)
     })
+  }
+
+  useEffect(() => {
+    loadTree(0)
+
+    if (DEMO) {
+      return
+    }
+    const events = new EventSource(BASE_URL + "/events")
+    events.addEventListener("progress", (event) => {
+      const progress: RunProgress = JSON.parse((event as MessageEvent).data)
+      setRunProgress(progress)
+      if (progress.done) {
+        // Otherwise it reconnects when the server ends the stream.
+        events.close()
+      }
+    })
+    return () => events.close()
+    // eslint-disable-next-line react-hooks/exhaustive-deps
   }, []);
 
+  // Show the first results as soon as they're published; after that, wait to be asked, so the tree doesn't change under the user.
+  useEffect(() => {
+    if (runProgress === null || runProgress.generation <= shownGeneration || treeData === undefined) {
+      return
+    }
+    if (treeData.length === 0) {
+      loadTree(runProgress.generation)
+    } else if (shownGeneration === 0) {
+      // Loaded before the first progress arrived.
+      setShownGeneration(runProgress.generation)
+    }
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [runProgress, treeData]);
+
 
 
   const onExpand = (expandedKeys: React.Key[], { node }: { expanded: boolean, node: DiffNode }): any => {
@@ -250,12 +445,23 @@ const App: React.FC = () => {
   const onSelect = (selectedKeys: React.Key[]): any => {
     const key = selectedKeys[0];
 
-    getDiffHtml(key).then((html) => {
-      setDiff(html);
+    getDiffWindow(key, 0).then((diffWindow) => {
+      setDiffKey(key);
+      setDiffEnd(diffWindow.end);
+      setDiffLength(diffWindow.stats.lines);
+      setDiff(getDiffHtml(diffWindow.lines));
     });
 
   }
 
+  const onShowMore = () => {
+    const key = diffKey!;
+    getDiffWindow(key, diffEnd).then((diffWindow) => {
+      setDiffEnd(diffWindow.end);
+      setDiff(prev => prev + getDiffHtml(diffWindow.lines));
+    });
+  }
+
 
 
   const onLoadData = ({ key, children }: any) =>
@@ -268,18 +474,53 @@ const App: React.FC = () => {
       }
 
       setTimeout(() => {
-        // Load the children of this node.
-        getChildrenData(key).then((children) => {
+        // Expand the children that should be, including ones that came with their own children.
+        const autoExpand = (nodes: DiffNode[]) => {
+          nodes.forEach((child) => {
+            if (!child.isLeaf && shouldAutoExpand(child.key)) {
+              expand(child.key);
+              if (child.children) {
+                autoExpand(child.children)
+              }
+            }
+          })
+        }
+
+        // Load the children of this node, showing each page as it arrives.
+        const loadPage = (cursor: string | null, loaded: DiffNode[]) => {
+          getChildrenPage(key, cursor).then((page) => {
+            if (page === null) {
+              // A run in progress published another tree, start over from the first page.
+              loadPage(null, [])
+              return
+            }
+            const children = loaded.concat(page.children)
+            cache(page.children)
+            setTreeData(origin =>
+              origin === undefined ? undefined :
+                updateTreeData(origin, key, children)
+            );
+            autoExpand(page.children)
+            if (page.nextCursor !== null) {
+              loadPage(page.nextCursor, children)
+            }
+            resolve();
+          })
+        }
+
+        // Prefetch a few levels of changed directories in one request, falling back to pages of children.
+        getSubtree(key).then((subtree) => {
+          if (subtree === null || subtree.children === null) {
+            loadPage(null, [])
+            return
+          }
+          const children = subtree.children
           cache(children)
           setTreeData(origin =>
             origin === undefined ? undefined :
               updateTreeData(origin, key, children)
           );
-          children.forEach((child) => {
-            if (!child.isLeaf && shouldAutoExpand(child.key)) {
-              expand(child.key);
-            }
-          })
+          autoExpand(children)
           resolve();
         })
         resolve();
@@ -341,6 +582,12 @@ const App: React.FC = () => {
             </Space>
           </Title>
         </Typography>
+        {runProgress !== null && !runProgress.done ? <Typography.Text style={{ color: "#fff" }}>
+          {formatProgress(runProgress)}
+        </Typography.Text> : null}
+        {runProgress !== null && runProgress.generation > shownGeneration && shownGeneration > 0 ? <Button onClick={() => loadTree(runProgress.generation)}>
+          Load latest results
+        </Button> : null}
       </Space >
 
     </Header >
@@ -384,6 +631,9 @@ const App: React.FC = () => {
         <div className="site-layout-background" style={{ padding: 24, textAlign: 'center' }}>
           <div id="code-diff" dangerouslySetInnerHTML={{ __html: diff }}>
           </div>
+          {diffEnd < diffLength ? <Button onClick={onShowMore}>
+            Show more ({diffEnd} of {diffLength} lines)
+          </Button> : null}
         </div>
       </Content>
     </Layout>
@@ -0,0 +1,14 @@
+# Production server settings, read by gunicorn when it starts server:app (see Dockerfile).
+import multiprocessing
+import os
+
+bind = "0.0.0.0:5000"
+
+# Workers share the memory mapped tree index through the page cache, so they're cheap.
+workers = int(os.environ.get("SERVER_WORKERS") or multiprocessing.cpu_count() * 2 + 1)
+# Threads per worker, so slow requests (large diffs) don't hold up the rest.
+worker_class = "gthread"
+threads = int(os.environ.get("SERVER_THREADS") or 4)
+
+timeout = 120
+keepalive = 5
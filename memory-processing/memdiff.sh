@@ -6,7 +6,8 @@ fi
 
 PLUGINS=$MEMORY_PLUGINS
 
-RUN_NAME="${FROM_MEMORY_IMAGE_FILENAME}__${TO_MEMORY_IMAGE_FILENAME}"
+# Keyed by image fingerprint (set by the CLI), so renamed or re-exported images don't mix up results.
+RUN_NAME="${FROM_MEMORY_FINGERPRINT:-$FROM_MEMORY_IMAGE_FILENAME}__${TO_MEMORY_FINGERPRINT:-$TO_MEMORY_IMAGE_FILENAME}"
 RUN_DIR="/results/memory/$RUN_NAME"
 FROM_OUTPUT_PATH_TEMPLATE="$RUN_DIR/from"
 TO_OUTPUT_PATH_TEMPLATE="$RUN_DIR/to"
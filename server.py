@@ -1,11 +1,16 @@
+import collections
+import gzip
+import hashlib
 import inspect
 import os
+import re
 import sys
+import threading
 import time
 
 import logging
 
-from flask import Flask, jsonify, request, render_template, send_from_directory
+from flask import Flask, Response, abort, g, request, render_template, send_from_directory
 
 import config
 
@@ -21,9 +26,13 @@ if config.dev:
     vmdiff.Main()
 
 try:
-    import diffcache  # noqa
+    import compact_tree  # noqa
+    import open_runs  # noqa
+    import search_index  # noqa
 except ImportError:
-    from backend import diffcache
+    from backend import compact_tree
+    from backend import open_runs
+    from backend import search_index
 
 
 REACT_BUILD_DIR = config.REACT_BUILD_DIR
@@ -31,76 +40,386 @@ REACT_BUILD_DIR = config.REACT_BUILD_DIR
 app = Flask(
     __name__, static_folder=f"{REACT_BUILD_DIR}/static", template_folder=f"{REACT_BUILD_DIR}")
 
-logging.info(f"Waiting for results at {config.RUN_TREE_PATH}....")
-
 if not os.path.exists(config.RUN_TREE_PATH):
-    logging.critical(
-        f"No results found at {config.RUN_TREE_PATH}. Generate results first?")
-    sys.exit(1)
+    # Served as they're published, see get_tree.
+    logging.warning(
+        f"No results at {config.RUN_TREE_PATH} yet, waiting for them to be generated.")
 
-cache = diffcache.DiffCache(
-    config.RUN_DISK_PATH, config.RUN_TREE_PATH, config.RUN_MEMORY_PATH)
-while True:
-    try:
-        tree, children_map = cache.get_tree_data_from_cache()
-        break
-    except FileNotFoundError:
-        time.sleep(3)
+# Every run in RESULTS_DIR can be served, at /runs/<run ID>/..., opened when it's first asked for.
+runs = open_runs.OpenRuns(config.RESULTS_DIR, config.RESULTS_STORAGE, config.SERVER_OPEN_RUNS)
+# This run is also served without the prefix, and kept open so it isn't evicted while it's served.
+runs.pin(config.RUN_ID)
 
 
-logging.debug(f"Tree: {len(tree)}, children: {len(children_map)}")
+@app.url_value_preprocessor
+def pop_run_id(endpoint, values):
+    g.run_id = values.pop("run_id", None) if values else None
 
 
-@app.route("/children")
-def get_children_handler():
-    key = request.args.get("key")
+def run_route(rule):
+    """Route rule to the server's run, and /runs/<run_id> + rule to any run in RESULTS_DIR."""
+    def decorator(f):
+        app.add_url_rule(f"/runs/<run_id>{rule}", view_func=f)
+        return app.route(rule)(f)
+    return decorator
 
-    node_children = children_map[key]
-    response = jsonify(node_children)
-    response.headers.add('Access-Control-Allow-Origin', '*')
 
-    return response
+def get_run():
+    """
+    Returns:
+        open_runs.OpenRun: the run the request is for.
+    """
+    run = runs.get(g.get("run_id") or config.RUN_ID)
+    if run is None:
+        abort(404, f"No run {g.run_id}")
+    return run
 
 
-@app.route("/diff")
-def get_diff():
+def get_tree():
+    """The run's tree; until it's been written, tell the client to retry."""
+    return get_versioned_tree()[0]
 
-    key = request.args.get("key")
 
-    diff = cache.get_diff(key)
-    if diff is None:
-        logging.warning(f"No diff found for {key}")
-        result = None
+def get_versioned_tree():
+    """The run's tree and its version, see OpenRun.get_versioned_tree."""
+    run = get_run()
+    try:
+        return run.get_versioned_tree()
+    except FileNotFoundError:
+        logging.info(f"Waiting for results at {run.cache.tree_path}....")
+        abort(503)
+
+
+def get_search_index():
+    # Waits for the tree as get_tree does.
+    get_tree()
+    return get_run().get_search_index()
+
+
+def get_grep_index():
+    diff_index = get_run().get_grep_index()
+    if diff_index is None:
+        abort(404, "No index of the diffs, run vmdiff on this run again to index them")
+    return diff_index
+
+
+# Largest page of children a client can ask for.
+MAX_PAGE_SIZE = 10000
+MAX_SUBTREE_DEPTH = 32
+MAX_SUBTREE_BUDGET = 10000
+DEFAULT_SEARCH_LIMIT = 100
+# Lines of a diff per window, unless the client asks for fewer.
+MAX_DIFF_WINDOW = 10000
+MAX_SEARCH_LIMIT = 1000
+# Responses smaller than this aren't worth compressing.
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+# Number of gzipped bodies kept, so popular responses are only compressed once per worker.
+COMPRESSED_CACHE_SIZE = 1024
+# Seconds between checking the progress of a run in progress, for /events.
+PROGRESS_POLL_INTERVAL = 1
+# Seconds between comments sent on an idle event stream, so proxies don't close it.
+EVENTS_KEEPALIVE = 15
+# Seconds an event stream is served before it's closed, so it doesn't hold a worker thread for the
+# whole run; EventSource reconnects after EVENTS_RETRY milliseconds and is sent the progress again.
+EVENTS_MAX_DURATION = 60
+EVENTS_RETRY = 5000
+
+compressed_bodies = collections.OrderedDict()
+compressed_bodies_lock = threading.Lock()
+
+
+def get_etag(*parts):
+    """A strong ETag for a response of the request's run. A run's results only change when a run in
+    progress publishes another tree (another diff gets another run ID), so the run ID, the tree's
+    version (which callers include in parts) and the request identify the body.
+    """
+    return hashlib.sha1("\0".join((get_run().run_id,) + parts).encode("utf8")).hexdigest()
+
+
+def get_compressed_body(etag, body):
+    with compressed_bodies_lock:
+        compressed = compressed_bodies.get(etag)
+        if compressed is not None:
+            compressed_bodies.move_to_end(etag)
+            return compressed
+
+    compressed = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    with compressed_bodies_lock:
+        compressed_bodies[etag] = compressed
+        if len(compressed_bodies) > COMPRESSED_CACHE_SIZE:
+            compressed_bodies.popitem(last=False)
+    return compressed
+
+
+def json_response(get_data, *etag_parts):
+    """Serve the JSON of get_data(), unless the client already has it, gzipped if the client accepts it.
+
+    Args:
+        get_data (callable): produces the data, only called if the body is needed.
+        etag_parts (str): what identifies the data within the run, besides the request path.
+    """
+    # Responses change when a run in progress publishes another tree.
+    etag = get_etag(request.path, get_run().get_tree_version(), *etag_parts)
+    use_gzip = "gzip" in request.accept_encodings
+    # The gzipped body is another representation, so it gets its own ETag.
+    response_etag = f"{etag}-gz" if use_gzip else etag
+
+    if request.if_none_match.contains(response_etag):
+        response = Response(status=304)
     else:
-        result = diff.diff_lines
-
-    response = jsonify(result)
+        body = app.json.dumps(get_data()).encode("utf8")
+        if use_gzip and len(body) >= MIN_COMPRESS_SIZE:
+            response = Response(get_compressed_body(
+                etag, body), mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response_etag = etag
+            response = Response(body, mimetype="application/json")
+
+    response.set_etag(response_etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Vary"] = "Accept-Encoding"
     response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+
+@run_route("/children")
+def get_children_handler():
+    """Children of a node: all of them as a list, or if any of sort, cursor or limit are given,
+    one page of them as {children, total, nextCursor}.
+
+    Cursors are only valid for the tree they were made from: once a run in progress publishes
+    another one, they're rejected with 409 Conflict, for the client to list the children again.
+    """
+    key = request.args.get("key", "")
+    sort = request.args.get("sort", "name")
+    cursor = request.args.get("cursor")
+    limit = request.args.get("limit")
+    paged = sort != "name" or cursor is not None or limit is not None
+
+    if sort not in compact_tree.SORTS:
+        abort(400, f"sort must be one of {compact_tree.SORTS}")
+    # "<tree version>:<offset>", see children_page.
+    cursor_version, _, offset = (cursor or "").rpartition(":")
+    try:
+        limit = min(int(limit or compact_tree.PAGE_SIZE), MAX_PAGE_SIZE)
+        if cursor is not None and int(offset) < 0 or limit < 1:
+            raise ValueError
+    except ValueError:
+        abort(400, "cursor and limit must be positive numbers")
+
+    def get_children():
+        tree, version = get_versioned_tree()
+        node = tree.find(key)
+        if node is None:
+            abort(404)
+        if not paged:
+            return tree.children_json(node)
+        if cursor is not None and cursor_version != version:
+            abort(409, "The tree has changed since the cursor was made, list the children again")
+        page = tree.children_page(node, sort, offset or None, limit)
+        if page["nextCursor"] is not None:
+            page["nextCursor"] = f"{version}:{page['nextCursor']}"
+        return page
+
+    if not paged:
+        return json_response(get_children, key)
+    return json_response(get_children, key, sort, cursor or "", str(limit))
+
+
+@run_route("/subtree")
+def get_subtree():
+    """Several levels of children at once: depth levels below key, descending only into changed
+    children if changed is true, up to budget nodes (see CompactTree.subtree_json).
+    """
+    key = request.args.get("key", "")
+    changed_only = request.args.get("changed", "false").lower() == "true"
+    try:
+        depth = min(int(request.args.get("depth", compact_tree.SUBTREE_DEPTH)), MAX_SUBTREE_DEPTH)
+        budget = min(int(request.args.get("budget", compact_tree.SUBTREE_BUDGET)), MAX_SUBTREE_BUDGET)
+        if depth < 1 or budget < 1:
+            raise ValueError
+    except ValueError:
+        abort(400, "depth and budget must be positive numbers")
+
+    def get_subtree_data():
+        tree = get_tree()
+        node = tree.find(key)
+        if node is None:
+            abort(404)
+        return tree.subtree_json(node, depth, changed_only, budget)
+
+    return json_response(get_subtree_data, key, str(depth), str(changed_only), str(budget))
+
+
+@run_route("/search")
+def search():
+    """Changed files and processes matching q, best first: ?q=&mode=substring|glob|regex&limit="""
+    query = request.args.get("q", "")
+    mode = request.args.get("mode", "substring")
+    if mode not in search_index.SEARCH_MODES:
+        abort(400, f"mode must be one of {search_index.SEARCH_MODES}")
+    try:
+        limit = min(int(request.args.get("limit", DEFAULT_SEARCH_LIMIT)), MAX_SEARCH_LIMIT)
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        abort(400, "limit must be a positive number")
+
+    def get_results():
+        try:
+            return get_search_index().search(query, mode, limit)
+        except re.error as e:
+            abort(400, f"Invalid regex: {e}")
+
+    return json_response(get_results, query, mode, str(limit))
+
 
-    # to start with, just return the directories, and let the user expand out the files.
+@run_route("/grep")
+def grep():
+    """Changed files and processes with added or removed lines containing q, and where: ?q=&limit="""
+    query = request.args.get("q", "")
+    try:
+        limit = min(int(request.args.get("limit", DEFAULT_SEARCH_LIMIT)), MAX_SEARCH_LIMIT)
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        abort(400, "limit must be a positive number")
+
+    def get_results():
+        try:
+            return get_grep_index().search(query, get_run().cache.get_diff_lines, limit)
+        except ValueError as e:
+            abort(400, str(e))
+
+    return json_response(get_results, query, str(limit))
+
+
+def get_range(name):
+    """A range argument "start-end" (or "start-", to the end) as (start, end), or None if it's not given."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    match = re.fullmatch(r"(\d+)-(\d*)", value)
+    if match is None:
+        abort(400, f"{name} must be a range like 0-100, or 100- for the rest")
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else None
+    if end is not None and end < start:
+        abort(400, f"{name} must end after it starts")
+    return start, end
+
+
+@run_route("/diff")
+def get_diff():
+    """A diff's lines: all of them as a list, or if lines or hunks (ranges of them) are given,
+    a window of them with the diff's statistics, see unified_diff.get_window: ?key=&lines=|hunks=&limit=
+    """
+    key = request.args.get("key", "")
+    lines = get_range("lines")
+    hunks = get_range("hunks")
+    if lines is not None or hunks is not None:
+        if lines is not None and hunks is not None:
+            abort(400, "Give either lines or hunks, not both")
+        try:
+            limit = min(int(request.args.get("limit", MAX_DIFF_WINDOW)), MAX_DIFF_WINDOW)
+            if limit < 1:
+                raise ValueError
+        except ValueError:
+            abort(400, "limit must be a positive number")
+        start, end = hunks or lines
+
+        def get_diff_window():
+            window = get_run().cache.get_diff_window(key, start, end, by_hunk=hunks is not None, max_lines=limit)
+            if window is None:
+                abort(404)
+            return window
+
+        return json_response(get_diff_window, key, "hunks" if hunks else "lines",
+                             str(start), str(end), str(limit))
+
+    def get_diff_lines():
+        # Serve the lines as stored, there's no need to parse them into a UnifiedDiff.
+        diff_lines = get_run().cache.get_diff_lines(key)
+        if diff_lines is None:
+            logging.warning(f"No diff found for {key}")
+        return diff_lines
+
+    return json_response(get_diff_lines, key)
+
+
+@run_route("/progress")
+def get_progress_handler():
+    """Progress of the run: paths listed, compared, diffed and changes found so far, the totals
+    known so far, the generation of the published results, and whether the run is done.
+    """
+    response = app.json.response(get_run().get_progress())
+    response.headers["Cache-Control"] = "no-store"
+    response.headers.add('Access-Control-Allow-Origin', '*')
     return response
 
 
-@app.route("/changed_files")
-def get_changed_files():
-    response = jsonify(tree)
+@run_route("/events")
+def get_events():
+    """Server-Sent Events of the run's progress: a "progress" event (as /progress) whenever it changes, until it's done.
+
+    Each stream is closed after EVENTS_MAX_DURATION, and the client reconnects to carry on.
+    """
+    run = get_run()
+
+    def stream():
+        last_progress = None
+        started = last_sent = time.monotonic()
+        yield f"retry: {EVENTS_RETRY}\n\n"
+        while time.monotonic() - started < EVENTS_MAX_DURATION:
+            run_progress = run.get_progress()
+            if run_progress != last_progress:
+                yield f"event: progress\ndata: {app.json.dumps(run_progress)}\n\n"
+                last_progress = run_progress
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= EVENTS_KEEPALIVE:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            if run_progress["done"]:
+                return
+            time.sleep(PROGRESS_POLL_INTERVAL)
+
+    response = Response(stream(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-store"
+    # Don't let a reverse proxy hold the events back.
+    response.headers["X-Accel-Buffering"] = "no"
     response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
 
+@run_route("/changed_files")
+def get_changed_files():
     # To start with, just return the directories, and let the user expand out the files.
-    return response
+    return json_response(lambda: get_tree().tree_json())
 
 
-@app.route("/json/<path:path>")
+@run_route("/json/<path:path>")
 def json(path):
-    json_dir = f"{cache.tree_path}/json"
+    json_dir = f"{get_run().cache.tree_path}/json"
     return send_from_directory(json_dir, path)
 
 
-@app.route("/")
+@app.route("/runs")
+def get_runs():
+    """The runs in RESULTS_DIR, most recently used first, see OpenRuns.list; ?run=<id> to view one."""
+    response = app.json.response(runs.list())
+    response.headers["Cache-Control"] = "no-store"
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+
+@run_route("/")
 def index():
     return render_template("index.html")
 
 
 if __name__ == "__main__":
 
-    app.run("0.0.0.0", debug=True)
+    # Development only: in production, server:app is run by gunicorn (see gunicorn.conf.py).
+    app.run("0.0.0.0", debug=bool(config.dev), threaded=True)
@@ -0,0 +1,142 @@
+import array
+
+import pytest
+
+import compact_tree
+from compact_tree import CompactTree
+
+
+def build_tree(root_key, paths):
+    """A tree of one root and a file node for each path below it, with their parent directories."""
+    keys = [root_key]
+    children = [[]]
+    nodes = {root_key: 0}
+    is_dirs = [True]
+    statuses = ["unchanged"]
+    lines_added = [0]
+    for path in paths:
+        parent = root_key
+        parts = path.split("/")
+        for depth, part in enumerate(parts):
+            key = f"{parent}/{part}"
+            if key not in nodes:
+                is_file = depth == len(parts) - 1
+                nodes[key] = len(keys)
+                keys.append(key)
+                children.append([])
+                is_dirs.append(not is_file)
+                statuses.append("modified" if is_file else "unchanged")
+                lines_added.append(len(key) if is_file else 0)
+                children[nodes[parent]].append(nodes[key])
+            parent = key
+
+    titles = [key.rsplit("/", 1)[-1] for key in keys]
+    return CompactTree.build(
+        [0], children, keys, titles, statuses, is_dirs, lines_added, [1] * len(keys), [2] * len(keys))
+
+
+def get_subtree_keys(tree, node):
+    """Keys of a node and its descendants, each with its parent's key, following the tree's links."""
+    found = {}
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        parent = tree.parent[node]
+        found[tree.get_key(node)] = tree.get_key(parent) if parent != compact_tree.NO_PARENT else None
+        stack.extend(tree.get_children(node))
+    return found
+
+
+def test_sections_round_trip(tmp_path):
+    sections = [
+        ("small", array.array("B", [1, 2, 3])),
+        ("numbers", array.array("I", [0, 1, 2 ** 32 - 1])),
+        ("big", array.array("Q", [2 ** 63])),
+        ("signed", array.array("i", [-1, 5])),
+        ("empty", array.array("I")),
+        ("blob", "naïve\0text".encode("utf8")),
+    ]
+    path = tmp_path / "test.bin"
+    compact_tree.write_sections(path, b"TESTFILE", 42, sections)
+
+    typecodes = {name: data.typecode for name, data in sections if isinstance(data, array.array)}
+    for buffer in (path.read_bytes(), compact_tree.map_file(path)):
+        num_items, read = compact_tree.read_sections(buffer, b"TESTFILE", typecodes)
+        assert num_items == 42
+        assert set(read) == {name for name, _ in sections}
+        for name, data in sections:
+            assert read[name].tolist() == list(data)
+        # No temporary file is left behind.
+        assert [p.name for p in tmp_path.iterdir()] == ["test.bin"]
+
+
+def test_sections_are_aligned(tmp_path):
+    path = tmp_path / "test.bin"
+    compact_tree.write_sections(path, b"TESTFILE", 0, [
+        ("odd", b"abc"), ("numbers", array.array("Q", [7])), ("more", b"de")])
+
+    data = path.read_bytes()
+    for index in range(3):
+        _, offset, _ = compact_tree._SECTION.unpack_from(
+            data, compact_tree._HEADER.size + index * compact_tree._SECTION.size)
+        # So arrays can be cast in place.
+        assert offset % compact_tree._ALIGNMENT == 0
+
+
+def test_sections_other_magic_rejected(tmp_path):
+    path = tmp_path / "test.bin"
+    compact_tree.write_sections(path, b"TESTFILE", 0, [("numbers", array.array("I", [1]))])
+
+    with pytest.raises(ValueError):
+        compact_tree.read_sections(path.read_bytes(), b"OTHERONE", {"numbers": "I"})
+
+
+def test_tree_save_open_round_trip(tmp_path):
+    tree = build_tree("C:", ["Windows/a.txt", "Windows/System32/b.dll", "Users/c.txt"])
+    tree.save(tmp_path / "tree.bin")
+
+    opened = CompactTree.open(tmp_path / "tree.bin")
+
+    assert len(opened) == len(tree)
+    assert opened.tree_json() == tree.tree_json()
+    assert opened.get_children_map() == tree.get_children_map()
+
+
+def test_merge_offsets_indices_of_other_tree():
+    disk = build_tree("C:", ["Windows/a.txt", "Windows/System32/b.dll", "Users/c.txt"])
+    memory = build_tree("Processes", ["4/100", "4/101/102", "200"])
+
+    merged = disk.merge(memory)
+
+    assert len(merged) == len(disk) + len(memory)
+    assert list(merged.roots) == [0, len(disk)]
+    assert merged.tree_json() == disk.tree_json() + memory.tree_json()
+
+    # Both trees' links (parents, first children, child counts) still lead to the same nodes.
+    assert get_subtree_keys(merged, merged.roots[0]) == get_subtree_keys(disk, disk.roots[0])
+    assert get_subtree_keys(merged, merged.roots[1]) == get_subtree_keys(memory, memory.roots[0])
+
+    for tree in (disk, memory):
+        for node in range(len(tree)):
+            key = tree.get_key(node)
+            merged_node = merged.find(key)
+            assert merged_node is not None
+            assert merged.get_key(merged_node) == key
+            # Titles are looked up in the merged title table.
+            assert merged.node_json(merged_node) == tree.node_json(node)
+            assert merged.children_json(merged_node) == tree.children_json(node)
+            assert merged.get_aggregates(merged_node) == tree.get_aggregates(node)
+    assert merged.find("D:") is None
+
+
+def test_merge_saved_trees(tmp_path):
+    disk = build_tree("C:", ["a.txt", "dir/b.txt"])
+    memory = build_tree("Processes", ["4/100"])
+    disk.save(tmp_path / "disk.bin")
+    memory.save(tmp_path / "memory.bin")
+
+    # Trees mapped from files (memoryviews rather than arrays) merge the same way.
+    merged = CompactTree.open(tmp_path / "disk.bin").merge(CompactTree.open(tmp_path / "memory.bin"))
+    merged.save(tmp_path / "merged.bin")
+
+    assert CompactTree.open(tmp_path / "merged.bin").tree_json() == disk.merge(memory).tree_json()
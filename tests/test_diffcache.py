@@ -0,0 +1,103 @@
+import types
+
+import pytest
+
+import diff_tree
+import diffcache
+import grep_index
+import packstore
+import progress
+import unified_diff
+
+DIFF_LINES = [
+    "diff --git a b\n",
+    "--- a\n",
+    "+++ b\n",
+    "@@ -1,2 +1,2 @@\n",
+    " one\n",
+    "-two\n",
+    "+three\n",
+]
+
+
+def make_cache(tmp_path, storage):
+    return diffcache.DiffCache(tmp_path / "disk", tmp_path / "tree", tmp_path / "memory", storage=storage)
+
+
+def write_run(tmp_path, storage):
+    """A finished run with a file, a directory and a process diff."""
+    cache = make_cache(tmp_path, storage)
+    run_progress = progress.Progress(cache.tree_path, "results")
+    cache.cache_results({
+        "/a": unified_diff.UnifiedDiff(DIFF_LINES, is_dir=False),
+        "/dir": unified_diff.UnifiedDiff(DIFF_LINES[:3], is_dir=True),
+    })
+    cache.cache_process_results({"42": unified_diff.UnifiedDiff(DIFF_LINES)})
+    (cache.tree_path / diffcache.TREE_FILENAME).touch()
+    run_progress.finish()
+    return cache
+
+
+@pytest.mark.parametrize("storage", ["pack", "mirror"])
+def test_interrupted_run_isnt_cached(tmp_path, storage):
+    cache = make_cache(tmp_path, storage)
+    run_progress = progress.Progress(cache.tree_path, "results")
+    cache.cache_results({"/a": unified_diff.UnifiedDiff(DIFF_LINES)})
+    # Published with the first batch of results.
+    (cache.tree_path / diffcache.TREE_FILENAME).touch()
+    assert not cache.cache_exists()
+
+    run_progress.finish()
+    assert cache.cache_exists()
+
+    cache.clear()
+    assert not cache.cache_exists()
+    assert not cache.run_path.exists()
+    assert progress.read_progress(cache.tree_path) is None
+
+
+@pytest.mark.parametrize("storage", ["pack", "mirror"])
+def test_cached_results_are_loaded_lazily(tmp_path, storage):
+    write_run(tmp_path, storage)
+    results = make_cache(tmp_path, storage).get_cached_results()
+    assert sorted(results) == ["/a", "/dir"]
+    assert "/missing" not in results
+
+    diff = results["/a"]
+    assert results["/a"] is diff
+    assert (diff.status, diff.lines_added, diff.lines_removed, diff.is_dir) == ("modified", 1, 1, False)
+    assert results["/dir"].is_dir
+    # The stats came from the index, the lines are read when they're used.
+    assert diff._diff_lines is None
+    assert diff.diff_lines == DIFF_LINES
+
+    processes = make_cache(tmp_path, storage).get_cached_process_results()
+    assert list(processes) == ["42"]
+    assert processes["42"].diff_lines == DIFF_LINES
+
+
+@pytest.mark.parametrize("storage", ["pack", "mirror"])
+def test_grep_index_is_built_from_cached_results(tmp_path, storage):
+    write_run(tmp_path, storage)
+    (tmp_path / "tree" / grep_index.GrepIndex.FILENAME).unlink()
+    cache = make_cache(tmp_path, storage)
+    assert not cache.grep_index_cache_exists()
+
+    cache.index_cached_results()
+    found = cache.get_grep_index_from_cache().search("three", cache.get_diff_lines)
+    assert sorted(result["key"] for result in found["results"]) == ["/a", "42"]
+
+
+@pytest.mark.parametrize("storage", ["pack", "mirror"])
+def test_tree_from_cached_results_doesnt_read_diffs(tmp_path, storage, monkeypatch):
+    write_run(tmp_path, storage)
+    results = make_cache(tmp_path, storage).get_cached_results()
+
+    def read(*args):
+        raise AssertionError("Read a diff's lines")
+    monkeypatch.setattr(unified_diff.UnifiedDiff, "diff_lines", property(read))
+    monkeypatch.setattr(packstore.PackStore, "get", read)
+
+    tree = diff_tree.DiffTree(types.SimpleNamespace(diffs=results, diff_type="disk")).compact
+    node = tree.find("/a")
+    assert (tree.get_title(node), tree.lines_added[node], tree.lines_removed[node]) == ("a", 1, 1)
@@ -0,0 +1,98 @@
+import fcntl
+import shutil
+import threading
+
+import pytest
+
+import diffcache
+import open_runs
+import results_store
+from test_compact_tree import build_tree
+
+
+def evict_while(run_path, wait):
+    """Delete the run as eviction does, while wait() blocks on it."""
+    with open(run_path / results_store.ResultsStore.LOCK_FILENAME, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        waiter.join(0.2)
+        shutil.rmtree(run_path)
+    waiter.join()
+
+
+def test_reader_lock_doesnt_create_run(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        results_store.RunLock(tmp_path / "run").acquire(create=False)
+    assert not (tmp_path / "run").exists()
+
+
+def test_reader_lock_fails_on_evicted_run(tmp_path):
+    (tmp_path / "run").mkdir()
+    errors = []
+
+    def wait():
+        try:
+            results_store.RunLock(tmp_path / "run").acquire(create=False)
+        except FileNotFoundError as e:
+            errors.append(e)
+
+    evict_while(tmp_path / "run", wait)
+    assert errors
+    assert not (tmp_path / "run").exists()
+
+
+def test_writer_lock_recreates_evicted_run(tmp_path):
+    (tmp_path / "run").mkdir()
+    locks = []
+    evict_while(tmp_path / "run", lambda: locks.append(results_store.RunLock(tmp_path / "run").acquire()))
+    assert (tmp_path / "run" / results_store.ResultsStore.LOCK_FILENAME).exists()
+    locks[0].release()
+
+
+def test_evicted_run_isnt_served(tmp_path):
+    (tmp_path / "run" / "tree").mkdir(parents=True)
+    runs = open_runs.OpenRuns(tmp_path, "pack", 2)
+    found = []
+
+    def wait():
+        found.append(runs.get("run"))
+
+    with open(tmp_path / "run" / results_store.ResultsStore.LOCK_FILENAME, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        waiter.join(0.2)
+        # Other runs are looked up while it waits.
+        assert runs.get("missing") is None
+        shutil.rmtree(tmp_path / "run")
+    waiter.join()
+    assert found == [None]
+    assert not (tmp_path / "run").exists()
+
+
+def test_runs_are_opened_once(tmp_path):
+    for run_id in ("a", "b", "c"):
+        (tmp_path / run_id / "tree").mkdir(parents=True)
+    runs = open_runs.OpenRuns(tmp_path, "pack", 2)
+    run = runs.get("a")
+    assert runs.get("a") is run
+    runs.get("b")
+    runs.get("c")
+    assert runs.get("a") is not run
+
+
+def test_tree_is_reopened_when_republished(tmp_path):
+    (tmp_path / "run" / "tree").mkdir(parents=True)
+    tree_file = tmp_path / "run" / "tree" / diffcache.TREE_FILENAME
+    build_tree("", ["a"]).save(tree_file)
+    run = open_runs.OpenRuns(tmp_path, "pack", 2).get("run")
+
+    tree, version = run.get_versioned_tree()
+    assert run.get_versioned_tree() == (tree, version)
+
+    build_tree("", ["a", "b"]).save(tree_file)
+    republished, new_version = run.get_versioned_tree()
+    assert new_version != version
+    assert len(republished) == len(tree) + 1
+    assert run.get_tree() is republished
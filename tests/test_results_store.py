@@ -0,0 +1,37 @@
+import os
+
+import results_store
+
+
+def make_artifact(results_dir, name, size, age):
+    path = results_dir / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+    mtime = path.stat().st_mtime - age
+    os.utime(path, (mtime, mtime))
+    os.utime(path.parent, (mtime, mtime))
+    return path
+
+
+def test_artifacts_of_run_in_progress_are_kept(tmp_path):
+    old = results_store.ResultsStore.GRACE_PERIOD * 2
+    used = make_artifact(tmp_path, "components/used", 1000, old)
+    unused = make_artifact(tmp_path, "volumes/unused", 1000, old)
+    store = results_store.ResultsStore(tmp_path, budget=100)
+
+    with results_store.RunLock(tmp_path / "run"):
+        store.register_run(tmp_path / "run", [str(used)])
+        assert store.collect() == 1000
+
+    assert used.exists()
+    assert not unused.exists()
+
+
+def test_unlocked_runs_are_evicted(tmp_path):
+    store = results_store.ResultsStore(tmp_path, budget=100)
+    (tmp_path / "run").mkdir()
+    make_artifact(tmp_path, "run/disk/pack", 1000, 0)
+    store.register_run(tmp_path / "run", [])
+
+    assert store.collect() > 0
+    assert not (tmp_path / "run").exists()
@@ -0,0 +1,75 @@
+import pytest
+
+import search_index
+from test_compact_tree import build_tree
+
+PATHS = [
+    "café",
+    "Über/x.txt",
+    "docs/readme.md",
+    "docs/sub/readme.txt",
+    "src/main.py",
+    "src/Readme",
+    "teſt/a",
+]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return search_index.SearchIndex.build(build_tree("", PATHS))
+
+
+def search_keys(index, query, mode):
+    return [result["key"] for result in index.search(query, mode)["results"]]
+
+
+@pytest.mark.parametrize("query, mode, keys", [
+    ("README", "substring", ["/src/Readme", "/docs/readme.md", "/docs/sub/readme.txt"]),
+    ("docs/sub", "substring", ["/docs/sub/readme.txt"]),
+    ("\\docs\\readme", "substring", ["/docs/readme.md"]),
+    ("*.md", "glob", ["/docs/readme.md"]),
+    ("readme.*", "glob", ["/docs/readme.md", "/docs/sub/readme.txt"]),
+    ("/src/*", "glob", ["/src/Readme", "/src/main.py"]),
+    ("r[e]adme", "glob", ["/src/Readme"]),
+    (r"readme\.(md|txt)$", "regex", ["/docs/readme.md", "/docs/sub/readme.txt"]),
+    (r"(?<=/)main", "regex", ["/src/main.py"]),
+])
+def test_search(index, query, mode, keys):
+    assert search_keys(index, query, mode) == keys
+
+
+@pytest.mark.parametrize("query, mode, keys", [
+    ("Ü", "substring", ["/Über/x.txt"]),
+    ("Ü", "regex", ["/Über/x.txt"]),
+    (r"^/\w+$", "regex", ["/café"]),
+    ("caf?", "glob", ["/café"]),
+    ("*f?", "glob", ["/café"]),
+    ("CAFÉ", "glob", ["/café"]),
+    # re.IGNORECASE matches "ſ" to "s".
+    ("test", "regex", ["/teſt/a"]),
+    ("test", "substring", ["/teſt/a"]),
+])
+def test_search_non_ascii(index, query, mode, keys):
+    assert search_keys(index, query, mode) == keys
+
+
+def test_substring_ranking(index):
+    # Names starting with the query first, then other names containing it, then shorter paths.
+    assert search_keys(index, "a", "substring") == [
+        "/teſt/a", "/café", "/src/Readme", "/src/main.py", "/docs/readme.md", "/docs/sub/readme.txt"]
+    # Matches only in directory names last.
+    assert search_keys(index, "r", "substring") == [
+        "/src/Readme", "/docs/readme.md", "/docs/sub/readme.txt", "/Über/x.txt", "/src/main.py"]
+
+
+def test_search_limit_and_total(index):
+    found = index.search("readme", "substring", limit=1)
+    assert len(found["results"]) == 1
+    assert found["total"] == 3
+    assert not found["truncated"]
+
+
+def test_search_empty_and_unknown_mode(index):
+    assert index.search("", "regex") == {"results": [], "total": 0, "truncated": False}
+    with pytest.raises(ValueError):
+        index.search("a", "fuzzy")
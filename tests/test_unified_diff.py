@@ -0,0 +1,187 @@
+import re
+
+import pytest
+
+import diffcache
+import grep_index
+import unified_diff
+
+DIFF_LINES = [
+    "diff --git a b\n",
+    "--- a\n",
+    "+++ b\n",
+    "@@ -1,3 +1,3 @@\n",
+    " one\n",
+    "-two\n",
+    # An added line "+two", not a header.
+    "++two\n",
+    " three\n",
+    "@@ -10,2 +10,3 @@\n",
+    " ten\n",
+    # A removed line "-eleven".
+    "--eleven\n",
+    "+eleven\n",
+    "+twelve\n",
+]
+HEADER_END = 3
+HUNKS = [3, 8]
+
+_HUNK_HEADER = re.compile(r"^@@ -(\d+),(\d+) \+(\d+),(\d+) @@")
+
+
+def check_hunks(lines):
+    """Assert that every hunk of a diff has as many old and new lines as its header says."""
+    hunk_starts = [index for index, line in enumerate(lines) if line.startswith("@@")]
+    for start, end in zip(hunk_starts, hunk_starts[1:] + [len(lines)]):
+        _, old_count, _, new_count = map(int, _HUNK_HEADER.match(lines[start]).groups())
+        body = lines[start + 1:end]
+        assert old_count == sum(not line.startswith("+") for line in body)
+        assert new_count == sum(not line.startswith("-") for line in body)
+
+
+def test_stats_count_changes_in_hunks_only():
+    stats = unified_diff.get_stats(DIFF_LINES)
+    hunk_index = unified_diff.get_hunk_index(DIFF_LINES)
+
+    assert stats["status"] == "modified"
+    assert (stats["linesAdded"], stats["linesRemoved"]) == (3, 2)
+    assert stats["bytesChanged"] == len("+two\n" "two\n" "-eleven\n" "eleven\n" "twelve\n")
+    # Windows report the same statistics as the tree.
+    assert hunk_index == {"lines": len(DIFF_LINES), "hunks": HUNKS, "linesAdded": 3, "linesRemoved": 2}
+
+
+def test_stats_status():
+    assert unified_diff.get_stats(["diff --git a b\n", "new file mode 644\n"])["status"] == "added"
+    assert unified_diff.get_stats(["diff --git a b\n", "deleted file mode 644\n"])["status"] == "removed"
+
+
+@pytest.mark.parametrize("start, end, hunk_start, hunk_end", [
+    (3, 8, 0, 1),
+    (8, 13, 1, 2),
+    (3, 13, 0, 2),
+])
+def test_window_on_hunk_boundaries(start, end, hunk_start, hunk_end):
+    window = unified_diff.get_window(DIFF_LINES, unified_diff.get_hunk_index(DIFF_LINES), start, end)
+
+    # The diff's headers, then the hunks as they are.
+    assert window["lines"] == DIFF_LINES[:HEADER_END] + DIFF_LINES[start:end]
+    assert (window["start"], window["end"]) == (start, end)
+    assert (window["hunkStart"], window["hunkEnd"]) == (hunk_start, hunk_end)
+    assert window["stats"] == {"lines": 13, "hunks": 2, "linesAdded": 3, "linesRemoved": 2}
+
+
+def test_window_within_hunk_gets_its_own_header():
+    window = unified_diff.get_window(DIFF_LINES, unified_diff.get_hunk_index(DIFF_LINES), 6, 10)
+
+    # Old line 3 (three) and new line 2 (the added +two) are next at line 6, and the second
+    # hunk is cut off after its first line.
+    assert window["lines"] == (DIFF_LINES[:HEADER_END] + ["@@ -3,1 +2,2 @@\n"] + DIFF_LINES[6:8]
+                               + ["@@ -10,1 +10,1 @@\n", " ten\n"])
+    assert (window["hunkStart"], window["hunkEnd"]) == (0, 2)
+
+
+def test_window_is_clamped():
+    hunk_index = unified_diff.get_hunk_index(DIFF_LINES)
+
+    # Starting in the headers starts at the first hunk.
+    assert unified_diff.get_window(DIFF_LINES, hunk_index, 0, 5)["lines"] == (
+        DIFF_LINES[:HEADER_END] + ["@@ -1,1 +1,1 @@\n", " one\n"])
+    window = unified_diff.get_window(DIFF_LINES, hunk_index, 10, 100)
+    assert (window["start"], window["end"]) == (10, 13)
+    window = unified_diff.get_window(DIFF_LINES, hunk_index, 3, 13, max_lines=4)
+    assert (window["start"], window["end"]) == (3, 7)
+    window = unified_diff.get_window(DIFF_LINES, hunk_index, 20, 30)
+    assert (window["start"], window["end"], window["lines"]) == (13, 13, DIFF_LINES[:HEADER_END])
+
+
+def test_window_without_hunks():
+    diff_lines = ["diff --git a b\n", "new file mode 644\n"]
+    window = unified_diff.get_window(diff_lines, unified_diff.get_hunk_index(diff_lines), 0, 10)
+
+    assert window["lines"] == diff_lines
+    assert window["stats"]["hunks"] == 0
+
+
+@pytest.mark.parametrize("size", range(1, 11))
+def test_windows_page_through_diff(size):
+    hunk_index = unified_diff.get_hunk_index(DIFF_LINES)
+    locations = {location["line"]: location for location in grep_index.get_locations(
+        DIFF_LINES, [index for index in range(len(DIFF_LINES)) if not DIFF_LINES[index].startswith("@@")])}
+    body = []
+    start = HEADER_END
+    while start < len(DIFF_LINES):
+        window = unified_diff.get_window(DIFF_LINES, hunk_index, start, len(DIFF_LINES), max_lines=size)
+        assert window["start"] == start
+        assert window["lines"][:HEADER_END] == DIFF_LINES[:HEADER_END]
+
+        # Each window is a diff on its own, numbered as in the whole diff.
+        lines = window["lines"][HEADER_END:]
+        check_hunks(lines)
+        continued = len(lines) - (window["end"] - start)
+        for position, line in enumerate(lines):
+            if not line.startswith("@@"):
+                continue
+            index = start + position + 1 - continued
+            if index < window["end"] and not DIFF_LINES[index].startswith("@@"):
+                old_line, _, new_line, _ = map(int, _HUNK_HEADER.match(line).groups())
+                assert locations[index]["oldLine"] in (old_line, None)
+                assert locations[index]["newLine"] in (new_line, None)
+        body.extend(line for line in lines if not line.startswith("@@"))
+        start = window["end"]
+
+    assert body == [line for line in DIFF_LINES[HEADER_END:] if not line.startswith("@@")]
+
+
+@pytest.mark.parametrize("storage", ["pack", "mirror"])
+def test_cached_window_by_hunk(tmp_path, storage):
+    cache = diffcache.DiffCache(tmp_path / "disk", tmp_path / "tree", storage=storage)
+    cache.cache_results({"/a": unified_diff.UnifiedDiff(DIFF_LINES, is_dir=False)})
+
+    window = cache.get_diff_window("/a", 1, 2, by_hunk=True)
+    assert window["lines"] == DIFF_LINES[:HEADER_END] + DIFF_LINES[8:]
+    window = cache.get_diff_window("/a", 0, 1, by_hunk=True)
+    assert window["lines"] == DIFF_LINES[:8]
+    assert cache.get_diff_window("/missing") is None
+
+
+def test_mirror_manifest_is_appended_per_batch(tmp_path):
+    cache = diffcache.DiffCache(tmp_path / "disk", tmp_path / "tree", storage="mirror")
+    cache.cache_results({"/a": unified_diff.UnifiedDiff(DIFF_LINES, is_dir=False)})
+    cache.cache_results({"/b": unified_diff.UnifiedDiff(DIFF_LINES, is_dir=False)})
+    manifest_path = cache.run_path / diffcache.MANIFEST_FILENAME
+    assert manifest_path.read_text().count("\n") == 2
+
+    # A batch still being written.
+    with open(manifest_path, "a") as f:
+        f.write('{"/c": ["c", fal')
+    reader = diffcache.DiffCache(tmp_path / "disk", tmp_path / "tree", storage="mirror")
+    assert sorted(reader._read_manifest()) == ["/a", "/b"]
+    assert reader.get_diff_lines("/b") == DIFF_LINES
+
+
+def test_diff_from_stats_loads_lines_once():
+    loads = []
+
+    def load_lines():
+        loads.append(True)
+        return DIFF_LINES
+
+    stats = unified_diff.get_stats(DIFF_LINES)
+    diff = unified_diff.UnifiedDiff.from_stats(stats, load_lines, is_dir=False)
+    assert diff.stats() == unified_diff.UnifiedDiff(DIFF_LINES).stats() == stats
+    assert (diff.lines_added, diff.lines_removed, diff.is_dir) == (3, 2, False)
+    assert not loads
+
+    assert diff.diff_lines == DIFF_LINES
+    assert diff.diff_lines == DIFF_LINES
+    assert len(loads) == 1
+
+
+def test_stats_count_lines_with_embedded_newlines():
+    # An xattr value with a newline in it is still one line of the diff.
+    lines = DIFF_LINES[:HEADER_END] + ["@@ -1,1 +1,1 @@\n", "-user.a: x\n+y\n", "+user.a: z\n-w\n"]
+    stats = unified_diff.get_stats(lines)
+    index = unified_diff.get_hunk_index(lines)
+    assert (stats["linesAdded"], stats["linesRemoved"]) == (1, 1)
+    assert (index["linesAdded"], index["linesRemoved"]) == (1, 1)
+    assert unified_diff.get_window(lines, index, 4, 5)["lines"][HEADER_END] == "@@ -1,1 +1,0 @@\n"
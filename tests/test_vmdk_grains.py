@@ -0,0 +1,96 @@
+import struct
+
+import vmdk_grains
+from vmdk_grains import DATA, SECTOR_SIZE, ZERO
+
+GRAIN_SECTORS = 2
+GRAIN_SIZE = GRAIN_SECTORS * SECTOR_SIZE
+GTES_PER_GT = 4
+
+
+def write_sparse_extent(path, grain_table_entries, flags=0, gd_offset=1, grain_sectors=GRAIN_SECTORS):
+    """Write a hosted sparse extent with the given grain table entries (sector, 0 or 1 per grain).
+
+    The grain directory is at sector 1, followed by one sector per grain table that has any entries.
+    """
+    num_grains = len(grain_table_entries)
+    grain_tables = [grain_table_entries[start:start + GTES_PER_GT]
+                    for start in range(0, num_grains, GTES_PER_GT)]
+    grain_directory = []
+    next_sector = 2
+    for grain_table in grain_tables:
+        if any(grain_table):
+            grain_directory.append(next_sector)
+            next_sector += 1
+        else:
+            grain_directory.append(0)
+
+    header = vmdk_grains._SPARSE_HEADER.pack(
+        b"KDMV", 1, flags, num_grains * grain_sectors, grain_sectors, 0, 0,
+        GTES_PER_GT, 0, gd_offset, next_sector)
+    with open(path, "wb") as f:
+        f.write(header.ljust(SECTOR_SIZE, b"\0"))
+        f.write(struct.pack(f"<{len(grain_directory)}I", *grain_directory).ljust(SECTOR_SIZE, b"\0"))
+        for grain_table in grain_tables:
+            if any(grain_table):
+                f.write(struct.pack(f"<{len(grain_table)}I", *grain_table).ljust(SECTOR_SIZE, b"\0"))
+
+
+def write_delta_descriptor(path, extent_filename, num_grains, parent_filename):
+    with open(path, "w") as f:
+        f.write("# Disk DescriptorFile\nversion=1\n")
+        f.write(f'parentFileNameHint="{parent_filename}"\n')
+        f.write(f'RW {num_grains * GRAIN_SECTORS} SPARSE "{extent_filename}"\n')
+
+
+def test_sparse_extent_states(tmp_path):
+    # The second grain table has no allocated grains, so it isn't written.
+    write_sparse_extent(tmp_path / "disk.vmdk", [0, 100, 0, 1, 0, 0, 0, 0])
+
+    grain_map = vmdk_grains.GrainMap.from_image(tmp_path / "disk.vmdk")
+
+    assert grain_map.grain_size == GRAIN_SIZE
+    # Without the zeroed grain flag, 1 is just another sector.
+    assert list(grain_map.states) == [ZERO, DATA, ZERO, DATA, ZERO, ZERO, ZERO, ZERO]
+
+
+def test_zeroed_grains(tmp_path):
+    write_sparse_extent(tmp_path / "disk.vmdk", [0, 100, 0, 1, 1, 0, 0, 0],
+                        flags=vmdk_grains._FLAG_ZEROED_GRAIN_GTE)
+
+    grain_map = vmdk_grains.GrainMap.from_image(tmp_path / "disk.vmdk")
+
+    assert list(grain_map.states) == [ZERO, DATA, ZERO, ZERO, ZERO, ZERO, ZERO, ZERO]
+
+
+def test_delta_reads_unallocated_grains_from_parent(tmp_path):
+    write_sparse_extent(tmp_path / "base.vmdk", [5, 0, 0, 0, 0, 0, 0, 9])
+    write_sparse_extent(tmp_path / "delta-s001.vmdk", [0, 0, 7, 0, 0, 0, 0, 0])
+    write_delta_descriptor(tmp_path / "delta.vmdk", "delta-s001.vmdk", 8, "base.vmdk")
+
+    grain_map = vmdk_grains.GrainMap.from_image(tmp_path / "delta.vmdk")
+
+    assert list(grain_map.states) == [DATA, ZERO, DATA, ZERO, ZERO, ZERO, ZERO, DATA]
+    assert not grain_map.is_zero(0, 1)
+    assert grain_map.is_zero(GRAIN_SIZE, GRAIN_SIZE)
+    # Ranges spanning a data grain, or ending in one.
+    assert not grain_map.is_zero(GRAIN_SIZE, GRAIN_SIZE + 1)
+    assert grain_map.is_zero(3 * GRAIN_SIZE, 4 * GRAIN_SIZE)
+    assert not grain_map.is_zero(3 * GRAIN_SIZE, 4 * GRAIN_SIZE + 1)
+    # Past the end of the disk, or empty.
+    assert not grain_map.is_zero(8 * GRAIN_SIZE, 1)
+    assert not grain_map.is_zero(GRAIN_SIZE, 0)
+
+
+def test_mismatched_parent_grain_size_is_unsupported(tmp_path):
+    write_sparse_extent(tmp_path / "base.vmdk", [5, 0, 0, 0], grain_sectors=2 * GRAIN_SECTORS)
+    write_sparse_extent(tmp_path / "delta-s001.vmdk", [0, 0, 7, 0, 0, 0, 0, 0])
+    write_delta_descriptor(tmp_path / "delta.vmdk", "delta-s001.vmdk", 8, "base.vmdk")
+
+    assert vmdk_grains.GrainMap.from_image(tmp_path / "delta.vmdk") is None
+
+
+def test_stream_optimized_is_unsupported(tmp_path):
+    write_sparse_extent(tmp_path / "disk.vmdk", [0, 100, 0, 0], gd_offset=vmdk_grains._GD_AT_END)
+
+    assert vmdk_grains.GrainMap.from_image(tmp_path / "disk.vmdk") is None